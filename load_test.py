@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Load testing script for the gunicorn execution profiles
+Starts the server with every profile, sends concurrent chat requests and reports
+the memory of all server processes and the time to the first token
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+
+
+def percentile(values: List[float], percent: float) -> Optional[float]:
+    """Get the percentile of the values, None if there are no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def get_process_tree_rss(pid: int) -> int:
+    """Get the resident memory of the process and all its descendants in bytes (Linux only)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as fp:
+                for line in fp:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as fp:
+                    pending.extend(int(child) for child in fp.read().split())
+        except OSError:
+            continue
+    return total
+
+
+class LoadTestRunner:
+    def __init__(self, base_url: str, concurrency: int, requests: int, message: str, headers: Dict[str, str]):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.requests = requests
+        self.message = message
+        self.headers = {'Content-Type': 'application/json', **headers}
+
+    async def chat(self, session: aiohttp.ClientSession) -> Dict[str, Optional[float]]:
+        """Send one chat request and measure the time to the first token and to the end of the stream"""
+        start = time.perf_counter()
+        first_token = None
+        async with session.post(
+                f'{self.base_url}/chat', json={'message': self.message}, headers=self.headers) as response:
+            if response.status != 200:
+                return {'status': response.status, 'ttft': None, 'total': None}
+            async for line in response.content:
+                if first_token is None and line.startswith(b'data: '):
+                    try:
+                        event = json.loads(line[len(b'data: '):])
+                    except ValueError:
+                        continue
+                    if event.get('type') == 'message':
+                        first_token = time.perf_counter() - start
+        return {'status': 200, 'ttft': first_token, 'total': time.perf_counter() - start}
+
+    async def run(self, pid: Optional[int] = None) -> Dict[str, object]:
+        """Send the requests with the given concurrency, sampling the memory of the server"""
+        results = []
+        peak_rss = 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        done = asyncio.Event()
+
+        async def sample_memory():
+            nonlocal peak_rss
+            while not done.is_set():
+                peak_rss = max(peak_rss, get_process_tree_rss(pid))
+                await asyncio.sleep(0.2)
+
+        async def one(session):
+            async with semaphore:
+                try:
+                    results.append(await self.chat(session))
+                except aiohttp.ClientError as e:
+                    results.append({'status': None, 'ttft': None, 'total': None, 'error': str(e)})
+
+        idle_rss = get_process_tree_rss(pid) if pid else None
+        sampler = asyncio.create_task(sample_memory()) if pid else None
+        start = time.perf_counter()
+        timeout = aiohttp.ClientTimeout(total=300)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await asyncio.gather(*[one(session) for _ in range(self.requests)])
+        elapsed = time.perf_counter() - start
+        done.set()
+        if sampler:
+            await sampler
+
+        ttft = [r['ttft'] for r in results if r['ttft'] is not None]
+        return {
+            'requests': len(results),
+            'succeeded': sum(r['status'] == 200 for r in results),
+            'rejected': sum(r['status'] == 503 for r in results),
+            'throughput_rps': len(results) / elapsed,
+            'ttft_p50_ms': percentile(ttft, 50) and 1000 * percentile(ttft, 50),
+            'ttft_p99_ms': percentile(ttft, 99) and 1000 * percentile(ttft, 99),
+            'idle_rss_mb': idle_rss and idle_rss / 2 ** 20,
+            'peak_rss_mb': peak_rss and peak_rss / 2 ** 20,
+        }
+
+
+def start_server(profile: str, port: int, workers: Optional[int]) -> subprocess.Popen:
+    """Start gunicorn with the profile in the production mode, which does not reload the code"""
+    env = dict(os.environ, WORKER_PROFILE=profile, RUNNING_IN_PRODUCTION='true')
+    if workers:
+        env['GUNICORN_WORKERS'] = str(workers)
+    return subprocess.Popen(
+        ['gunicorn', 'api.main:create_app', '--bind', f'127.0.0.1:{port}'],
+        cwd=SRC_DIRECTORY, env=env)
+
+
+async def wait_until_healthy(base_url: str, timeout: float) -> bool:
+    """Wait for the health endpoint of the started server"""
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f'{base_url}/health') as response:
+                    if response.status == 200:
+                        return True
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(1)
+    return False
+
+
+def print_summary(results: Dict[str, Dict[str, object]]):
+    """Print the table of the results by profile"""
+    columns = ['succeeded', 'rejected', 'throughput_rps', 'ttft_p50_ms', 'ttft_p99_ms', 'idle_rss_mb', 'peak_rss_mb']
+    print('\n' + '=' * 100)
+    print(f"{'profile':<12}" + ''.join(f'{column:>14}' for column in columns))
+    for profile, result in results.items():
+        cells = []
+        for column in columns:
+            value = result.get(column)
+            cells.append(f'{value:>14.1f}' if isinstance(value, float) else f'{str(value):>14}')
+        print(f'{profile:<12}' + ''.join(cells))
+    print('=' * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the gunicorn execution profiles under load')
+    parser.add_argument('--profiles', default='async,legacy', help='Comma separated profiles to start and compare')
+    parser.add_argument('--url', help='Test the already running server instead of starting one per profile')
+    parser.add_argument('--pid', type=int, help='The gunicorn master process of the running server, for the memory')
+    parser.add_argument('--port', type=int, default=50505, help='The port of the started servers')
+    parser.add_argument('--workers', type=int, help='Override the number of workers of the started servers')
+    parser.add_argument('--concurrency', type=int, default=32, help='The number of concurrent chats')
+    parser.add_argument('--requests', type=int, default=200, help='The total number of chats per profile')
+    parser.add_argument('--message', default='What is the return policy?', help='The chat message')
+    parser.add_argument('--subscription-key', help='The APIM subscription key, if the URL is the gateway')
+    parser.add_argument('--startup-timeout', type=float, default=120, help='Seconds to wait for the server to start')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    headers = {'Ocp-Apim-Subscription-Key': args.subscription_key} if args.subscription_key else {}
+    results = {}
+    if args.url:
+        runner = LoadTestRunner(args.url, args.concurrency, args.requests, args.message, headers)
+        results['running'] = asyncio.run(runner.run(args.pid))
+    else:
+        base_url = f'http://127.0.0.1:{args.port}'
+        for profile in args.profiles.split(','):
+            print(f'🚀 Starting the server with the profile {profile}...')
+            server = start_server(profile, args.port, args.workers)
+            try:
+                if not asyncio.run(wait_until_healthy(base_url, args.startup_timeout)):
+                    print(f'❌ The server with the profile {profile} did not start')
+                    continue
+                runner = LoadTestRunner(base_url, args.concurrency, args.requests, args.message, headers)
+                results[profile] = asyncio.run(runner.run(server.pid))
+                print(f'✅ {profile}: {results[profile]}')
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=60)
+
+    print_summary(results)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    return 0 if results else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
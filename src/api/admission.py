@@ -0,0 +1,245 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from typing import Any, Callable, Dict, Optional
+
+import asyncio
+import collections
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
+from .latency import LatencyRecorder
+
+logger = logging.getLogger("azureaiapp")
+
+
+class AdmissionRejected(Exception):
+    """
+    The run was not admitted, because the worker is busy.
+
+    :param message: The reason of the rejection.
+    :param retry_after: The number of seconds, after which the client may retry.
+    """
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        """Constructor."""
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    The limit of the agent runs, which are active at the same time.
+
+    At most max_active runs are active in this worker. The next max_waiting requests wait in
+    the order of arrival for up to wait_timeout seconds, and the requests, which do not fit
+    into the queue or wait too long, are rejected at once, so the client may retry later
+    instead of slowing down all runs. If host_max_active is set, the runs of all workers on
+    the host are limited too: every run holds the lock of one of host_max_active files in
+    the host directory, which the system releases even if the worker dies.
+
+    :param max_active: The maximal number of the active runs of this worker.
+    :param max_waiting: The maximal number of the requests, waiting for the run.
+    :param wait_timeout: The maximal number of seconds to wait for the run.
+    :param host_max_active: The maximal number of the active runs of all workers on the host, 0 disables the limit.
+    :param host_directory: The directory with the lock files, shared by the workers.
+    """
+
+    DEFAULT_MAX_ACTIVE = 16
+    DEFAULT_MAX_WAITING = 32
+    DEFAULT_WAIT_TIMEOUT = 10.0
+    DEFAULT_HOST_DIRECTORY = os.path.join(tempfile.gettempdir(), "azureaiapp-admission")
+    HOST_POLL_INTERVAL = 0.05
+    # The weight of the last run in the average run duration, used to suggest the retry time.
+    DURATION_SMOOTHING = 0.2
+
+    def __init__(
+            self,
+            max_active: int = DEFAULT_MAX_ACTIVE,
+            max_waiting: int = DEFAULT_MAX_WAITING,
+            wait_timeout: float = DEFAULT_WAIT_TIMEOUT,
+            host_max_active: int = 0,
+            host_directory: str = DEFAULT_HOST_DIRECTORY
+        ) -> None:
+        """Constructor."""
+        self._max_active = max_active
+        self._max_waiting = max_waiting
+        self._wait_timeout = wait_timeout
+        self._host_max_active = host_max_active
+        self._host_directory = host_directory
+        if host_max_active and fcntl is None:
+            logger.warning("The host limit of the runs is not supported on this platform")
+            self._host_max_active = 0
+        if self._host_max_active:
+            os.makedirs(host_directory, exist_ok=True)
+        self._active = 0
+        self._waiters: collections.deque = collections.deque()
+        self._average_duration = 0.0
+        self._wait_times = LatencyRecorder()
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._host_waits = 0
+
+    def _retry_after(self) -> int:
+        """
+        Estimate the time, after which the client is likely to be admitted.
+
+        :return: The number of seconds, at least 1.
+        """
+        queued = len(self._waiters) + 1
+        return max(1, math.ceil(self._average_duration * queued / max(self._max_active, 1)))
+
+    def _reject(self, message: str) -> AdmissionRejected:
+        """
+        Build the rejection error.
+
+        :param message: The reason of the rejection.
+        :return: The error to raise.
+        """
+        logger.warning(f"The run was rejected: {message}")
+        return AdmissionRejected(message, self._retry_after())
+
+    async def _acquire_local(self) -> None:
+        """Take the slot of this worker, waiting in the queue if all slots are taken."""
+        if self._active < self._max_active and not self._waiters:
+            self._active += 1
+            return
+        if len(self._waiters) >= self._max_waiting:
+            self._rejected += 1
+            raise self._reject(f"{len(self._waiters)} requests are waiting for the run")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # The released slot is handed over to the waiter without decrementing the number of the active runs.
+            await asyncio.wait_for(waiter, self._wait_timeout)
+        except asyncio.TimeoutError:
+            self._remove_waiter(waiter)
+            self._timed_out += 1
+            raise self._reject(f"The run was not started in {self._wait_timeout} seconds")
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._release_local()
+            else:
+                self._remove_waiter(waiter)
+            raise
+
+    def _remove_waiter(self, waiter: asyncio.Future) -> None:
+        """
+        Remove the waiter, which has given up, from the queue.
+
+        :param waiter: The future of the waiter.
+        """
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _release_local(self) -> None:
+        """Give the slot of this worker to the first waiter or free it."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    def _try_lock_host_slot(self) -> Optional[int]:
+        """
+        Lock one of the free host slots.
+
+        :return: The descriptor of the locked file or None if all slots are taken.
+        """
+        first = random.randrange(self._host_max_active)
+        for i in range(self._host_max_active):
+            path = os.path.join(self._host_directory, f"slot-{(first + i) % self._host_max_active}.lock")
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    async def _acquire_host(self, deadline: float) -> int:
+        """
+        Lock the host slot, polling until the deadline.
+
+        :param deadline: The time.monotonic() value, after which the request is rejected.
+        :return: The descriptor of the locked file.
+        """
+        fd = self._try_lock_host_slot()
+        if fd is not None:
+            return fd
+        self._host_waits += 1
+        while time.monotonic() < deadline:
+            await asyncio.sleep(AdmissionController.HOST_POLL_INTERVAL)
+            fd = self._try_lock_host_slot()
+            if fd is not None:
+                return fd
+        self._timed_out += 1
+        raise self._reject(f"All {self._host_max_active} runs of the host are active")
+
+    async def acquire(self) -> Callable[[], None]:
+        """
+        Wait for the permission to start the run.
+
+        :return: The function, which must be called once the run has finished.
+        :raises AdmissionRejected: If the worker or the host is busy.
+        """
+        start = time.monotonic()
+        await self._acquire_local()
+        fd = None
+        if self._host_max_active:
+            try:
+                fd = await self._acquire_host(start + self._wait_timeout)
+            except BaseException:
+                self._release_local()
+                raise
+        admitted = time.monotonic()
+        self._wait_times.record('wait', admitted - start)
+        self._admitted += 1
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if released:
+                return
+            released = True
+            if fd is not None:
+                os.close(fd)
+            duration = time.monotonic() - admitted
+            self._average_duration += AdmissionController.DURATION_SMOOTHING * (duration - self._average_duration)
+            self._release_local()
+
+        return release
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the admission metrics.
+
+        :return: The dictionary with the number of active runs and waiting requests, their limits,
+                 the number of admitted, rejected and timed out requests, the waits for the host
+                 slot, the average run duration and the wait time percentiles in milliseconds.
+        """
+        return {
+            'active': self._active,
+            'max_active': self._max_active,
+            'waiting': len(self._waiters),
+            'max_waiting': self._max_waiting,
+            'host_max_active': self._host_max_active,
+            'admitted': self._admitted,
+            'rejected': self._rejected,
+            'timed_out': self._timed_out,
+            'host_waits': self._host_waits,
+            'average_run_ms': 1000 * self._average_duration,
+            'wait': self._wait_times.stats('wait')['wait'],
+        }
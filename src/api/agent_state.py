@@ -0,0 +1,143 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+The resolution of the agent, shared by the gunicorn master and workers.
+
+The master resolves the agent once and stores its identifier together with the project
+endpoint and the agent name in the state file. The workers and the next start read the
+identifier from there and validate it with a single get_agent call, so the agents of the
+project are listed only if the agent is not known yet.
+"""
+from typing import Optional
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+from azure.ai.agents.aio import AgentsClient
+from azure.ai.agents.models import Agent
+
+logger = logging.getLogger("azureaiapp")
+
+
+class AgentStateFile:
+    """
+    The file with the identifier of the resolved agent.
+
+    :param path: The path to the state file.
+    """
+
+    DEFAULT_PATH = os.path.join(tempfile.gettempdir(), "azureaiapp-agent.json")
+
+    def __init__(self, path: str = DEFAULT_PATH) -> None:
+        """Constructor."""
+        self._path = path
+
+    def read(self, endpoint: Optional[str], agent_name: Optional[str]) -> Optional[str]:
+        """
+        Read the identifier of the agent with the name in the project.
+
+        :param endpoint: The project endpoint.
+        :param agent_name: The agent name.
+        :return: The agent identifier or None if the file is missing or stores another agent.
+        """
+        try:
+            with open(self._path, encoding='utf-8') as fp:
+                state = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if state.get('endpoint') != endpoint or state.get('name') != agent_name:
+            return None
+        return state.get('agent_id')
+
+    def write(self, endpoint: Optional[str], agent_name: Optional[str], agent_id: str) -> None:
+        """
+        Store the identifier of the resolved agent, replacing the old file at once.
+
+        :param endpoint: The project endpoint.
+        :param agent_name: The agent name.
+        :param agent_id: The agent identifier.
+        """
+        state = {'endpoint': endpoint, 'name': agent_name, 'agent_id': agent_id, 'updated': time.time()}
+        try:
+            temporary_path = f"{self._path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'w', encoding='utf-8') as fp:
+                json.dump(state, fp)
+            os.replace(temporary_path, self._path)
+        except OSError as e:
+            logger.warning(f"Failed to write the agent state {self._path}: {e}")
+
+
+async def get_agent_if_valid(
+        agents_client: AgentsClient, agent_id: str, agent_name: Optional[str] = None) -> Optional[Agent]:
+    """
+    Get the agent and check that it has the expected name.
+
+    :param agents_client: The agents client.
+    :param agent_id: The agent identifier.
+    :param agent_name: The expected name, None skips the check.
+    :return: The agent or None if it does not exist or has another name.
+    """
+    try:
+        agent = await agents_client.get_agent(agent_id)
+    except Exception as e:
+        logger.warning(f"Could not retrieve agent by ID {agent_id}, error: {e}")
+        return None
+    if agent_name is not None and agent.name != agent_name:
+        logger.warning(f"The agent {agent_id} is named '{agent.name}' instead of '{agent_name}'")
+        return None
+    return agent
+
+
+async def find_agent_by_name(agents_client: AgentsClient, agent_name: str) -> Optional[Agent]:
+    """
+    Find the agent by name, listing all agents of the project.
+
+    :param agents_client: The agents client.
+    :param agent_name: The agent name.
+    :return: The agent or None if there is no agent with this name.
+    """
+    async for agent in agents_client.list_agents():
+        if agent.name == agent_name:
+            return agent
+    return None
+
+
+async def resolve_agent(
+        agents_client: AgentsClient,
+        endpoint: Optional[str],
+        agent_id: Optional[str],
+        agent_name: Optional[str],
+        state: AgentStateFile) -> Optional[Agent]:
+    """
+    Get the agent by the configured identifier, by the identifier in the state file or by name.
+
+    The configured identifier is trusted without checking the name. The agents are listed
+    only if neither identifier resolves to the agent. The resolved agent is stored in the
+    state file.
+
+    :param agents_client: The agents client.
+    :param endpoint: The project endpoint.
+    :param agent_id: The configured agent identifier.
+    :param agent_name: The agent name.
+    :param state: The state file.
+    :return: The agent or None if it was not found.
+    """
+    agent = None
+    if agent_id:
+        agent = await get_agent_if_valid(agents_client, agent_id)
+    if agent is None:
+        cached_id = state.read(endpoint, agent_name)
+        if cached_id and cached_id != agent_id:
+            agent = await get_agent_if_valid(agents_client, cached_id, agent_name)
+            if agent is not None:
+                logger.info(f"Found agent in the state file, ID: {agent.id}")
+    if agent is None and agent_name:
+        agent = await find_agent_by_name(agents_client, agent_name)
+        if agent is not None:
+            logger.info(f"Found agent by name '{agent_name}', ID: {agent.id}")
+    if agent is not None and state.read(endpoint, agent_name) != agent.id:
+        state.write(endpoint, agent_name, agent.id)
+    return agent
@@ -0,0 +1,137 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import asyncio
+import collections
+import time
+
+
+class AsyncLRUCache:
+    """
+    The least recently used cache with expiration for the results of coroutines.
+
+    Concurrent misses of the same key are coalesced: the value is loaded once and all
+    callers await the same result. The load continues even if the caller, which started
+    it, was cancelled. Exceptions are propagated to the callers and are not cached.
+
+    :param maxsize: The maximal number of entries in the cache.
+    :param ttl: The number of seconds after which an entry expires, None means never.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        """Constructor."""
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive.")
+        self._maxsize = maxsize
+        self._ttl = ttl
+        # key -> (expiration time, value)
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        # The loads in progress, the invalidated loads are removed and their results are not stored.
+        self._loading: Dict[Hashable, asyncio.Task] = {}
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        Get the value if it is in the cache and not expired.
+
+        :param key: The key to look up.
+        :return: The tuple of the flag, showing if the value was found, and the value.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires, value = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Put the value into the cache, evicting the least recently used entries if needed.
+
+        :param key: The key of the value.
+        :param value: The value to store.
+        """
+        expires = time.monotonic() + self._ttl if self._ttl is not None else None
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Get the value from the cache or load it, sharing the load between concurrent callers.
+
+        :param key: The key of the value.
+        :param loader: The function returning the awaitable, which produces the value.
+        :return: The cached or loaded value.
+        """
+        found, value = self.get(key)
+        if found:
+            self._hits += 1
+            return value
+        task = self._loading.get(key)
+        if task is None:
+            self._misses += 1
+            task = asyncio.ensure_future(self._load(key, loader))
+            self._loading[key] = task
+        else:
+            self._coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Load the value and store it if the key was not invalidated meanwhile.
+
+        :param key: The key of the value.
+        :param loader: The function returning the awaitable, which produces the value.
+        :return: The loaded value.
+        """
+        try:
+            value = await loader()
+            if self._loading.get(key) is asyncio.current_task():
+                self.set(key, value)
+            return value
+        finally:
+            if self._loading.get(key) is asyncio.current_task():
+                del self._loading[key]
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """
+        Remove the entry or, if the key is not provided, all entries from the cache.
+
+        The loads, which are in progress, complete for their callers but their results are not stored.
+
+        :param key: The key to remove.
+        """
+        if key is None:
+            self._entries.clear()
+            self._loading.clear()
+        else:
+            self._entries.pop(key, None)
+            self._loading.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the cache counters.
+
+        :return: The dictionary with the number of hits, misses, coalesced misses, evictions and the size.
+        """
+        return {
+            'size': len(self._entries),
+            'maxsize': self._maxsize,
+            'hits': self._hits,
+            'misses': self._misses,
+            'coalesced': self._coalesced,
+            'evictions': self._evictions,
+        }
@@ -0,0 +1,107 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+The start-up state, resolved once by the gunicorn master and inherited by the workers.
+
+The master stores the agent definition, including its tools, and the Application Insights
+connection string in the environment before forking the workers, so the workers do not
+send the same requests to the project endpoint at the same time. The workers are also
+recreated after max_requests, so the state older than the maximal age is not trusted.
+"""
+from typing import Any, Dict, MutableMapping, Optional
+
+import json
+import logging
+import os
+import random
+import time
+
+from azure.ai.agents.models import Agent
+
+logger = logging.getLogger("azureaiapp")
+
+
+class WorkerBootstrap:
+    """
+    The agent and the telemetry configuration of the project.
+
+    :param endpoint: The project endpoint.
+    :param agent: The agent.
+    :param telemetry_connection_string: The Application Insights connection string, None if tracing is disabled.
+    :param created: The time.time() value, when the state was resolved.
+    """
+
+    ENV_NAME = "AZUREAIAPP_BOOTSTRAP"
+    DEFAULT_MAX_AGE = 3600.0
+    DEFAULT_STARTUP_JITTER = 5.0
+
+    def __init__(
+            self,
+            endpoint: Optional[str],
+            agent: Agent,
+            telemetry_connection_string: Optional[str] = None,
+            created: Optional[float] = None
+        ) -> None:
+        """Constructor."""
+        self.endpoint = endpoint
+        self.agent = agent
+        self.telemetry_connection_string = telemetry_connection_string
+        self.created = time.time() if created is None else created
+
+    def save(self, environ: MutableMapping[str, str] = os.environ) -> None:
+        """
+        Store the state in the environment, which the forked workers inherit.
+
+        :param environ: The environment.
+        """
+        state: Dict[str, Any] = {
+            'endpoint': self.endpoint,
+            'agent': self.agent.as_dict(),
+            'telemetry_connection_string': self.telemetry_connection_string,
+            'created': self.created,
+        }
+        environ[WorkerBootstrap.ENV_NAME] = json.dumps(state)
+
+    @staticmethod
+    def load(
+            endpoint: Optional[str],
+            agent_id: Optional[str],
+            max_age: float = DEFAULT_MAX_AGE,
+            environ: MutableMapping[str, str] = os.environ
+        ) -> Optional['WorkerBootstrap']:
+        """
+        Read the state, stored by the master.
+
+        :param endpoint: The project endpoint of this worker.
+        :param agent_id: The configured agent identifier, None accepts any agent.
+        :param max_age: The maximal age of the state in seconds.
+        :param environ: The environment.
+        :return: The state or None if it is missing, too old or belongs to another project or agent.
+        """
+        value = environ.get(WorkerBootstrap.ENV_NAME)
+        if not value:
+            return None
+        try:
+            state = json.loads(value)
+            bootstrap = WorkerBootstrap(
+                state['endpoint'], Agent(state['agent']), state.get('telemetry_connection_string'), state['created'])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring the invalid bootstrap state: {e}")
+            return None
+        if bootstrap.endpoint != endpoint or (agent_id and bootstrap.agent.id != agent_id):
+            return None
+        if time.time() - bootstrap.created > max_age:
+            logger.info("The bootstrap state is too old, fetching the agent")
+            return None
+        return bootstrap
+
+
+def get_startup_delay(jitter: float = WorkerBootstrap.DEFAULT_STARTUP_JITTER) -> float:
+    """
+    Get the random delay of the first requests of the worker, so the workers started
+    together do not acquire the tokens and warm the caches at the same time.
+
+    :param jitter: The maximal delay in seconds, 0 disables the delay.
+    :return: The delay in seconds.
+    """
+    return random.uniform(0, jitter) if jitter > 0 else 0.0
@@ -0,0 +1,325 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+Readers and writers for the embeddings files.
+
+Two formats are supported and selected by the file extension:
+
+* CSV (``*.csv``) with the ``embedId``, ``token``, ``embedding`` and ``title`` columns, where the
+  embedding is stored as a JSON array. The ``embedId`` column is optional.
+* Binary (``*.f32``), a row-major little-endian float32 matrix without a header, which
+  can be memory mapped. The tokens and titles are stored in the JSON lines sidecar with the
+  same name and the ``.jsonl`` extension. The first line of the sidecar is the header
+  with the number of dimensions and, for the converted file, the SHA-256 hash of the source
+  CSV file. Each next line describes the matrix row with the same index.
+
+The manifest (``*.manifest.json``) may be stored next to the embeddings file. It describes
+the parameters the embeddings were built with and the chunk identifiers of every source file.
+"""
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+BINARY_EXTENSION = '.f32'
+METADATA_EXTENSION = '.jsonl'
+MANIFEST_EXTENSION = '.manifest.json'
+CSV_FIELDS = ['embedId', 'token', 'embedding', 'title']
+
+_DTYPE = np.dtype('<f4')
+
+
+def is_binary(path: str) -> bool:
+    """
+    Return True if the embeddings file is stored in the binary format.
+
+    :param path: The path to the embeddings file.
+    :return: True if the file has the binary extension.
+    """
+    return path.endswith(BINARY_EXTENSION)
+
+
+def get_metadata_path(path: str) -> str:
+    """
+    Get the path to the sidecar with the tokens and titles for the binary file.
+
+    :param path: The path to the binary embeddings file.
+    :return: The path to the metadata file.
+    """
+    return os.path.splitext(path)[0] + METADATA_EXTENSION
+
+
+def get_binary_path(path: str) -> str:
+    """
+    Get the path to the binary file, stored next to the CSV file.
+
+    :param path: The path to the CSV embeddings file.
+    :return: The path to the binary embeddings file.
+    """
+    return os.path.splitext(path)[0] + BINARY_EXTENSION
+
+
+def hash_file(path: str) -> str:
+    """
+    Get the SHA-256 hash of the file content.
+
+    :param path: The path to the file.
+    :return: The hexadecimal hash.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_current_embeddings_path(path: str) -> str:
+    """
+    Get the binary file, stored next to the CSV file, if it was converted from the current CSV file.
+
+    The binary file is matched by the hash of the source CSV file in its header. The binary
+    file without the hash is used only if it is not older than the CSV file.
+
+    :param path: The path to the CSV embeddings file.
+    :return: The path to the binary file or the CSV file if the binary file is missing or stale.
+    """
+    binary_path = get_binary_path(path)
+    if not os.path.isfile(binary_path) or not os.path.isfile(get_metadata_path(binary_path)):
+        return path
+    if not os.path.isfile(path):
+        return binary_path
+    with open(get_metadata_path(binary_path), encoding='utf-8') as fp:
+        source_hash = json.loads(fp.readline()).get('source_sha256')
+    if source_hash:
+        return binary_path if source_hash == hash_file(path) else path
+    return binary_path if os.path.getmtime(binary_path) >= os.path.getmtime(path) else path
+
+
+def get_manifest_path(path: str) -> str:
+    """
+    Get the path to the manifest of the embeddings file.
+
+    :param path: The path to the embeddings file.
+    :return: The path to the manifest file.
+    """
+    return os.path.splitext(path)[0] + MANIFEST_EXTENSION
+
+
+def read_manifest(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Read the manifest of the embeddings file.
+
+    :param path: The path to the embeddings file.
+    :return: The manifest or None if the embeddings file or its manifest does not exist.
+    """
+    manifest_path = get_manifest_path(path)
+    if not os.path.isfile(path) or not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def write_manifest(path: str, manifest: Dict[str, Any]) -> None:
+    """
+    Write the manifest of the embeddings file.
+
+    :param path: The path to the embeddings file.
+    :param manifest: The manifest to write.
+    """
+    with open(get_manifest_path(path), 'w', encoding='utf-8') as fp:
+        json.dump(manifest, fp, indent=2)
+
+
+class EmbeddingsWriter:
+    """
+    The writer of the embeddings file, the format is defined by the file extension.
+
+    :param path: The path to the embeddings file to be created.
+    :param source_sha256: The hash of the CSV file, the binary file is converted from.
+    """
+
+    def __init__(self, path: str, source_sha256: Optional[str] = None) -> None:
+        """Constructor."""
+        self._path = path
+        self._source_sha256 = source_sha256
+        self._binary = is_binary(path)
+        self._dimensions: Optional[int] = None
+        if self._binary:
+            self._vectors_fp = open(path, 'wb')
+            self._metadata_fp = open(get_metadata_path(path), 'w', encoding='utf-8')
+        else:
+            self._csv_fp = open(path, 'w', newline='')
+            self._csv_writer = csv.DictWriter(self._csv_fp, fieldnames=CSV_FIELDS)
+            self._csv_writer.writeheader()
+
+    def write(
+            self,
+            token: str,
+            title: str,
+            embedding: Sequence[float],
+            embed_id: Optional[str] = None
+        ) -> None:
+        """
+        Append the embedding to the file.
+
+        :param token: The text, the embedding was built for.
+        :param title: The name of the source document.
+        :param embedding: The embedding vector.
+        :param embed_id: The identifier of the document in the index.
+        :raises: ValueError if the embedding size differs from the previous ones.
+        """
+        if not self._binary:
+            self._csv_writer.writerow({
+                'embedId': embed_id or '',
+                'token': token,
+                'embedding': json.dumps(list(embedding)),
+                'title': title})
+            return
+        vector = np.asarray(embedding, dtype=_DTYPE)
+        if self._dimensions is None:
+            self._write_header(len(vector))
+        elif len(vector) != self._dimensions:
+            raise ValueError(
+                f"The embedding has {len(vector)} dimensions, while {self._dimensions} were expected.")
+        self._vectors_fp.write(vector.tobytes())
+        metadata = {'token': token, 'title': title}
+        if embed_id:
+            metadata['embedId'] = embed_id
+        self._metadata_fp.write(json.dumps(metadata) + '\n')
+
+    def _write_header(self, dimensions: Optional[int]) -> None:
+        """
+        Write the sidecar header.
+
+        :param dimensions: The number of dimensions in the embeddings.
+        """
+        self._dimensions = dimensions
+        header = {'dtype': 'float32', 'dimensions': dimensions}
+        if self._source_sha256:
+            header['source_sha256'] = self._source_sha256
+        self._metadata_fp.write(json.dumps(header) + '\n')
+
+    def close(self) -> None:
+        """Flush and close the underlying files."""
+        if self._binary:
+            if self._dimensions is None:
+                self._write_header(None)
+            self._vectors_fp.close()
+            self._metadata_fp.close()
+        else:
+            self._csv_fp.close()
+
+    def __enter__(self) -> 'EmbeddingsWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def _read_metadata_header(metadata_fp) -> Optional[int]:
+    """
+    Read the sidecar header.
+
+    :param metadata_fp: The opened metadata file.
+    :return: The number of dimensions in the embeddings.
+    :raises: ValueError if the data type is not supported.
+    """
+    header = json.loads(metadata_fp.readline())
+    if header.get('dtype') != 'float32':
+        raise ValueError(f"Unsupported embeddings data type {header.get('dtype')}.")
+    return header['dimensions']
+
+
+def load_vectors(path: str) -> np.ndarray:
+    """
+    Map the binary embeddings matrix into memory without copying it.
+
+    :param path: The path to the binary embeddings file.
+    :return: The read-only matrix with one embedding per row.
+    """
+    with open(get_metadata_path(path), encoding='utf-8') as fp:
+        dimensions = _read_metadata_header(fp)
+    if not dimensions or os.path.getsize(path) == 0:
+        return np.zeros((0, dimensions or 0), dtype=_DTYPE)
+    return np.memmap(path, dtype=_DTYPE, mode='r').reshape(-1, dimensions)
+
+
+def load_embeddings(path: str) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+    """
+    Load the embeddings matrix and the metadata of its rows.
+
+    The binary matrix is memory mapped, the CSV file is parsed into the float32 matrix.
+
+    :param path: The path to the embeddings file.
+    :return: The tuple of the embeddings matrix and the list of the row metadata. The matrix
+             of the empty CSV file has the shape (0, 0).
+    """
+    if is_binary(path):
+        vectors = load_vectors(path)
+        with open(get_metadata_path(path), encoding='utf-8') as fp:
+            _read_metadata_header(fp)
+            metadata = [json.loads(line) for line in fp]
+        return vectors, metadata
+    metadata = []
+    embeddings = []
+    for row in iter_embeddings(path):
+        embeddings.append(row.pop('embedding'))
+        metadata.append(row)
+    if not embeddings:
+        return np.zeros((0, 0), dtype=_DTYPE), metadata
+    return np.array(embeddings, dtype=_DTYPE).reshape(len(embeddings), -1), metadata
+
+
+def iter_embeddings(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Read the embeddings file row by row.
+
+    :param path: The path to the embeddings file.
+    :return: The iterator over dictionaries with token, title and embedding as the list of floats,
+             and embedId if the file contains it.
+    """
+    if is_binary(path):
+        vectors = load_vectors(path)
+        with open(get_metadata_path(path), encoding='utf-8') as fp:
+            _read_metadata_header(fp)
+            for vector, line in zip(vectors, fp):
+                row = json.loads(line)
+                row['embedding'] = vector.tolist()
+                yield row
+        return
+    with open(path, newline='') as fp:
+        reader = csv.DictReader(fp)
+        for row in reader:
+            row['embedding'] = json.loads(row['embedding'])
+            if not row.get('embedId'):
+                row.pop('embedId', None)
+            yield row
+
+
+def convert_csv_to_binary(csv_file: str, output_file: Optional[str] = None) -> str:
+    """
+    Convert the CSV embeddings file to the binary format.
+
+    :param csv_file: The CSV file to convert.
+    :param output_file: The binary file to create, by default it is created next to the CSV file.
+    :return: The path to the binary file.
+    """
+    output_file = output_file or get_binary_path(csv_file)
+    with EmbeddingsWriter(output_file, source_sha256=hash_file(csv_file)) as writer:
+        for row in iter_embeddings(csv_file):
+            writer.write(row['token'], row['title'], row['embedding'], row.get('embedId'))
+    return output_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the CSV embeddings file to the binary format.")
+    parser.add_argument("csv_file", help="The CSV embeddings file.")
+    parser.add_argument("output_file", nargs="?", help="The binary file to create.")
+    args = parser.parse_args()
+    print(f"Written {convert_csv_to_binary(args.csv_file, args.output_file)}")
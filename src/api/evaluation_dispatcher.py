@@ -0,0 +1,178 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from typing import Any, Awaitable, Callable, Dict, List
+
+import asyncio
+import logging
+import random
+import time
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+
+from .latency import LatencyRecorder
+
+logger = logging.getLogger("azureaiapp")
+
+
+class EvaluationDispatcher:
+    """
+    The queue of the agent evaluations, processed by the fixed number of background workers.
+
+    The completed runs are sampled and put into the bounded queue without waiting, so the chat
+    never waits for the evaluation. The run, which does not fit into the queue, is dropped.
+    The workers retry the connection errors, timeouts, throttling and server errors with the
+    exponential backoff, any other error fails the evaluation at once. The evaluations, which are still queued on shutdown,
+    are given the drain timeout to finish.
+
+    :param submit: The function, creating the evaluation of the thread and run identifiers.
+    :param concurrency: The number of the evaluations sent at the same time.
+    :param queue_size: The maximal number of the queued evaluations.
+    :param sampling_percent: The percent of the completed runs to evaluate.
+    :param max_attempts: The number of attempts to create the evaluation.
+    :param retry_delay: The number of seconds before the first retry, doubled for every next one.
+    """
+
+    DEFAULT_CONCURRENCY = 2
+    DEFAULT_QUEUE_SIZE = 1000
+    DEFAULT_SAMPLING_PERCENT = 100.0
+    DEFAULT_MAX_ATTEMPTS = 3
+    DEFAULT_RETRY_DELAY = 1.0
+    DRAIN_TIMEOUT = 10.0
+
+    def __init__(
+            self,
+            submit: Callable[[str, str], Awaitable[Any]],
+            concurrency: int = DEFAULT_CONCURRENCY,
+            queue_size: int = DEFAULT_QUEUE_SIZE,
+            sampling_percent: float = DEFAULT_SAMPLING_PERCENT,
+            max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+            retry_delay: float = DEFAULT_RETRY_DELAY
+        ) -> None:
+        """Constructor."""
+        self._submit = submit
+        self._concurrency = concurrency
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._sampling_percent = sampling_percent
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._workers: List[asyncio.Task] = []
+        self._latency = LatencyRecorder()
+        self._enqueued = 0
+        self._sampled_out = 0
+        self._dropped = 0
+        self._succeeded = 0
+        self._failed = 0
+        self._retries = 0
+        self._in_flight = 0
+
+    def start(self) -> None:
+        """Start the workers."""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self._concurrency)]
+
+    def enqueue(self, thread_id: str, run_id: str) -> bool:
+        """
+        Queue the evaluation of the completed run if it is sampled.
+
+        :param thread_id: The thread identifier.
+        :param run_id: The run identifier.
+        :return: True if the evaluation was queued.
+        """
+        if random.random() * 100 >= self._sampling_percent:
+            self._sampled_out += 1
+            return False
+        try:
+            self._queue.put_nowait((thread_id, run_id))
+        except asyncio.QueueFull:
+            self._dropped += 1
+            logger.warning(f"The evaluation queue is full, the run {run_id} is not evaluated")
+            return False
+        self._enqueued += 1
+        return True
+
+    @staticmethod
+    def _is_retriable(error: Exception) -> bool:
+        """
+        Check if the failed request may succeed later.
+
+        :param error: The error of the request.
+        :return: True for the connection errors, timeouts, throttling and server errors.
+        """
+        if isinstance(error, HttpResponseError):
+            status_code = error.status_code
+            return status_code is not None and (status_code in (408, 429) or status_code >= 500)
+        return isinstance(error, (ServiceRequestError, ServiceResponseError, asyncio.TimeoutError))
+
+    async def _evaluate(self, thread_id: str, run_id: str) -> None:
+        """
+        Create the evaluation, retrying the transient failures.
+
+        :param thread_id: The thread identifier.
+        :param run_id: The run identifier.
+        """
+        for attempt in range(self._max_attempts):
+            start = time.perf_counter()
+            try:
+                logger.info(f"Running agent evaluation on thread ID {thread_id} and run ID {run_id}")
+                response = await self._submit(thread_id, run_id)
+                self._latency.record('evaluation', time.perf_counter() - start)
+                self._succeeded += 1
+                logger.info(f"Evaluation response: {response}")
+                return
+            except Exception as e:
+                if attempt + 1 >= self._max_attempts or not EvaluationDispatcher._is_retriable(e):
+                    self._failed += 1
+                    logger.error(f"Error creating agent evaluation: {e}")
+                    return
+                self._retries += 1
+                delay = self._retry_delay * 2 ** attempt
+                logger.warning(f"Error creating agent evaluation, retrying in {delay} seconds: {e}")
+                await asyncio.sleep(delay)
+
+    async def _work(self) -> None:
+        """Evaluate the queued runs one by one."""
+        while True:
+            thread_id, run_id = await self._queue.get()
+            self._in_flight += 1
+            try:
+                await self._evaluate(thread_id, run_id)
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+
+    async def close(self, timeout: float = DRAIN_TIMEOUT) -> None:
+        """
+        Wait for the queued evaluations up to the timeout and stop the workers.
+
+        :param timeout: The maximal number of seconds to wait for the queued evaluations.
+        """
+        if self._workers and self._queue.qsize() + self._in_flight:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"{self._queue.qsize() + self._in_flight} evaluations were not finished on shutdown")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the dispatcher metrics.
+
+        :return: The dictionary with the queue length, the number of queued, sampled out, dropped,
+                 succeeded, failed and retried evaluations and the evaluation latency.
+        """
+        return {
+            'queued': self._queue.qsize(),
+            'queue_size': self._queue.maxsize,
+            'in_flight': self._in_flight,
+            'sampling_percent': self._sampling_percent,
+            'enqueued': self._enqueued,
+            'sampled_out': self._sampled_out,
+            'dropped': self._dropped,
+            'succeeded': self._succeeded,
+            'failed': self._failed,
+            'retries': self._retries,
+            'latency': self._latency.stats('evaluation')['evaluation'],
+        }
@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from typing import Dict, Iterable, Optional
+
+import asyncio
+
+from azure.ai.agents.aio import AgentsClient
+from azure.ai.agents.models import FilePurpose
+
+from .async_cache import AsyncLRUCache
+
+
+class FileNameCache:
+    """
+    The cache of the names of the files, cited by the agent.
+
+    The file names almost never change, so they are resolved once per process instead of
+    once per citation. The concurrent lookups of the same file share one request.
+
+    :param maxsize: The maximal number of file names in the cache.
+    :param ttl: The number of seconds after which the file name is requested again, None means never.
+    """
+
+    DEFAULT_SIZE = 4096
+    DEFAULT_TTL = 3600.0
+
+    def __init__(self, maxsize: int = DEFAULT_SIZE, ttl: Optional[float] = DEFAULT_TTL) -> None:
+        """Constructor."""
+        self._cache = AsyncLRUCache(maxsize, ttl)
+
+    async def get(self, agent_client: AgentsClient, file_id: str) -> str:
+        """
+        Get the name of the file.
+
+        :param agent_client: The client used to request the file if it is not cached.
+        :param file_id: The file identifier.
+        :return: The file name.
+        """
+        return await self._cache.get_or_load(file_id, lambda: self._load(agent_client, file_id))
+
+    async def get_many(self, agent_client: AgentsClient, file_ids: Iterable[str]) -> Dict[str, str]:
+        """
+        Get the names of the files, requesting all missing names concurrently.
+
+        :param agent_client: The client used to request the files which are not cached.
+        :param file_ids: The file identifiers, they may repeat.
+        :return: The file names by identifier.
+        """
+        unique_ids = list(dict.fromkeys(file_ids))
+        if not unique_ids:
+            return {}
+        names = await asyncio.gather(*[self.get(agent_client, file_id) for file_id in unique_ids])
+        return dict(zip(unique_ids, names))
+
+    @staticmethod
+    async def _load(agent_client: AgentsClient, file_id: str) -> str:
+        """
+        Request the file name from the service.
+
+        :param agent_client: The agent client.
+        :param file_id: The file identifier.
+        :return: The file name.
+        """
+        openai_file = await agent_client.files.get(file_id)
+        return openai_file.filename
+
+    async def warm(self, agent_client: AgentsClient, vector_store_ids: Iterable[str] = ()) -> int:
+        """
+        Fill the cache with the names of the agent files in one request.
+
+        :param agent_client: The agent client.
+        :param vector_store_ids: If provided, only the files of these vector stores are cached.
+        :return: The number of cached file names.
+        """
+        vector_store_ids = list(vector_store_ids)
+        wanted = set()
+        for vector_store_id in vector_store_ids:
+            async for vector_store_file in agent_client.vector_store_files.list(vector_store_id):
+                wanted.add(vector_store_file.id)
+        files = await agent_client.files.list(purpose=FilePurpose.AGENTS)
+        count = 0
+        for file_info in files.data:
+            if not vector_store_ids or file_info.id in wanted:
+                self._cache.set(file_info.id, file_info.filename)
+                count += 1
+        return count
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the cache counters.
+
+        :return: The dictionary with the number of hits, misses, coalesced misses, evictions and the size.
+        """
+        return self._cache.stats()
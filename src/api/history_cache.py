@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from typing import Any, Dict, List, Optional, Tuple
+
+from .async_cache import AsyncLRUCache
+
+
+class ThreadHistoryCache:
+    """
+    The cache of the formatted messages of the recently opened threads.
+
+    The thread is cached only as a whole, newest message first, so that reopening it costs
+    one request for the messages newer than the cached ones, including the messages posted
+    by /chat since the thread was cached.
+
+    :param maxsize: The maximal number of threads in the cache.
+    :param ttl: The number of seconds after which the thread is fetched again, None means never.
+    """
+
+    DEFAULT_SIZE = 256
+    DEFAULT_TTL = 3600.0
+
+    def __init__(self, maxsize: int = DEFAULT_SIZE, ttl: Optional[float] = DEFAULT_TTL) -> None:
+        """Constructor."""
+        self._cache = AsyncLRUCache(maxsize, ttl)
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, thread_id: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Get the cached messages of the thread.
+
+        :param thread_id: The thread identifier.
+        :return: The copy of the list of the formatted messages, newest first, or None if the thread is not cached.
+        """
+        found, messages = self._cache.get(thread_id)
+        if not found:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return list(messages)
+
+    def set(self, thread_id: str, messages: List[Dict[str, Any]]) -> None:
+        """
+        Cache all messages of the thread.
+
+        :param thread_id: The thread identifier.
+        :param messages: The formatted messages with the 'id' key, newest first.
+        """
+        self._cache.set(thread_id, list(messages))
+
+    def invalidate(self, thread_id: Optional[str] = None) -> None:
+        """
+        Drop the thread or, if the thread is not provided, all threads from the cache.
+
+        :param thread_id: The thread identifier.
+        """
+        self._cache.invalidate(thread_id)
+
+    @staticmethod
+    def select_page(
+            messages: List[Dict[str, Any]],
+            limit: Optional[int] = None,
+            after: Optional[str] = None,
+            before: Optional[str] = None
+        ) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        """
+        Select the page of the messages by the cursors.
+
+        :param messages: The formatted messages, newest first.
+        :param limit: The maximal number of messages on the page.
+        :param after: The identifier of the message, the page starts after.
+        :param before: The identifier of the message, the page ends before.
+        :return: The tuple of the page and the flag, showing if there are more messages in
+                 the direction of the paging, or None if the cursor is not in the messages.
+        """
+        ids = [message['id'] for message in messages]
+        start, end = 0, len(messages)
+        try:
+            if after:
+                start = ids.index(after) + 1
+            if before:
+                end = ids.index(before)
+        except ValueError:
+            return None
+        if limit is None or end - start <= limit:
+            return messages[start:end], False
+        if before and not after:
+            return messages[end - limit:end], True
+        return messages[start:start + limit], True
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the cache counters.
+
+        :return: The dictionary with the number of hits, misses, evictions and the number of cached threads.
+        """
+        return {**self._cache.stats(), 'hits': self._hits, 'misses': self._misses}
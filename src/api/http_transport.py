@@ -0,0 +1,186 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+The HTTP connection pool, shared by the Azure SDK clients of the process.
+
+By default every client creates its own aiohttp session with the default pool limits, so
+the project, agents and search clients open and handshake their own connections. The
+shared session keeps the connections alive between the requests of all clients, caches
+the DNS lookups and counts the requests, which are waiting for a free connection.
+The aiohttp transport of the Azure SDK supports HTTP/1.1 only.
+"""
+from typing import Any, Dict
+
+import logging
+import time
+
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+
+from .latency import LatencyRecorder
+
+logger = logging.getLogger("azureaiapp")
+
+
+class TransportMetrics:
+    """The counters of the shared connection pool, collected from the aiohttp tracing."""
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self.requests = 0
+        self.in_flight = 0
+        self.failed = 0
+        self.queued = 0
+        self.waiting = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+        self._latency = LatencyRecorder()
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """
+        Build the tracing of the session, which updates the counters.
+
+        :return: The trace configuration.
+        """
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params) -> None:
+            self.requests += 1
+            self.in_flight += 1
+
+        async def on_request_end(session, context, params) -> None:
+            self.in_flight -= 1
+
+        async def on_request_exception(session, context, params) -> None:
+            self.in_flight -= 1
+            self.failed += 1
+
+        async def on_connection_queued_start(session, context, params) -> None:
+            self.queued += 1
+            self.waiting += 1
+            context.queued_at = time.perf_counter()
+
+        async def on_connection_queued_end(session, context, params) -> None:
+            self.waiting -= 1
+            self._latency.record('queue', time.perf_counter() - context.queued_at)
+
+        async def on_connection_create_start(session, context, params) -> None:
+            context.connect_at = time.perf_counter()
+
+        async def on_connection_create_end(session, context, params) -> None:
+            self.connections_created += 1
+            self._latency.record('connect', time.perf_counter() - context.connect_at)
+
+        async def on_connection_reuseconn(session, context, params) -> None:
+            self.connections_reused += 1
+
+        async def on_dns_cache_hit(session, context, params) -> None:
+            self.dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session, context, params) -> None:
+            self.dns_cache_misses += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the pool counters.
+
+        :return: The dictionary with the number of requests, the requests in flight, failed and
+                 waiting for the connection, the created and reused connections, the DNS cache hits
+                 and misses and the percentiles of the queue wait and connection time.
+        """
+        return {
+            'requests': self.requests,
+            'in_flight': self.in_flight,
+            'failed': self.failed,
+            'queued': self.queued,
+            'waiting': self.waiting,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'dns_cache_hits': self.dns_cache_hits,
+            'dns_cache_misses': self.dns_cache_misses,
+            'latency': self._latency.stats(),
+        }
+
+
+class SharedTransport:
+    """
+    The aiohttp session with the configured connection pool for the Azure SDK clients.
+
+    The session must be created in the running event loop. The clients get the transports,
+    which do not own the session, so closing the client keeps the pool open until close()
+    is called.
+
+    :param limit: The maximal number of connections, 0 for no limit.
+    :param limit_per_host: The maximal number of connections to the same endpoint, 0 for no limit.
+    :param keepalive_timeout: The number of seconds to keep the idle connection open.
+    :param dns_cache_ttl: The number of seconds to cache the DNS lookups.
+    """
+
+    DEFAULT_LIMIT = 200
+    DEFAULT_LIMIT_PER_HOST = 100
+    DEFAULT_KEEPALIVE_TIMEOUT = 60.0
+    DEFAULT_DNS_CACHE_TTL = 300
+
+    def __init__(
+            self,
+            limit: int = DEFAULT_LIMIT,
+            limit_per_host: int = DEFAULT_LIMIT_PER_HOST,
+            keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT,
+            dns_cache_ttl: int = DEFAULT_DNS_CACHE_TTL
+        ) -> None:
+        """Constructor."""
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self.metrics = TransportMetrics()
+        connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=dns_cache_ttl)
+        # The same session settings as the session, created by AioHttpTransport.
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            trust_env=True,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            auto_decompress=False,
+            trace_configs=[self.metrics.trace_config()])
+
+    def transport(self) -> AioHttpTransport:
+        """
+        Get the transport of the Azure SDK client, using the shared session.
+
+        :return: The transport, which does not close the session.
+        """
+        return AioHttpTransport(session=self.session, session_owner=False)
+
+    async def close(self) -> None:
+        """Close the session and all its connections."""
+        if not self.session.closed:
+            await self.session.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the pool limits and counters.
+
+        :return: The dictionary with the limits and the counters of the pool.
+        """
+        return {
+            'limit': self._limit,
+            'limit_per_host': self._limit_per_host,
+            **self.metrics.stats(),
+        }
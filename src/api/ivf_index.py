@@ -0,0 +1,252 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+The inverted file (IVF) index for the approximate nearest neighbour search by cosine similarity.
+
+The vectors are clustered by the spherical k-means. The query is compared with the
+centroids first, and only the vectors of the ``nprobe`` closest clusters are scanned.
+Increasing ``nprobe`` increases the recall and the latency; ``nprobe == n_lists`` is the
+exact search.
+
+The vectors are stored grouped by cluster in one contiguous matrix, so that every cluster is
+a slice and the saved index can be memory mapped. The inserted vectors are kept in the
+pending buffer, which is scanned by cluster as well, until ``compact`` merges it into the matrix.
+"""
+from typing import List, Optional, Sequence, Tuple
+
+import json
+import math
+import os
+
+import numpy as np
+
+
+_DTYPE = np.float32
+_FILES = ('centroids', 'vectors', 'offsets', 'ids')
+_INFO_FILE = 'index.json'
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale the vectors to the unit length.
+
+    :param vectors: The vector or the matrix with one vector per row.
+    :return: The new contiguous float32 array.
+    """
+    vectors = np.array(vectors, dtype=_DTYPE, order='C')
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    vectors /= norms
+    return vectors
+
+
+class IVFIndex:
+    """
+    The inverted file index over unit vectors.
+
+    :param centroids: The unit centroids of the clusters, one per row.
+    :param nprobe: The number of the closest clusters to scan by default.
+    """
+
+    DEFAULT_NPROBE = 8
+    TRAIN_ITERATIONS = 20
+
+    def __init__(self, centroids: np.ndarray, nprobe: int = DEFAULT_NPROBE) -> None:
+        """Constructor."""
+        self._centroids = _normalize(centroids)
+        self.nprobe = nprobe
+        dimensions = self._centroids.shape[1]
+        self._vectors = np.zeros((0, dimensions), dtype=_DTYPE)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        self._pending_vectors: List[np.ndarray] = []
+        self._pending_ids: List[np.ndarray] = []
+        self._pending_lists: List[np.ndarray] = []
+
+    @property
+    def n_lists(self) -> int:
+        """The number of clusters."""
+        return len(self._centroids)
+
+    @property
+    def dimensions(self) -> int:
+        """The number of dimensions in the vectors."""
+        return self._centroids.shape[1]
+
+    def __len__(self) -> int:
+        return len(self._ids) + sum(len(ids) for ids in self._pending_ids)
+
+    @classmethod
+    def train(
+            cls,
+            vectors: np.ndarray,
+            n_lists: Optional[int] = None,
+            nprobe: int = DEFAULT_NPROBE,
+            iterations: int = TRAIN_ITERATIONS,
+            seed: int = 0
+        ) -> 'IVFIndex':
+        """
+        Cluster the vectors with the spherical k-means and create the empty index.
+
+        :param vectors: The training vectors, one per row.
+        :param n_lists: The number of clusters, by default the square root of the number of vectors.
+        :param nprobe: The number of the closest clusters to scan by default.
+        :param iterations: The number of k-means iterations.
+        :param seed: The seed of the random initialization.
+        :return: The index without vectors.
+        :raises: ValueError if there are fewer vectors than clusters.
+        """
+        vectors = _normalize(vectors)
+        n_lists = n_lists or max(1, int(math.sqrt(len(vectors))))
+        if len(vectors) < n_lists:
+            raise ValueError(f"At least {n_lists} vectors are required to train {n_lists} clusters.")
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            empty = ~sums.any(axis=1)
+            # The empty clusters are restarted from random vectors.
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+            centroids = _normalize(sums)
+        return cls(centroids, nprobe=nprobe)
+
+    @classmethod
+    def build(
+            cls,
+            vectors: np.ndarray,
+            n_lists: Optional[int] = None,
+            nprobe: int = DEFAULT_NPROBE,
+            seed: int = 0
+        ) -> 'IVFIndex':
+        """
+        Train the index on the vectors and add them with the row numbers as identifiers.
+
+        :param vectors: The vectors to index, one per row.
+        :param n_lists: The number of clusters, by default the square root of the number of vectors.
+        :param nprobe: The number of the closest clusters to scan by default.
+        :param seed: The seed of the random initialization.
+        :return: The compacted index.
+        """
+        index = cls.train(vectors, n_lists=n_lists, nprobe=nprobe, seed=seed)
+        index.add(vectors)
+        index.compact()
+        return index
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Find the closest cluster of every vector.
+
+        :param vectors: The unit vectors, one per row.
+        :return: The cluster numbers.
+        """
+        return np.argmax(vectors @ self._centroids.T, axis=1)
+
+    def add(self, vectors: np.ndarray, ids: Optional[Sequence[int]] = None) -> None:
+        """
+        Insert the vectors into the pending buffer, they are searchable immediately.
+
+        :param vectors: The vectors to add, one per row.
+        :param ids: The identifiers of the vectors, by default the consecutive numbers after the last one.
+        :raises: ValueError if the number of identifiers or dimensions does not match.
+        """
+        vectors = _normalize(np.atleast_2d(vectors))
+        if vectors.shape[1] != self.dimensions:
+            raise ValueError(f"The vectors have {vectors.shape[1]} dimensions, while {self.dimensions} were expected.")
+        if ids is None:
+            start = len(self)
+            ids = np.arange(start, start + len(vectors), dtype=np.int64)
+        else:
+            ids = np.asarray(ids, dtype=np.int64)
+            if len(ids) != len(vectors):
+                raise ValueError("The number of ids must be equal to the number of vectors.")
+        self._pending_vectors.append(vectors)
+        self._pending_ids.append(ids)
+        self._pending_lists.append(self._assign(vectors))
+
+    def compact(self) -> None:
+        """Merge the pending buffer into the clustered matrix."""
+        if not self._pending_ids:
+            return
+        lists = np.concatenate(
+            [np.repeat(np.arange(self.n_lists), np.diff(self._offsets))] + self._pending_lists)
+        vectors = np.concatenate([self._vectors] + self._pending_vectors)
+        ids = np.concatenate([self._ids] + self._pending_ids)
+        order = np.argsort(lists, kind='stable')
+        self._vectors = np.ascontiguousarray(vectors[order])
+        self._ids = ids[order]
+        self._offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=self.n_lists), out=self._offsets[1:])
+        self._pending_vectors.clear()
+        self._pending_ids.clear()
+        self._pending_lists.clear()
+
+    def search(self, query: Sequence[float], k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the approximate k nearest neighbours of the query by cosine similarity.
+
+        :param query: The query vector.
+        :param k: The number of neighbours to return.
+        :param nprobe: The number of the closest clusters to scan, by default the index setting.
+        :return: The tuple of the identifiers and the similarities, ordered by similarity.
+        """
+        query = _normalize(query)
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        centroid_scores = self._centroids @ query
+        if nprobe < self.n_lists:
+            probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        else:
+            probes = np.arange(self.n_lists)
+        candidates = [np.arange(self._offsets[probe], self._offsets[probe + 1]) for probe in probes]
+        rows = np.concatenate(candidates) if candidates else np.zeros(0, dtype=np.int64)
+        scores = self._vectors[rows] @ query
+        ids = self._ids[rows]
+        for vectors, pending_ids, lists in zip(self._pending_vectors, self._pending_ids, self._pending_lists):
+            mask = np.isin(lists, probes)
+            scores = np.concatenate([scores, vectors[mask] @ query])
+            ids = np.concatenate([ids, pending_ids[mask]])
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=_DTYPE)
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return ids[top], scores[top]
+
+    def save(self, directory: str) -> None:
+        """
+        Compact the index and save it to the directory as the numpy files.
+
+        :param directory: The directory to save the index to, it is created if needed.
+        """
+        self.compact()
+        os.makedirs(directory, exist_ok=True)
+        arrays = dict(zip(_FILES, (self._centroids, self._vectors, self._offsets, self._ids)))
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f'{name}.npy'), array)
+        with open(os.path.join(directory, _INFO_FILE), 'w', encoding='utf-8') as fp:
+            json.dump({'nprobe': self.nprobe, 'n_lists': self.n_lists, 'dimensions': self.dimensions}, fp)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> 'IVFIndex':
+        """
+        Load the index, saved by save.
+
+        :param directory: The directory with the index.
+        :param mmap: If True, the vectors are memory mapped instead of being read into memory.
+        :return: The loaded index. New vectors can be added to it, compact copies the vectors into memory.
+        """
+        with open(os.path.join(directory, _INFO_FILE), encoding='utf-8') as fp:
+            info = json.load(fp)
+        mmap_mode = 'r' if mmap else None
+        arrays = {
+            name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+            for name in _FILES}
+        index = cls(np.asarray(arrays['centroids']), nprobe=info['nprobe'])
+        index._vectors = arrays['vectors']
+        index._ids = np.asarray(arrays['ids'])
+        index._offsets = np.asarray(arrays['offsets'])
+        return index
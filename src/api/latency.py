@@ -0,0 +1,72 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from typing import Dict, Optional
+
+import collections
+import math
+
+
+class LatencyRecorder:
+    """
+    The recorder of the latencies of the recent requests by metric name.
+
+    Only the last samples of every metric are kept, so the percentiles describe the recent load.
+
+    :param window: The number of the last samples to keep per metric.
+    """
+
+    DEFAULT_WINDOW = 1000
+
+    def __init__(self, window: int = DEFAULT_WINDOW) -> None:
+        """Constructor."""
+        self._window = window
+        self._samples: Dict[str, collections.deque] = {}
+        self._counts: Dict[str, int] = collections.Counter()
+
+    def record(self, name: str, seconds: float) -> None:
+        """
+        Record the latency sample.
+
+        :param name: The metric name, for example 'ttft'.
+        :param seconds: The latency in seconds.
+        """
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples[name] = collections.deque(maxlen=self._window)
+        samples.append(seconds)
+        self._counts[name] += 1
+
+    @staticmethod
+    def _percentile(ordered: list, percent: float) -> float:
+        """
+        Get the percentile of the ordered samples by the nearest rank.
+
+        :param ordered: The samples in the ascending order.
+        :param percent: The percentile from 0 to 100.
+        :return: The sample at the percentile.
+        """
+        rank = min(len(ordered) - 1, max(0, math.ceil(percent / 100 * len(ordered)) - 1))
+        return ordered[rank]
+
+    def stats(self, name: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        """
+        Get the latency statistics in milliseconds.
+
+        :param name: The metric to report, by default all metrics are reported.
+        :return: The dictionary with the total count, the mean, p50, p95 and p99 of the recent samples by metric.
+        """
+        names = [name] if name is not None else list(self._samples)
+        result = {}
+        for metric in names:
+            ordered = sorted(self._samples.get(metric, ()))
+            if not ordered:
+                result[metric] = {'count': self._counts[metric]}
+                continue
+            result[metric] = {
+                'count': self._counts[metric],
+                'mean_ms': 1000 * sum(ordered) / len(ordered),
+                'p50_ms': 1000 * self._percentile(ordered, 50),
+                'p95_ms': 1000 * self._percentile(ordered, 95),
+                'p99_ms': 1000 * self._percentile(ordered, 99),
+            }
+        return result
@@ -0,0 +1,257 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+
+import collections
+import math
+import re
+
+import numpy as np
+
+from api.embeddings_store import load_embeddings
+from api.ivf_index import IVFIndex
+
+
+class SearchBackend(ABC):
+    """
+    The search engine, which SearchIndexManager uses instead of Azure AI Search.
+
+    The results are the dictionaries with the 'token' and 'title' keys, ordered by relevance.
+    """
+
+    @abstractmethod
+    async def vector_search(self, message: str, k: int) -> List[Dict[str, Any]]:
+        """
+        Find the documents, which embeddings are the closest to the message embedding.
+
+        :param message: The customer question.
+        :param k: The number of documents to return.
+        :return: The found documents.
+        """
+
+    @abstractmethod
+    async def keyword_search(self, message: str, k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Find the documents by the words of the message.
+
+        :param message: The customer question.
+        :param k: The number of documents to return, by default the backend decides.
+        :return: The found documents.
+        """
+
+    async def close(self) -> None:
+        """Close the resources, associated with the backend."""
+
+
+class LocalSearchBackend(SearchBackend):
+    """
+    The in-process search over the embeddings file.
+
+    The embeddings matrix is used as it is loaded, so the memory mapped binary file is not
+    copied into memory. The vector search is one matrix-vector product, scaled by the inverse
+    norms of the rows, followed by the partial sort. The keyword search uses the BM25 ranking
+    over the document texts and titles.
+
+    :param embeddings_file: The embeddings file, CSV or binary (see embeddings_store).
+    :param embedding_client: The embedding client, used to embed the questions. It must
+                             use the same model as the one used to build the embeddings file.
+    :param model: The embedding model.
+    :param dimensions: The number of dimensions in the embedding, if the model accepts it.
+    :param ann_index: The approximate nearest neighbour index over the rows of the embeddings file.
+                      If it is provided, the vector search scans only its closest clusters
+                      instead of the whole matrix.
+    """
+
+    DEFAULT_TOP = 50
+    # The number of rows, which norms are computed at once.
+    NORM_CHUNK_ROWS = 65536
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    _WORD = re.compile(r'\w+')
+
+    def __init__(
+            self,
+            embeddings_file: str,
+            embedding_client: Optional[Any] = None,
+            model: Optional[str] = None,
+            dimensions: Optional[int] = None,
+            ann_index: Optional[IVFIndex] = None,
+        ) -> None:
+        """Constructor."""
+        self._vectors, self._documents = load_embeddings(embeddings_file)
+        self._inverse_norms: Optional[np.ndarray] = None
+        if ann_index is not None and len(ann_index) != len(self._documents):
+            raise ValueError(
+                f"The ANN index has {len(ann_index)} vectors, while the embeddings file has {len(self._documents)}.")
+        self._ann_index = ann_index
+        self._embedding_client = embedding_client
+        self._model = model
+        self._dimensions = dimensions
+        self._build_keyword_index()
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        """
+        Scale the query vector to the unit length.
+
+        :param vectors: The vector or the small matrix with one vector per row.
+        :return: The new contiguous float32 array.
+        """
+        vectors = np.array(vectors, dtype=np.float32, order='C')
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors /= norms
+        return vectors
+
+    def _get_inverse_norms(self) -> np.ndarray:
+        """
+        Get the inverse norms of the embeddings, so that the scaled dot product is the cosine similarity.
+
+        The norms are computed once, a chunk of rows at a time, so the memory mapped matrix is not copied.
+
+        :return: The inverse norms, one per row, 1 for the zero rows.
+        """
+        if self._inverse_norms is None:
+            inverse_norms = np.empty(len(self._vectors), dtype=np.float32)
+            for start in range(0, len(self._vectors), LocalSearchBackend.NORM_CHUNK_ROWS):
+                end = start + LocalSearchBackend.NORM_CHUNK_ROWS
+                norms = np.linalg.norm(self._vectors[start:end], axis=1)
+                norms[norms == 0] = 1
+                inverse_norms[start:end] = 1 / norms
+            self._inverse_norms = inverse_norms
+        return self._inverse_norms
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Get the indices of the k largest scores in the descending order.
+
+        :param scores: The scores of the documents.
+        :param k: The number of indices to return.
+        :return: The indices of the best documents.
+        """
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(scores))
+        return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+    def build_ann_index(self, n_lists: Optional[int] = None, nprobe: int = IVFIndex.DEFAULT_NPROBE) -> IVFIndex:
+        """
+        Build the approximate nearest neighbour index over the loaded embeddings and use it for the vector search.
+
+        :param n_lists: The number of clusters, by default the square root of the number of rows.
+        :param nprobe: The number of the closest clusters to scan.
+        :return: The index, which may be saved and passed to the constructor later.
+        """
+        self._ann_index = IVFIndex.build(self._vectors, n_lists=n_lists, nprobe=nprobe)
+        return self._ann_index
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def search_vector(self, vector: Any, k: int) -> List[int]:
+        """
+        Find the rows with the highest cosine similarity to the vector.
+
+        :param vector: The query embedding.
+        :param k: The number of rows to return.
+        :return: The row numbers ordered by similarity.
+        """
+        if self._ann_index is not None:
+            return self._ann_index.search(vector, k)[0].tolist()
+        if not len(self._vectors):
+            return []
+        query = LocalSearchBackend._normalize(np.asarray(vector, dtype=np.float32))
+        scores = (self._vectors @ query) * self._get_inverse_norms()
+        return LocalSearchBackend._top_k(scores, k).tolist()
+
+    def _tokenize(self, text: str) -> List[str]:
+        """
+        Split the text into lower case words.
+
+        :param text: The text to split.
+        :return: The list of words.
+        """
+        return LocalSearchBackend._WORD.findall(text.casefold())
+
+    def _build_keyword_index(self) -> None:
+        """Build the inverted index with the term frequencies for BM25."""
+        postings = collections.defaultdict(lambda: ([], []))
+        lengths = np.zeros(len(self._documents), dtype=np.float32)
+        for row, document in enumerate(self._documents):
+            words = self._tokenize(f"{document['title']} {document['token']}")
+            lengths[row] = len(words)
+            for word, count in collections.Counter(words).items():
+                rows, counts = postings[word]
+                rows.append(row)
+                counts.append(count)
+        self._postings = {
+            word: (np.array(rows, dtype=np.int64), np.array(counts, dtype=np.float32))
+            for word, (rows, counts) in postings.items()}
+        average_length = float(lengths.mean()) if len(lengths) else 0.0
+        self._length_norm = (
+            LocalSearchBackend.BM25_K1 * (
+                1 - LocalSearchBackend.BM25_B + LocalSearchBackend.BM25_B * lengths / (average_length or 1)))
+
+    def search_keywords(self, text: str, k: int) -> List[int]:
+        """
+        Find the rows with the highest BM25 score for the words of the text.
+
+        :param text: The query text.
+        :param k: The number of rows to return.
+        :return: The row numbers ordered by the score, the rows without any query word are omitted.
+        """
+        scores = np.zeros(len(self._documents), dtype=np.float32)
+        n_documents = len(self._documents)
+        for word in set(self._tokenize(text)):
+            if word not in self._postings:
+                continue
+            rows, counts = self._postings[word]
+            idf = math.log(1 + (n_documents - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * counts * (LocalSearchBackend.BM25_K1 + 1) / (counts + self._length_norm[rows])
+        return [row for row in LocalSearchBackend._top_k(scores, k).tolist() if scores[row] > 0]
+
+    async def _embed(self, message: str) -> List[float]:
+        """
+        Build the embedding of the message.
+
+        :param message: The text to embed.
+        :return: The embedding.
+        :raises: ValueError if the embedding client was not provided.
+        """
+        if self._embedding_client is None:
+            raise ValueError("The embedding client is required for the vector search.")
+        response = await self._embedding_client.embed(
+            input=[message],
+            dimensions=self._dimensions,
+            model=self._model
+        )
+        return response["data"][0]['embedding']
+
+    async def vector_search(self, message: str, k: int) -> List[Dict[str, Any]]:
+        """
+        Find the documents, which embeddings are the closest to the message embedding.
+
+        :param message: The customer question.
+        :param k: The number of documents to return.
+        :return: The found documents.
+        """
+        return [self._documents[row] for row in self.search_vector(await self._embed(message), k)]
+
+    async def keyword_search(self, message: str, k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Find the documents by the words of the message using BM25.
+
+        :param message: The customer question.
+        :param k: The number of documents to return, DEFAULT_TOP by default.
+        :return: The found documents.
+        """
+        return [
+            self._documents[row]
+            for row in self.search_keywords(message, k or LocalSearchBackend.DEFAULT_TOP)]
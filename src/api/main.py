@@ -1,7 +1,9 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
 
+import asyncio
 import contextlib
+import functools
 import os
 
 from azure.ai.projects.aio import AIProjectClient
@@ -15,30 +17,64 @@ from dotenv import load_dotenv
 
 from logging_config import configure_logging
 
+from .admission import AdmissionController
+from .agent_state import AgentStateFile, resolve_agent
+from .bootstrap import WorkerBootstrap, get_startup_delay
+from .evaluation_dispatcher import EvaluationDispatcher
+from .file_name_cache import FileNameCache
+from .history_cache import ThreadHistoryCache
+from .http_transport import SharedTransport
+from .latency import LatencyRecorder
+from .run_stream import StreamRegistry
+from .stream_journal import StreamJournal
+from .thread_pool import WarmThreadPool
+from .thread_registry import ThreadRegistry
+
 enable_trace = False
 logger = None
 
 @contextlib.asynccontextmanager
 async def lifespan(app: fastapi.FastAPI):
     agent = None
+    warm_task = None
+    thread_pool = None
+    evaluation_dispatcher = None
+    http_transport = None
 
     proj_endpoint = os.environ.get("AZURE_EXISTING_AIPROJECT_ENDPOINT")
     agent_id = os.environ.get("AZURE_EXISTING_AGENT_ID")
     try:
+        # The project and agents clients share one connection pool.
+        http_transport = SharedTransport(
+            limit=int(os.environ.get("HTTP_POOL_SIZE", SharedTransport.DEFAULT_LIMIT)),
+            limit_per_host=int(os.environ.get("HTTP_POOL_SIZE_PER_HOST", SharedTransport.DEFAULT_LIMIT_PER_HOST)),
+            keepalive_timeout=float(
+                os.environ.get("HTTP_KEEPALIVE_TIMEOUT", SharedTransport.DEFAULT_KEEPALIVE_TIMEOUT)),
+            dns_cache_ttl=int(os.environ.get("HTTP_DNS_CACHE_TTL", SharedTransport.DEFAULT_DNS_CACHE_TTL)))
+        app.state.http_transport = http_transport
         ai_project = AIProjectClient(
             credential=DefaultAzureCredential(exclude_shared_token_cache_credential=True),
             endpoint=proj_endpoint,
-            api_version = "2025-05-15-preview" # Evaluations yet not supported on stable (api_version="2025-05-01")
+            api_version = "2025-05-15-preview", # Evaluations yet not supported on stable (api_version="2025-05-01")
+            transport=http_transport.transport()
         )
         logger.info("Created AIProjectClient")
 
+        # The master process has resolved the agent and the telemetry configuration for all workers.
+        bootstrap = WorkerBootstrap.load(
+            proj_endpoint, agent_id,
+            max_age=float(os.environ.get("BOOTSTRAP_MAX_AGE", WorkerBootstrap.DEFAULT_MAX_AGE)))
+
         if enable_trace:
             application_insights_connection_string = ""
-            try:
-                application_insights_connection_string = await ai_project.telemetry.get_connection_string()
-            except Exception as e:
-                e_string = str(e)
-                logger.error("Failed to get Application Insights connection string, error: %s", e_string)
+            if bootstrap is not None and bootstrap.telemetry_connection_string:
+                application_insights_connection_string = bootstrap.telemetry_connection_string
+            else:
+                try:
+                    application_insights_connection_string = await ai_project.telemetry.get_connection_string()
+                except Exception as e:
+                    e_string = str(e)
+                    logger.error("Failed to get Application Insights connection string, error: %s", e_string)
             if not application_insights_connection_string:
                 logger.error("Application Insights was not enabled for this project.")
                 logger.error("Enable it via the 'Tracing' tab in your AI Foundry project page.")
@@ -49,32 +85,70 @@ async def lifespan(app: fastapi.FastAPI):
                 app.state.application_insights_connection_string = application_insights_connection_string
                 logger.info("Configured Application Insights for tracing.")
 
-        if agent_id:
-            try: 
-                agent = await ai_project.agents.get_agent(agent_id)
-                logger.info("Agent already exists, skipping creation")
-                logger.info(f"Fetched agent, agent ID: {agent.id}")
-                logger.info(f"Fetched agent, model name: {agent.model}")
-            except Exception as e:
-                logger.error(f"Error fetching agent: {e}", exc_info=True)
-
-        if not agent:
-            # Fallback to searching by name
-            agent_name = os.environ["AZURE_AI_AGENT_NAME"]
-            agent_list = ai_project.agents.list_agents()
-            if agent_list:
-                async for agent_object in agent_list:
-                    if agent_object.name == agent_name:
-                        agent = agent_object
-                        logger.info(f"Found agent by name '{agent_name}', ID={agent_object.id}")
-                        break
+        if bootstrap is not None:
+            agent = bootstrap.agent
+            logger.info("Using the agent, resolved by the master process")
+        else:
+            # Without the bootstrap state the agent ID from the master still needs one get_agent call.
+            agent = await resolve_agent(
+                ai_project.agents, proj_endpoint, agent_id, os.environ.get("AZURE_AI_AGENT_NAME"),
+                AgentStateFile(os.environ.get("AGENT_STATE_PATH", AgentStateFile.DEFAULT_PATH)))
+        if agent:
+            logger.info(f"Fetched agent, agent ID: {agent.id}")
+            logger.info(f"Fetched agent, model name: {agent.model}")
 
         if not agent:
             raise RuntimeError("No agent found. Ensure qunicorn.py created one or set AZURE_EXISTING_AGENT_ID.")
 
         app.state.ai_project = ai_project
         app.state.agent = agent
-        
+
+        file_name_cache = FileNameCache(
+            maxsize=int(os.environ.get("FILE_NAME_CACHE_SIZE", FileNameCache.DEFAULT_SIZE)),
+            ttl=float(os.environ.get("FILE_NAME_CACHE_TTL", FileNameCache.DEFAULT_TTL)))
+        app.state.file_name_cache = file_name_cache
+        app.state.history_cache = ThreadHistoryCache(
+            maxsize=int(os.environ.get("HISTORY_CACHE_SIZE", ThreadHistoryCache.DEFAULT_SIZE)),
+            ttl=float(os.environ.get("HISTORY_CACHE_TTL", ThreadHistoryCache.DEFAULT_TTL)))
+        # The workers on the same host share the registry through the file, the empty path disables sharing.
+        app.state.thread_registry = ThreadRegistry(
+            path=os.environ.get("THREAD_REGISTRY_PATH", ThreadRegistry.DEFAULT_PATH) or None,
+            ttl=float(os.environ.get("THREAD_REGISTRY_TTL", ThreadRegistry.DEFAULT_TTL)))
+        thread_pool = WarmThreadPool(
+            ai_project.agents, size=int(os.environ.get("THREAD_POOL_SIZE", WarmThreadPool.DEFAULT_SIZE)))
+        app.state.thread_pool = thread_pool
+        app.state.chat_metrics = LatencyRecorder()
+        # The client may resume the stream of any worker on the host through the journal file,
+        # the empty path keeps the streams in the worker, which has started them.
+        stream_journal_path = os.environ.get("SSE_JOURNAL_PATH", StreamJournal.DEFAULT_PATH)
+        app.state.stream_registry = StreamRegistry(
+            buffer_size=int(os.environ.get("SSE_REPLAY_SIZE", StreamRegistry.DEFAULT_BUFFER_SIZE)),
+            max_ahead=int(os.environ.get("SSE_QUEUE_SIZE", StreamRegistry.DEFAULT_MAX_AHEAD)),
+            grace=float(os.environ.get("SSE_RESUME_GRACE", StreamRegistry.DEFAULT_GRACE)),
+            journal=StreamJournal(stream_journal_path) if stream_journal_path else None)
+        # The runs of all workers on the host are limited only if ADMISSION_HOST_MAX_ACTIVE is set.
+        app.state.admission = AdmissionController(
+            max_active=int(os.environ.get("ADMISSION_MAX_ACTIVE", AdmissionController.DEFAULT_MAX_ACTIVE)),
+            max_waiting=int(os.environ.get("ADMISSION_MAX_WAITING", AdmissionController.DEFAULT_MAX_WAITING)),
+            wait_timeout=float(os.environ.get("ADMISSION_WAIT_TIMEOUT", AdmissionController.DEFAULT_WAIT_TIMEOUT)),
+            host_max_active=int(os.environ.get("ADMISSION_HOST_MAX_ACTIVE", "0")),
+            host_directory=os.environ.get("ADMISSION_HOST_DIRECTORY", AdmissionController.DEFAULT_HOST_DIRECTORY))
+        # The completed runs are evaluated only if Application Insights is configured.
+        if getattr(app.state, "application_insights_connection_string", None):
+            from .routes import run_agent_evaluation
+            evaluation_dispatcher = EvaluationDispatcher(
+                functools.partial(run_agent_evaluation, ai_project, app.state.application_insights_connection_string),
+                concurrency=int(os.environ.get("EVALUATION_CONCURRENCY", EvaluationDispatcher.DEFAULT_CONCURRENCY)),
+                queue_size=int(os.environ.get("EVALUATION_QUEUE_SIZE", EvaluationDispatcher.DEFAULT_QUEUE_SIZE)),
+                sampling_percent=float(
+                    os.environ.get("EVALUATION_SAMPLING_PERCENT", EvaluationDispatcher.DEFAULT_SAMPLING_PERCENT)))
+            evaluation_dispatcher.start()
+        app.state.evaluation_dispatcher = evaluation_dispatcher
+        # The workers, started together, acquire the tokens and warm up at different times.
+        startup_delay = get_startup_delay(
+            float(os.environ.get("STARTUP_JITTER", WorkerBootstrap.DEFAULT_STARTUP_JITTER)))
+        warm_task = asyncio.create_task(warm_worker(startup_delay, thread_pool, file_name_cache, ai_project, agent))
+
         yield
 
     except Exception as e:
@@ -82,11 +156,40 @@ async def lifespan(app: fastapi.FastAPI):
         raise RuntimeError(f"Error during startup: {e}")
 
     finally:
+        if warm_task is not None:
+            warm_task.cancel()
+        if thread_pool is not None:
+            await thread_pool.close()
+        if evaluation_dispatcher is not None:
+            await evaluation_dispatcher.close()
         try:
             await ai_project.close()
             logger.info("Closed AIProjectClient")
         except Exception as e:
             logger.error("Error closing AIProjectClient", exc_info=True)
+        if http_transport is not None:
+            await http_transport.close()
+
+
+async def warm_worker(
+        delay: float, thread_pool: WarmThreadPool, file_name_cache: FileNameCache, ai_project: AIProjectClient, agent
+    ) -> None:
+    """Start filling the thread pool and warm the file name cache after the start-up delay."""
+    await asyncio.sleep(delay)
+    thread_pool.start()
+    await warm_file_name_cache(file_name_cache, ai_project, agent)
+
+
+async def warm_file_name_cache(file_name_cache: FileNameCache, ai_project: AIProjectClient, agent) -> None:
+    """Cache the names of the files in the agent vector stores, so that the first citations are resolved locally."""
+    try:
+        vector_store_ids = []
+        if agent.tool_resources and agent.tool_resources.file_search:
+            vector_store_ids = agent.tool_resources.file_search.vector_store_ids or []
+        count = await file_name_cache.warm(ai_project.agents, vector_store_ids)
+        logger.info(f"Cached {count} file names")
+    except Exception as e:
+        logger.warning(f"Failed to warm the file name cache: {e}")
 
 
 def create_app():
@@ -1,13 +1,13 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
 
-import asyncio
 import json
 import os
-from typing import AsyncGenerator, Optional, Dict
+import time
+from typing import AsyncGenerator, Awaitable, Callable, Optional, Dict, List, Tuple
 
 import fastapi
-from fastapi import Request, Depends, HTTPException
+from fastapi import Request, Depends, HTTPException, Query
 from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import JSONResponse
@@ -16,22 +16,37 @@ import logging
 from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
 
 from azure.ai.agents.aio import AgentsClient
+from azure.core.exceptions import ResourceNotFoundError
 from azure.ai.agents.models import (
     Agent,
+    AgentThread,
     MessageDeltaChunk,
     ThreadMessage,
     ThreadRun,
     AsyncAgentEventHandler,
-    RunStep
+    RunStep,
+    ThreadMessageOptions,
+    MessageRole
 )
 from azure.ai.projects import AIProjectClient
 from azure.ai.projects.models import (
+   AgentEvaluation,
    AgentEvaluationRequest,
    AgentEvaluationSamplingConfiguration,
    AgentEvaluationRedactionConfiguration,
    EvaluatorIds
 )
 
+from .admission import AdmissionController, AdmissionRejected
+from .evaluation_dispatcher import EvaluationDispatcher
+from .file_name_cache import FileNameCache
+from .history_cache import ThreadHistoryCache
+from .latency import LatencyRecorder
+from .run_stream import ResumableStream, StreamMetrics, StreamRegistry, parse_event_id
+from .sse import DeltaCoalescer, encode_comment, encode_event, flush_when_idle
+from .thread_pool import WarmThreadPool
+from .thread_registry import ThreadRegistry
+
 
 # Create a logger for this module
 logger = logging.getLogger("azureaiapp")
@@ -49,6 +64,12 @@ templates = Jinja2Templates(directory=directory)
 # Create a new FastAPI router
 router = fastapi.APIRouter()
 
+# The maximal number of messages the service lists in one request. The page of the chat history
+# has one message less, since one extra message is requested to know if there are more.
+HISTORY_PAGE_LIMIT = 100
+# The maximal number of new messages fetched to refresh the cached thread.
+HISTORY_REFRESH_LIMIT = 100
+
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from typing import Optional
@@ -100,24 +121,55 @@ def get_agent_client(request: Request) -> AgentsClient:
 def get_agent(request: Request) -> Agent:
     return request.app.state.agent
 
-def get_app_insights_conn_str(request: Request) -> str:
-    if hasattr(request.app.state, "application_insights_connection_string"):
-        return request.app.state.application_insights_connection_string
-    else:
-        return None
+def get_file_name_cache(request: Request) -> FileNameCache:
+    return request.app.state.file_name_cache
+
+def get_history_cache(request: Request) -> ThreadHistoryCache:
+    return request.app.state.history_cache
+
+def get_thread_registry(request: Request) -> ThreadRegistry:
+    return request.app.state.thread_registry
+
+def get_thread_pool(request: Request) -> WarmThreadPool:
+    return request.app.state.thread_pool
+
+def get_chat_metrics(request: Request) -> LatencyRecorder:
+    return request.app.state.chat_metrics
+
+def get_stream_registry(request: Request) -> StreamRegistry:
+    return request.app.state.stream_registry
+
+def get_admission_controller(request: Request) -> AdmissionController:
+    return request.app.state.admission
+
+def get_evaluation_dispatcher(request: Request) -> Optional[EvaluationDispatcher]:
+    return getattr(request.app.state, "evaluation_dispatcher", None)
 
-def serialize_sse_event(data: Dict) -> str:
-    return f"data: {json.dumps(data)}\n\n"
+# The SSE comment sent first, so that the headers reach the client before the run starts.
+SSE_STREAM_START = encode_comment("stream-start")
 
-async def get_message_and_annotations(agent_client : AgentsClient, message: ThreadMessage) -> Dict:
+# The message deltas are joined into one event for up to this number of milliseconds
+# or characters, 0 sends every delta at once.
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "0"))
+SSE_COALESCE_CHARS = int(os.getenv("SSE_COALESCE_CHARS", "0"))
+# The number of seconds between the checks if the client is still connected.
+SSE_DISCONNECT_POLL = float(os.getenv("SSE_DISCONNECT_POLL", "1"))
+# The run statuses, after which the run cannot be cancelled.
+RUN_FINAL_STATUSES = ("completed", "failed", "cancelled", "expired")
+
+async def get_message_and_annotations(
+    agent_client : AgentsClient,
+    message: ThreadMessage,
+    file_name_cache: FileNameCache
+) -> Dict:
     annotations = []
-    # Get file annotations for the file search.
-    for annotation in (a.as_dict() for a in message.file_citation_annotations):
-        file_id = annotation["file_citation"]["file_id"]
-        logger.info(f"Fetching file with ID for annotation {file_id}")
-        openai_file = await agent_client.files.get(file_id)
-        annotation["file_name"] = openai_file.filename
-        logger.info(f"File name for annotation: {annotation['file_name']}")
+    # Get file annotations for the file search, the names of all cited files are resolved at once.
+    file_annotations = [a.as_dict() for a in message.file_citation_annotations]
+    file_names = await file_name_cache.get_many(
+        agent_client, (annotation["file_citation"]["file_id"] for annotation in file_annotations))
+    for annotation in file_annotations:
+        annotation["file_name"] = file_names[annotation["file_citation"]["file_id"]]
+        logger.debug(f"File name for annotation: {annotation['file_name']}")
         annotations.append(annotation)
 
     # Get url annotation for the index search.
@@ -132,54 +184,81 @@ async def get_message_and_annotations(agent_client : AgentsClient, message: Thre
         'annotations': annotations
     }
 
-class MyEventHandler(AsyncAgentEventHandler[str]):
-    def __init__(self, ai_project: AIProjectClient, app_insights_conn_str: str):
+class MyEventHandler(AsyncAgentEventHandler[bytes]):
+    def __init__(
+        self,
+        ai_project: AIProjectClient,
+        evaluation_dispatcher: Optional[EvaluationDispatcher],
+        file_name_cache: FileNameCache,
+        stream_metrics: Optional[StreamMetrics] = None
+    ):
         super().__init__()
         self.agent_client = ai_project.agents
         self.ai_project = ai_project
-        self.app_insights_conn_str = app_insights_conn_str
-
-    async def on_message_delta(self, delta: MessageDeltaChunk) -> Optional[str]:
-        stream_data = {'content': delta.text, 'type': "message"}
-        return serialize_sse_event(stream_data)
-
-    async def on_thread_message(self, message: ThreadMessage) -> Optional[str]:
+        self.evaluation_dispatcher = evaluation_dispatcher
+        self.file_name_cache = file_name_cache
+        self.coalescer = DeltaCoalescer(SSE_COALESCE_MS / 1000, SSE_COALESCE_CHARS)
+        # The time of the first token, used to measure the time to first token.
+        self.first_token_at: Optional[float] = None
+        self.stream_metrics = stream_metrics
+        # The last state of the run, used to cancel it if the client disconnects.
+        self.run: Optional[ThreadRun] = None
+
+    def with_pending_deltas(self, event: Optional[bytes]) -> Optional[bytes]:
+        """Send the buffered deltas before the event of the other type."""
+        pending = self.coalescer.flush()
+        if pending is None:
+            return event
+        return pending + event if event else pending
+
+    async def on_message_delta(self, delta: MessageDeltaChunk) -> Optional[bytes]:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return self.coalescer.add(delta.text)
+
+    async def on_thread_message(self, message: ThreadMessage) -> Optional[bytes]:
         try:
             logger.info(f"MyEventHandler: Received thread message, message ID: {message.id}, status: {message.status}")
             if message.status != "completed":
-                return None
+                return self.with_pending_deltas(None)
 
             logger.info("MyEventHandler: Received completed message")
 
-            stream_data = await get_message_and_annotations(self.agent_client, message)
+            stream_data = await get_message_and_annotations(self.agent_client, message, self.file_name_cache)
             stream_data['type'] = "completed_message"
-            return serialize_sse_event(stream_data)
+            return self.with_pending_deltas(encode_event(stream_data))
         except Exception as e:
             logger.error(f"Error in event handler for thread message: {e}", exc_info=True)
-            return None
+            return self.with_pending_deltas(None)
 
-    async def on_thread_run(self, run: ThreadRun) -> Optional[str]:
+    async def on_thread_run(self, run: ThreadRun) -> Optional[bytes]:
         logger.info("MyEventHandler: on_thread_run event received")
+        self.run = run
         run_information = f"ThreadRun status: {run.status}, thread ID: {run.thread_id}"
         stream_data = {'content': run_information, 'type': 'thread_run'}
         if run.status == "failed":
             stream_data['error'] = run.last_error.as_dict()
         # automatically run agent evaluation when the run is completed
         if run.status == "completed":
-            run_agent_evaluation(run.thread_id, run.id, self.ai_project, self.app_insights_conn_str)
-        return serialize_sse_event(stream_data)
-
-    async def on_error(self, data: str) -> Optional[str]:
+            if self.stream_metrics is not None:
+                self.stream_metrics.completed += 1
+                if run.usage:
+                    self.stream_metrics.record_usage(run.usage.completion_tokens)
+            if self.evaluation_dispatcher is not None:
+                self.evaluation_dispatcher.enqueue(run.thread_id, run.id)
+        return self.with_pending_deltas(encode_event(stream_data))
+
+    async def on_error(self, data: str) -> Optional[bytes]:
         logger.error(f"MyEventHandler: on_error event received: {data}")
         stream_data = {'type': "stream_end"}
-        return serialize_sse_event(stream_data)
+        return self.with_pending_deltas(encode_event(stream_data))
 
-    async def on_done(self) -> Optional[str]:
+    async def on_done(self) -> Optional[bytes]:
         logger.info("MyEventHandler: on_done event received")
         stream_data = {'type': "stream_end"}
-        return serialize_sse_event(stream_data)
+        return self.with_pending_deltas(encode_event(stream_data))
 
-    async def on_run_step(self, step: RunStep) -> Optional[str]:
+    async def on_run_step(self, step: RunStep) -> Optional[bytes]:
         logger.info(f"Step {step['id']} status: {step['status']}")
         step_details = step.get("step_details", {})
         tool_calls = step_details.get("tool_calls", [])
@@ -191,7 +270,7 @@ class MyEventHandler(AsyncAgentEventHandler[str]):
                 if azure_ai_search_details:
                     logger.info(f"azure_ai_search input: {azure_ai_search_details.get('input')}")
                     logger.info(f"azure_ai_search output: {azure_ai_search_details.get('output')}")
-        return None
+        return self.with_pending_deltas(None)
 
 @router.get("/", response_class=HTMLResponse)
 async def index(request: Request, _ = auth_dependency):
@@ -203,43 +282,355 @@ async def index(request: Request, _ = auth_dependency):
     )
 
 
-async def get_result(
-    request: Request, 
+def start_run(
     thread_id: str, 
     agent_id: str, 
     ai_project: AIProjectClient,
-    app_insight_conn_str: Optional[str], 
-    carrier: Dict[str, str]
-) -> AsyncGenerator[str, None]:
+    evaluation_dispatcher: Optional[EvaluationDispatcher],
+    carrier: Dict[str, str],
+    file_name_cache: FileNameCache,
+    content: str,
+    replace_thread: Callable[[str], Awaitable[str]],
+    chat_metrics: LatencyRecorder,
+    stream_registry: StreamRegistry,
+    started: float
+) -> ResumableStream:
+    """
+    Start the run in the background, the clients follow it through the returned stream.
+
+    The run is started before the response, so that it is cancelled after the grace period
+    even if the client has gone before reading the response.
+    """
     ctx = TraceContextTextMapPropagator().extract(carrier=carrier)
-    with tracer.start_as_current_span('get_result', context=ctx):
-        logger.info(f"get_result invoked for thread_id={thread_id} and agent_id={agent_id}")
-        try:
-            agent_client = ai_project.agents
-            async with await agent_client.runs.stream(
-                thread_id=thread_id, 
-                agent_id=agent_id,
-                event_handler=MyEventHandler(ai_project, app_insight_conn_str),
-            ) as stream:
-                logger.info("Successfully created stream; starting to process events")
-                async for event in stream:
-                    _, _, event_func_return_val = event
-                    logger.debug(f"Received event: {event}")
-                    if event_func_return_val:
-                        logger.info(f"Yielding event: {event_func_return_val}")
+    stream_metrics = stream_registry.metrics
+    event_handler = MyEventHandler(ai_project, evaluation_dispatcher, file_name_cache, stream_metrics)
+    agent_client = ai_project.agents
+    stream_metrics.started += 1
+    # The thread of the cookie, which the reconnecting client sends.
+    client_thread_id = thread_id
+
+    async def run_events() -> AsyncGenerator[bytes, None]:
+        nonlocal thread_id
+        with tracer.start_as_current_span('get_result', context=ctx) as span:
+            logger.info(f"get_result invoked for thread_id={thread_id} and agent_id={agent_id}")
+            ttft_recorded = False
+            try:
+                try:
+                    # The user message is added by the run itself, which saves the separate request.
+                    stream = await agent_client.runs.stream(
+                        thread_id=thread_id,
+                        agent_id=agent_id,
+                        additional_messages=[ThreadMessageOptions(role=MessageRole.USER, content=content)],
+                        event_handler=event_handler,
+                    )
+                except ResourceNotFoundError:
+                    # The known thread was deleted, the conversation continues in the new one.
+                    thread_id = await replace_thread(thread_id)
+                    stream = await agent_client.runs.stream(
+                        thread_id=thread_id,
+                        agent_id=agent_id,
+                        additional_messages=[ThreadMessageOptions(role=MessageRole.USER, content=content)],
+                        event_handler=event_handler,
+                    )
+                async with stream:
+                    logger.info("Successfully created stream; starting to process events")
+                    # The f-strings of the debug messages are not built for every token unless they are logged.
+                    debug = logger.isEnabledFor(logging.DEBUG)
+
+                    async def handler_events() -> AsyncGenerator[bytes, None]:
+                        async for event in stream:
+                            _, _, event_func_return_val = event
+                            if debug:
+                                logger.debug(f"Received event: {event}")
+                            if event_func_return_val:
+                                yield event_func_return_val
+
+                    # The buffered deltas are sent when they are due, even if the model pauses.
+                    async for event_func_return_val in flush_when_idle(handler_events(), event_handler.coalescer):
                         yield event_func_return_val
-                    else:
-                        logger.debug("Event received but no data to yield")
+                        if event_handler.first_token_at is not None and not ttft_recorded:
+                            ttft_recorded = True
+                            ttft = event_handler.first_token_at - started
+                            chat_metrics.record('ttft', ttft)
+                            span.set_attribute("chat.ttft_ms", 1000 * ttft)
+                            logger.info(f"Time to first token: {1000 * ttft:.0f} ms, thread ID: {thread_id}")
+                pending = event_handler.coalescer.flush()
+                if pending:
+                    yield pending
+            except Exception as e:
+                logger.exception(f"Exception in get_result: {e}")
+                yield encode_event({'type': "error", 'message': str(e)})
+
+    async def cancel_run() -> None:
+        """Cancel the run, which nobody reads anymore, so that it does not spend the tokens."""
+        run = event_handler.run
+        if run is None or run.status in RUN_FINAL_STATUSES:
+            logger.info(f"The client has gone before the run on thread ID {thread_id} could be cancelled")
+            return
+        try:
+            await agent_client.runs.cancel(thread_id=run.thread_id, run_id=run.id)
         except Exception as e:
-            logger.exception(f"Exception in get_result: {e}")
-            yield serialize_sse_event({'type': "error", 'message': str(e)})
+            stream_metrics.cancel_failures += 1
+            logger.warning(f"Failed to cancel the run {run.id}: {e}")
+            return
+        stream_metrics.record_cancelled(event_handler.coalescer.deltas)
+        logger.info(f"Cancelled the run {run.id} of the disconnected client")
+
+    return stream_registry.create(client_thread_id, run_events(), cancel_run)
+
+
+async def get_result(
+    request: Request,
+    stream: ResumableStream,
+    chat_metrics: LatencyRecorder,
+    started: float
+) -> AsyncGenerator[bytes, None]:
+    # Flush the headers before waiting for the run.
+    yield SSE_STREAM_START
+    chat_metrics.record('ttfb', time.perf_counter() - started)
+    async for event in stream.subscribe(0, request.is_disconnected, SSE_DISCONNECT_POLL):
+        yield event
+
+
+async def resume_result(
+    request: Request,
+    stream: ResumableStream,
+    last_event: int,
+    stream_metrics: StreamMetrics
+) -> AsyncGenerator[bytes, None]:
+    """Replay the events missed by the reconnected client and follow the run."""
+    logger.info(f"Resuming the stream {stream.stream_id} after the event {last_event}")
+    stream_metrics.resumed += 1
+    yield SSE_STREAM_START
+    async for event in stream.subscribe(last_event, request.is_disconnected, SSE_DISCONNECT_POLL):
+        yield event
+
+
+async def resume_shared_result(
+    stream_id: str,
+    last_event: int,
+    events: AsyncGenerator[bytes, None],
+    stream_metrics: StreamMetrics
+) -> AsyncGenerator[bytes, None]:
+    """Replay the events of the run of another worker from the journal and follow the run."""
+    logger.info(f"Resuming the stream {stream_id} of another worker after the event {last_event}")
+    stream_metrics.resumed += 1
+    stream_metrics.shared_resumes += 1
+    yield SSE_STREAM_START
+    async for event in events:
+        yield event
+
+
+async def get_or_create_thread(
+    agent_client: AgentsClient,
+    thread_id: Optional[str],
+    agent_id: Optional[str],
+    agent: Agent,
+    thread_registry: ThreadRegistry,
+    history_cache: ThreadHistoryCache,
+    thread_pool: WarmThreadPool
+) -> str:
+    """
+    Get the thread from the cookies or take a new one from the pool.
+
+    The threads known to the registry are used without requesting them from the service.
+    """
+    try:
+        if thread_id and agent_id == agent.id:
+            if await thread_registry.is_known(thread_id, agent.id):
+                logger.debug(f"Using known thread with ID {thread_id}")
+                return thread_id
+            logger.info(f"Retrieving thread with ID {thread_id}")
+            try:
+                thread = await agent_client.threads.get(thread_id)
+            except ResourceNotFoundError:
+                logger.warning(f"Thread with ID {thread_id} was not found, creating a new one")
+                thread = await create_thread(thread_pool, history_cache)
+        else:
+            thread = await create_thread(thread_pool, history_cache)
+        await thread_registry.remember(thread.id, agent.id)
+        return thread.id
+    except Exception as e:
+        logger.error(f"Error handling thread: {e}")
+        raise HTTPException(status_code=400, detail=f"Error handling thread: {e}")
+
+
+async def create_thread(thread_pool: WarmThreadPool, history_cache: ThreadHistoryCache) -> AgentThread:
+    logger.info("Taking a new thread")
+    thread = await thread_pool.acquire()
+    history_cache.set(thread.id, [])
+    return thread
+
+
+async def replace_missing_thread(
+    agent_client: AgentsClient,
+    thread_id: str,
+    agent: Agent,
+    thread_registry: ThreadRegistry,
+    history_cache: ThreadHistoryCache,
+    thread_pool: WarmThreadPool
+) -> str:
+    """Forget the thread, which was deleted, and take a new one instead."""
+    logger.warning(f"Thread with ID {thread_id} was not found, creating a new one")
+    await thread_registry.forget(thread_id)
+    history_cache.invalidate(thread_id)
+    thread = await create_thread(thread_pool, history_cache)
+    await thread_registry.remember(thread.id, agent.id)
+    return thread.id
+
+
+def format_history_message(formatted_message: Dict, message: ThreadMessage) -> Dict:
+    formatted_message['id'] = message.id
+    formatted_message['role'] = message.role
+    formatted_message['created_at'] = message.created_at.astimezone().strftime("%m/%d/%y, %I:%M %p")
+    return formatted_message
+
+
+async def iter_history_pages(
+    agent_client: AgentsClient,
+    thread_id: str,
+    file_name_cache: FileNameCache,
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None
+) -> AsyncGenerator[List[Tuple[ThreadMessage, Dict]], None]:
+    """Yield the pages of the thread messages, newest first, formatted as soon as every page is fetched."""
+    pages = agent_client.messages.list(
+        thread_id=thread_id, limit=limit, before=before).by_page(continuation_token=after)
+    async for page in pages:
+        messages = [message async for message in page]
+        if not messages:
+            break
+        # Resolve the names of all cited files of the page in one concurrent burst before formatting.
+        await file_name_cache.get_many(
+            agent_client,
+            (annotation.file_citation.file_id
+             for message in messages for annotation in message.file_citation_annotations))
+        yield [
+            (message, format_history_message(
+                await get_message_and_annotations(agent_client, message, file_name_cache), message))
+            for message in messages]
+
+
+async def iter_thread_history(
+    agent_client: AgentsClient,
+    thread_id: str,
+    file_name_cache: FileNameCache,
+    history_cache: ThreadHistoryCache
+) -> AsyncGenerator[Dict, None]:
+    """
+    Yield all formatted messages of the thread, newest first.
+
+    The cached thread costs one request for the messages newer than the cached ones. Otherwise
+    the messages are yielded as they are fetched and the thread is cached if all of them are completed.
+    """
+    cached = history_cache.get(thread_id)
+    if cached:
+        newer = []
+        completed = True
+        async for page in iter_history_pages(
+                agent_client, thread_id, file_name_cache, limit=HISTORY_REFRESH_LIMIT, before=cached[0]['id']):
+            newer.extend(formatted for _, formatted in page)
+            completed = completed and all(message.status == "completed" for message, _ in page)
+            break
+        if len(newer) < HISTORY_REFRESH_LIMIT:
+            if completed:
+                history_cache.set(thread_id, newer + cached)
+            for formatted in newer + cached:
+                yield formatted
+            return
+        # Too many new messages, the thread is fetched again.
+        history_cache.invalidate(thread_id)
+    elif cached is not None:
+        # The thread was empty.
+        history_cache.invalidate(thread_id)
+
+    content = []
+    completed = True
+    async for page in iter_history_pages(agent_client, thread_id, file_name_cache, limit=HISTORY_PAGE_LIMIT):
+        for message, formatted in page:
+            completed = completed and message.status == "completed"
+            content.append(formatted)
+            yield formatted
+    if completed:
+        history_cache.set(thread_id, content)
+
+
+async def get_history_page(
+    agent_client: AgentsClient,
+    thread_id: str,
+    file_name_cache: FileNameCache,
+    history_cache: ThreadHistoryCache,
+    limit: Optional[int],
+    after: Optional[str],
+    before: Optional[str]
+) -> Tuple[List[Dict], bool]:
+    """
+    Get one page of the formatted messages, newest first, and the flag showing if there are more messages.
+
+    The page is taken from the cached thread if the cursors are in it, otherwise it is fetched with one request.
+    """
+    if history_cache.get(thread_id) is not None:
+        messages = [formatted async for formatted in iter_thread_history(
+            agent_client, thread_id, file_name_cache, history_cache)]
+        page = ThreadHistoryCache.select_page(messages, limit, after, before)
+        if page is not None:
+            return page
+    # One extra message is requested to know if there are more, within the limit of the service.
+    if limit:
+        limit = min(limit, HISTORY_PAGE_LIMIT - 1)
+    async for page in iter_history_pages(
+            agent_client, thread_id, file_name_cache, limit=limit + 1 if limit else None, after=after, before=before):
+        formatted_messages = [formatted for _, formatted in page]
+        if limit and len(formatted_messages) > limit:
+            return formatted_messages[:limit], True
+        return formatted_messages, False
+    return [], False
+
+
+async def stream_history(messages: AsyncGenerator[Dict, None]) -> AsyncGenerator[str, None]:
+    """Serialize the messages as the newline delimited JSON."""
+    try:
+        async for formatted in messages:
+            yield json.dumps(formatted) + "\n"
+    except Exception as e:
+        logger.exception(f"Exception in stream_history: {e}")
+        yield json.dumps({'type': "error", 'message': str(e)}) + "\n"
+
+
+async def iter_page(messages: List[Dict]) -> AsyncGenerator[Dict, None]:
+    for formatted in messages:
+        yield formatted
+
+
+async def prefetch_first(messages: AsyncGenerator[Dict, None]) -> AsyncGenerator[Dict, None]:
+    """Fetch the first message now and return the generator of all messages."""
+    try:
+        first = await messages.__anext__()
+    except StopAsyncIteration:
+        return iter_page([])
+
+    async def iter_all() -> AsyncGenerator[Dict, None]:
+        yield first
+        async for formatted in messages:
+            yield formatted
+
+    return iter_all()
 
 
 @router.get("/chat/history")
 async def history(
     request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_PAGE_LIMIT - 1),
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    stream: bool = False,
     ai_project : AIProjectClient = Depends(get_ai_project),
     agent : Agent = Depends(get_agent),
+    file_name_cache: FileNameCache = Depends(get_file_name_cache),
+    history_cache: ThreadHistoryCache = Depends(get_history_cache),
+    thread_registry: ThreadRegistry = Depends(get_thread_registry),
+    thread_pool: WarmThreadPool = Depends(get_thread_pool),
 	_ = auth_dependency
 ):
     with tracer.start_as_current_span("chat_history"):
@@ -248,37 +639,45 @@ async def history(
         agent_id = request.cookies.get('agent_id')
 
         # Attempt to get an existing thread. If not found, create a new one.
-        try:
-            agent_client = ai_project.agents
-            if thread_id and agent_id == agent.id:
-                logger.info(f"Retrieving thread with ID {thread_id}")
-                thread = await agent_client.threads.get(thread_id)
-            else:
-                logger.info("Creating a new thread")
-                thread = await agent_client.threads.create()
-        except Exception as e:
-            logger.error(f"Error handling thread: {e}")
-            raise HTTPException(status_code=400, detail=f"Error handling thread: {e}")
-
-        thread_id = thread.id
+        agent_client = ai_project.agents
+        thread_id = await get_or_create_thread(
+            agent_client, thread_id, agent_id, agent, thread_registry, history_cache, thread_pool)
         agent_id = agent.id
 
-    # Create a new message from the user's input.
+    # List the messages of the thread, newest first.
     try:
-        content = []
-        response = agent_client.messages.list(
-            thread_id=thread_id,
-        )
-        async for message in response:
-            formatteded_message = await get_message_and_annotations(agent_client, message)
-            formatteded_message['role'] = message.role
-            formatteded_message['created_at'] = message.created_at.astimezone().strftime("%m/%d/%y, %I:%M %p")
-            content.append(formatteded_message)
-                
-                                        
+        headers = {}
+        paginated = limit is not None or after is not None or before is not None
+        if paginated:
+            try:
+                content, has_more = await get_history_page(
+                    agent_client, thread_id, file_name_cache, history_cache, limit, after, before)
+            except ResourceNotFoundError:
+                thread_id = await replace_missing_thread(
+                    agent_client, thread_id, agent, thread_registry, history_cache, thread_pool)
+                content, has_more = [], False
+            headers["X-Has-More"] = str(has_more).lower()
+            if content:
+                headers["X-First-Id"] = content[0]['id']
+                headers["X-Last-Id"] = content[-1]['id']
         logger.info(f"List message, thread ID: {thread_id}")
-        response = JSONResponse(content=content)
-    
+        if paginated:
+            messages = iter_page(content)
+        else:
+            messages = iter_thread_history(agent_client, thread_id, file_name_cache, history_cache)
+            try:
+                # The first page is fetched before responding, so that the missing thread can be replaced.
+                messages = await prefetch_first(messages)
+            except ResourceNotFoundError:
+                thread_id = await replace_missing_thread(
+                    agent_client, thread_id, agent, thread_registry, history_cache, thread_pool)
+                messages = iter_page([])
+        if stream:
+            response = StreamingResponse(stream_history(messages), media_type="application/x-ndjson", headers=headers)
+        else:
+            content = [formatted async for formatted in messages]
+            response = JSONResponse(content=content, headers=headers)
+
         # Update cookies to persist the thread and agent IDs.
         response.set_cookie("thread_id", thread_id)
         response.set_cookie("agent_id", agent_id)
@@ -287,6 +686,24 @@ async def history(
         logger.error(f"Error listing message: {e}")
         raise HTTPException(status_code=500, detail=f"Error list message: {e}")
 
+@router.get("/metrics")
+async def metrics(request: Request, _ = auth_dependency):
+    """Get the metrics of the caches and pools of this worker."""
+    state = request.app.state
+    return JSONResponse({
+        "pid": os.getpid(),
+        "file_name_cache": state.file_name_cache.stats(),
+        "history_cache": state.history_cache.stats(),
+        "thread_registry": state.thread_registry.stats(),
+        "thread_pool": state.thread_pool.stats(),
+        "chat_latency": state.chat_metrics.stats(),
+        "streams": state.stream_registry.metrics.stats(),
+        "stream_registry": state.stream_registry.stats(),
+        "admission": state.admission.stats(),
+        "evaluations": state.evaluation_dispatcher.stats() if state.evaluation_dispatcher else None,
+        "http_transport": state.http_transport.stats() if getattr(state, "http_transport", None) else None,
+    })
+
 @router.get("/agent")
 async def get_chat_agent(
     request: Request
@@ -298,32 +715,51 @@ async def chat(
     request: Request,
     agent : Agent = Depends(get_agent),
     ai_project: AIProjectClient = Depends(get_ai_project),
-    app_insights_conn_str : str = Depends(get_app_insights_conn_str),
+    evaluation_dispatcher: Optional[EvaluationDispatcher] = Depends(get_evaluation_dispatcher),
+    file_name_cache: FileNameCache = Depends(get_file_name_cache),
+    history_cache: ThreadHistoryCache = Depends(get_history_cache),
+    thread_registry: ThreadRegistry = Depends(get_thread_registry),
+    thread_pool: WarmThreadPool = Depends(get_thread_pool),
+    chat_metrics: LatencyRecorder = Depends(get_chat_metrics),
+    stream_registry: StreamRegistry = Depends(get_stream_registry),
+    admission: AdmissionController = Depends(get_admission_controller),
 	_ = auth_dependency
 ):
+    started = time.perf_counter()
     # Retrieve the thread ID from the cookies (if available).
     thread_id = request.cookies.get('thread_id')
     agent_id = request.cookies.get('agent_id')
 
+    # Set the Server-Sent Events (SSE) response headers.
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "Content-Type": "text/event-stream",
+        # Ask the reverse proxies not to buffer the events.
+        "X-Accel-Buffering": "no"
+    }
+
+    # The client, which has lost the connection, continues the running answer instead of starting a new run.
+    last_event_id = parse_event_id(request.headers.get('last-event-id'))
+    if last_event_id is not None:
+        stream_id, last_event = last_event_id
+        stream = stream_registry.get(stream_id, thread_id)
+        if stream is not None:
+            return StreamingResponse(
+                resume_result(request, stream, last_event, stream_registry.metrics), headers=headers)
+        # The stream of another worker on the host is followed through the shared journal.
+        shared_events = await stream_registry.subscribe_shared(
+            stream_id, thread_id, last_event, request.is_disconnected, SSE_DISCONNECT_POLL)
+        if shared_events is not None:
+            return StreamingResponse(
+                resume_shared_result(stream_id, last_event, shared_events, stream_registry.metrics), headers=headers)
+        # Starting a new run would post the user's message again, the client reloads the history instead.
+        logger.warning(f"The stream {stream_id} cannot be resumed")
+        raise HTTPException(status_code=410, detail="The stream cannot be resumed")
+
     with tracer.start_as_current_span("chat_request"):
         carrier = {}        
         TraceContextTextMapPropagator().inject(carrier)
-        
-        # Attempt to get an existing thread. If not found, create a new one.
-        try:
-            agent_client = ai_project.agents
-            if thread_id and agent_id == agent.id:
-                logger.info(f"Retrieving thread with ID {thread_id}")
-                thread = await agent_client.threads.get(thread_id)
-            else:
-                logger.info("Creating a new thread")
-                thread = await agent_client.threads.create()
-        except Exception as e:
-            logger.error(f"Error handling thread: {e}")
-            raise HTTPException(status_code=400, detail=f"Error handling thread: {e}")
-
-        thread_id = thread.id
-        agent_id = agent.id
 
         # Parse the JSON from the request.
         try:
@@ -334,28 +770,37 @@ async def chat(
 
         logger.info(f"user_message: {user_message}")
 
-        # Create a new message from the user's input.
+        # Wait for the free run slot, the busy worker rejects the request before any upstream call.
         try:
-            message = await agent_client.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=user_message.get('message', '')
-            )
-            logger.info(f"Created message, message ID: {message.id}")
-        except Exception as e:
-            logger.error(f"Error creating message: {e}")
-            raise HTTPException(status_code=500, detail=f"Error creating message: {e}")
-
-        # Set the Server-Sent Events (SSE) response headers.
-        headers = {
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Content-Type": "text/event-stream"
-        }
-        logger.info(f"Starting streaming response for thread ID {thread_id}")
+            release_run = await admission.acquire()
+        except AdmissionRejected as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+        try:
+            # Attempt to get an existing thread. If not found, create a new one.
+            agent_client = ai_project.agents
+            thread_id = await get_or_create_thread(
+                agent_client, thread_id, agent_id, agent, thread_registry, history_cache, thread_pool)
+            agent_id = agent.id
+
+            def replace_thread(missing_thread_id: str) -> Awaitable[str]:
+                return replace_missing_thread(
+                    agent_client, missing_thread_id, agent, thread_registry, history_cache, thread_pool)
+
+            logger.info(f"Starting streaming response for thread ID {thread_id}")
+
+            # The run posts the user's message.
+            stream = start_run(
+                thread_id, agent_id, ai_project, evaluation_dispatcher, carrier, file_name_cache,
+                user_message.get('message', ''), replace_thread, chat_metrics, stream_registry, started)
+        except BaseException:
+            release_run()
+            raise
+        # The slot is held until the run has finished, even if the client has gone.
+        stream.task.add_done_callback(lambda _: release_run())
 
         # Create the streaming response using the generator.
-        response = StreamingResponse(get_result(request, thread_id, agent_id, ai_project, app_insights_conn_str, carrier), headers=headers)
+        response = StreamingResponse(get_result(request, stream, chat_metrics, started), headers=headers)
 
         # Update cookies to persist the thread and agent IDs.
         response.set_cookie("thread_id", thread_id)
@@ -367,43 +812,31 @@ def read_file(path: str) -> str:
         return file.read()
 
 
-def run_agent_evaluation(
-    thread_id: str, 
-    run_id: str,
+async def run_agent_evaluation(
     ai_project: AIProjectClient,
-    app_insights_conn_str: str):
-
-    if app_insights_conn_str:
-        agent_evaluation_request = AgentEvaluationRequest(
-            run_id=run_id,
-            thread_id=thread_id,
-            evaluators={
-                "Relevance": {"Id": EvaluatorIds.RELEVANCE.value},
-                "TaskAdherence": {"Id": EvaluatorIds.TASK_ADHERENCE.value},
-                "ToolCallAccuracy": {"Id": EvaluatorIds.TOOL_CALL_ACCURACY.value},
-            },
-            sampling_configuration=AgentEvaluationSamplingConfiguration(
-                name="default",
-                sampling_percent=100,
-            ),
-            redaction_configuration=AgentEvaluationRedactionConfiguration(
-                redact_score_properties=False,
-            ),
-            app_insights_connection_string=app_insights_conn_str,
-        )
-        
-        async def run_evaluation():
-            try:        
-                logger.info(f"Running agent evaluation on thread ID {thread_id} and run ID {run_id}")
-                agent_evaluation_response = await ai_project.evaluations.create_agent_evaluation(
-                    evaluation=agent_evaluation_request
-                )
-                logger.info(f"Evaluation response: {agent_evaluation_response}")
-            except Exception as e:
-                logger.error(f"Error creating agent evaluation: {e}")
-
-        # Create a new task to run the evaluation asynchronously
-        asyncio.create_task(run_evaluation())
+    app_insights_conn_str: str,
+    thread_id: str, 
+    run_id: str) -> AgentEvaluation:
+    """Create the evaluation of the completed run, it is called by the EvaluationDispatcher."""
+    agent_evaluation_request = AgentEvaluationRequest(
+        run_id=run_id,
+        thread_id=thread_id,
+        evaluators={
+            "Relevance": {"Id": EvaluatorIds.RELEVANCE.value},
+            "TaskAdherence": {"Id": EvaluatorIds.TASK_ADHERENCE.value},
+            "ToolCallAccuracy": {"Id": EvaluatorIds.TOOL_CALL_ACCURACY.value},
+        },
+        # The runs are sampled by the dispatcher before the request.
+        sampling_configuration=AgentEvaluationSamplingConfiguration(
+            name="default",
+            sampling_percent=100,
+        ),
+        redaction_configuration=AgentEvaluationRedactionConfiguration(
+            redact_score_properties=False,
+        ),
+        app_insights_connection_string=app_insights_conn_str,
+    )
+    return await ai_project.evaluations.create_agent_evaluation(evaluation=agent_evaluation_request)
 
 
 @router.get("/config/azure")
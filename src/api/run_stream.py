@@ -0,0 +1,469 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+import asyncio
+import collections
+import logging
+import secrets
+import time
+
+from .sse import encode_event_id, split_events
+from .stream_journal import Events, StreamJournal
+
+logger = logging.getLogger("azureaiapp")
+
+# The tasks, which must finish even if the request, which started them, is gone.
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def run_in_background(coroutine: Awaitable[Any]) -> asyncio.Task:
+    """
+    Run the coroutine in the task, which is not cancelled together with the current request.
+
+    :param coroutine: The coroutine to run.
+    :return: The task.
+    """
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+class StreamMetrics:
+    """The counters of the chat streams of this worker."""
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.cancel_failures = 0
+        self.backpressure_waits = 0
+        self.resumed = 0
+        self.shared_resumes = 0
+        self.replayed_events = 0
+        self._completion_tokens = 0
+        self._completed_with_usage = 0
+        self._estimated_tokens_saved = 0.0
+
+    def record_usage(self, completion_tokens: int) -> None:
+        """
+        Record the number of completion tokens of the completed run.
+
+        :param completion_tokens: The number of tokens, generated by the run.
+        """
+        self._completion_tokens += completion_tokens
+        self._completed_with_usage += 1
+
+    @property
+    def average_completion_tokens(self) -> float:
+        """The average number of completion tokens of the completed runs."""
+        if not self._completed_with_usage:
+            return 0.0
+        return self._completion_tokens / self._completed_with_usage
+
+    def record_cancelled(self, streamed_tokens: int) -> None:
+        """
+        Record the run, cancelled because the client has gone.
+
+        The saved tokens are estimated as the average completion of the completed runs
+        minus the tokens, which were already streamed.
+
+        :param streamed_tokens: The number of the message deltas sent before the cancellation.
+        """
+        self.cancelled += 1
+        self._estimated_tokens_saved += max(self.average_completion_tokens - streamed_tokens, 0.0)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the stream counters.
+
+        :return: The dictionary with the number of started, completed and cancelled streams,
+                 failed cancellations, waits for slow clients, resumed streams, the streams of
+                 other workers resumed from the journal, replayed events and the estimated number
+                 of saved tokens.
+        """
+        return {
+            'started': self.started,
+            'completed': self.completed,
+            'cancelled': self.cancelled,
+            'cancel_failures': self.cancel_failures,
+            'backpressure_waits': self.backpressure_waits,
+            'resumed': self.resumed,
+            'shared_resumes': self.shared_resumes,
+            'replayed_events': self.replayed_events,
+            'average_completion_tokens': self.average_completion_tokens,
+            'estimated_tokens_saved': round(self._estimated_tokens_saved),
+        }
+
+
+def format_event_id(stream_id: str, sequence: int) -> str:
+    """
+    Build the identifier of the event, which is sent by the client in the Last-Event-ID header.
+
+    :param stream_id: The identifier of the stream, which has no dots.
+    :param sequence: The number of the event in the stream starting from 1.
+    :return: The event identifier.
+    """
+    return f"{stream_id}.{sequence}"
+
+
+def parse_event_id(event_id: Optional[str]) -> Optional[Tuple[str, int]]:
+    """
+    Parse the identifier of the event, built by format_event_id.
+
+    :param event_id: The value of the Last-Event-ID header.
+    :return: The stream identifier and the event number or None if the identifier is not valid.
+    """
+    if not event_id:
+        return None
+    stream_id, _, sequence = event_id.rpartition('.')
+    if not stream_id or not sequence.isdigit():
+        return None
+    return stream_id, int(sequence)
+
+
+class ResumableStream:
+    """
+    The stream of the run events, to which the client may reconnect.
+
+    The source is consumed by the separate task and every event is stored with its number in
+    the ring buffer of the recent events. The attached client receives the events after the
+    last one it has seen, so the reconnected client gets the missed events replayed and then
+    follows the live run. The source is not read further than max_ahead events ahead of the
+    attached client, so the slow client slows down the reading of the upstream instead of
+    growing the buffer. If no client is attached for the grace period, including the time
+    before the first client attaches, the source is cancelled and on_abandon is started in the
+    background. With the journal, the events are also written to it for the clients, which
+    reconnect to the other workers, and the client following the stream from another worker
+    counts as attached.
+
+    :param stream_id: The identifier of the stream.
+    :param thread_id: The thread of the run, the reconnecting client must have the same thread.
+    :param source: The events to relay.
+    :param on_abandon: The function, releasing the upstream resources.
+    :param buffer_size: The number of the recent events kept for the replay.
+    :param max_ahead: The maximal number of the events waiting for the client.
+    :param grace: The number of seconds to wait for the client to reconnect.
+    :param metrics: The metrics to count the waits for the slow client and the resumed streams.
+    :param journal: The journal shared with the other workers, None if the stream is not shared.
+    """
+
+    def __init__(
+            self,
+            stream_id: str,
+            thread_id: str,
+            source: AsyncGenerator[bytes, None],
+            on_abandon: Callable[[], Awaitable[None]],
+            buffer_size: int,
+            max_ahead: int,
+            grace: float,
+            metrics: Optional[StreamMetrics] = None,
+            journal: Optional[StreamJournal] = None
+        ) -> None:
+        """Constructor."""
+        self.stream_id = stream_id
+        self.thread_id = thread_id
+        self._source = source
+        self._on_abandon = on_abandon
+        # The client may lag behind by max_ahead events, which must still be in the buffer.
+        self._events: collections.deque = collections.deque(maxlen=max(buffer_size, max_ahead))
+        self._max_ahead = max_ahead
+        self._grace = grace
+        self._metrics = metrics
+        # The number of the last stored event and of the last event given to the client.
+        self._last = 0
+        self._sent = 0
+        self._stored = asyncio.Event()
+        self._sent_changed = asyncio.Event()
+        self._subscriber: Optional[object] = None
+        self.finished = False
+        self.abandoned = False
+        self._journal = journal
+        # The events not written to the journal yet.
+        self._journal_events: Events = []
+        self._journal_changed = asyncio.Event()
+        # The time, when the client of another worker has last read the stream.
+        self._remote_attached: Optional[float] = None
+        self.task = asyncio.create_task(self._produce())
+        self._journal_task = asyncio.create_task(self._write_journal()) if journal is not None else None
+        # The run is abandoned if the client does not attach in time.
+        self._abandon_task: Optional[asyncio.Task] = run_in_background(self._abandon_after_grace())
+
+    async def _produce(self) -> None:
+        """Read the source into the buffer."""
+        try:
+            async for chunk in self._source:
+                for event in split_events(chunk):
+                    if self._last - self._sent >= self._max_ahead and self._metrics is not None:
+                        self._metrics.backpressure_waits += 1
+                    while self._last - self._sent >= self._max_ahead:
+                        self._sent_changed.clear()
+                        await self._sent_changed.wait()
+                    self._last += 1
+                    event_id = format_event_id(self.stream_id, self._last)
+                    self._events.append((self._last, encode_event_id(event_id) + event))
+                    self._stored.set()
+                    if self._journal is not None:
+                        self._journal_events.append(self._events[-1])
+                        self._journal_changed.set()
+        except Exception as e:
+            logger.error(f"Error reading the stream {self.stream_id}: {e}", exc_info=True)
+        finally:
+            self.finished = True
+            self._stored.set()
+            self._journal_changed.set()
+            # Close the upstream even if the task was cancelled while waiting for the client.
+            await self._source.aclose()
+
+    async def _write_journal(self) -> None:
+        """Write the stored events to the journal and read the progress of the client of another worker."""
+        try:
+            await self._journal.create(self.stream_id, self.thread_id)
+            while True:
+                self._journal_changed.clear()
+                finished = self.finished
+                events, self._journal_events = self._journal_events, []
+                self._remote_attached, remote_sent = await self._journal.append(self.stream_id, events, finished)
+                if remote_sent > self._sent:
+                    self._sent = remote_sent
+                    self._sent_changed.set()
+                if finished:
+                    return
+                # The progress of the remote client is read more often while the source waits for it.
+                waiting = (self._last - self._sent >= self._max_ahead and self._remote_attached is not None
+                           and time.time() - self._remote_attached < self._grace)
+                try:
+                    await asyncio.wait_for(
+                        self._journal_changed.wait(),
+                        StreamJournal.POLL_INTERVAL if waiting else StreamJournal.HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as e:
+            logger.warning(f"Failed to write the stream {self.stream_id} to the journal: {e}")
+
+    async def subscribe(
+            self,
+            last_event: int,
+            is_disconnected: Callable[[], Awaitable[bool]],
+            poll_interval: float
+        ) -> AsyncGenerator[bytes, None]:
+        """
+        Attach the client to the stream, the previously attached client is detached.
+
+        The client connection is checked every poll interval, even if the events keep coming,
+        because the server may accept the writes to the closed connection.
+
+        :param last_event: The number of the last event the client has received, 0 for the new client.
+        :param is_disconnected: The function, checking if the client has gone.
+        :param poll_interval: The number of seconds between the checks of the client connection.
+        :return: The generator of the events after the last received one.
+        """
+        token = object()
+        self._subscriber = token
+        if self._abandon_task is not None:
+            self._abandon_task.cancel()
+            self._abandon_task = None
+        if self._events and last_event < self._events[0][0] - 1:
+            logger.warning(f"The events {last_event + 1}-{self._events[0][0] - 1} of the stream "
+                           f"{self.stream_id} are not kept anymore")
+        if self._metrics is not None and last_event < self._last:
+            self._metrics.replayed_events += self._last - max(last_event, self._events[0][0] - 1)
+        position = last_event
+        self._sent = position
+        self._sent_changed.set()
+        loop = asyncio.get_running_loop()
+        next_check = loop.time() + poll_interval
+        try:
+            while self._subscriber is token:
+                if self._events and position < self._last:
+                    first = self._events[0][0]
+                    event_number, chunk = self._events[max(position - first + 1, 0)]
+                    position = self._sent = event_number
+                    self._sent_changed.set()
+                    yield chunk
+                elif self.finished:
+                    return
+                else:
+                    self._stored.clear()
+                    try:
+                        await asyncio.wait_for(self._stored.wait(), max(next_check - loop.time(), 0))
+                    except asyncio.TimeoutError:
+                        pass
+                if loop.time() >= next_check:
+                    if await is_disconnected():
+                        logger.info(f"The client of the stream {self.stream_id} has disconnected")
+                        return
+                    next_check = loop.time() + poll_interval
+        finally:
+            if self._subscriber is token:
+                self._subscriber = None
+                if not self.finished:
+                    self._abandon_task = run_in_background(self._abandon_after_grace())
+
+    async def _abandon_after_grace(self) -> None:
+        """Cancel the source if no client reconnects during the grace period."""
+        while True:
+            await asyncio.sleep(self._grace)
+            if self._subscriber is not None or self.finished:
+                return
+            # The client follows the stream from another worker.
+            if self._remote_attached is None or time.time() - self._remote_attached >= self._grace:
+                break
+        self.abandoned = True
+        self.task.cancel()
+        await self._on_abandon()
+
+
+class StreamRegistry:
+    """
+    The streams of this worker, to which the clients may reconnect.
+
+    The stream is kept while it is running and for the grace period after it has finished,
+    so that the client, which has missed the end of the answer, may still get it. With the
+    journal, the client may also reconnect to the stream of another worker on the host.
+
+    :param buffer_size: The number of the recent events kept for the replay per stream.
+    :param max_ahead: The maximal number of the events waiting for the client per stream.
+    :param grace: The number of seconds to wait for the client to reconnect.
+    :param metrics: The stream metrics.
+    :param journal: The journal shared by the workers on the host, None if the streams are not shared.
+    """
+
+    DEFAULT_BUFFER_SIZE = 256
+    DEFAULT_MAX_AHEAD = 64
+    DEFAULT_GRACE = 30.0
+
+    def __init__(
+            self,
+            buffer_size: int = DEFAULT_BUFFER_SIZE,
+            max_ahead: int = DEFAULT_MAX_AHEAD,
+            grace: float = DEFAULT_GRACE,
+            metrics: Optional[StreamMetrics] = None,
+            journal: Optional[StreamJournal] = None
+        ) -> None:
+        """Constructor."""
+        self._buffer_size = buffer_size
+        self._max_ahead = max_ahead
+        self._grace = grace
+        self.metrics = metrics if metrics is not None else StreamMetrics()
+        self._streams: Dict[str, ResumableStream] = {}
+        self._journal = journal
+
+    def create(
+            self,
+            thread_id: str,
+            source: AsyncGenerator[bytes, None],
+            on_abandon: Callable[[], Awaitable[None]]
+        ) -> ResumableStream:
+        """
+        Start reading the source into the new stream.
+
+        :param thread_id: The thread of the run.
+        :param source: The events of the run.
+        :param on_abandon: The function, releasing the upstream resources if the client has gone.
+        :return: The stream.
+        """
+        stream_id = secrets.token_urlsafe(12)
+        stream = ResumableStream(
+            stream_id, thread_id, source, on_abandon, self._buffer_size, self._max_ahead, self._grace, self.metrics,
+            self._journal)
+        self._streams[stream_id] = stream
+        loop = asyncio.get_running_loop()
+        stream.task.add_done_callback(
+            lambda _: loop.call_later(self._grace, self._streams.pop, stream_id, None))
+        return stream
+
+    def get(self, stream_id: str, thread_id: Optional[str]) -> Optional[ResumableStream]:
+        """
+        Get the stream to reconnect to.
+
+        :param stream_id: The identifier of the stream.
+        :param thread_id: The thread of the client.
+        :return: The stream or None if it is not known, was abandoned or belongs to the other thread.
+        """
+        stream = self._streams.get(stream_id)
+        if stream is None or stream.abandoned or stream.thread_id != thread_id:
+            return None
+        return stream
+
+    async def subscribe_shared(
+            self,
+            stream_id: str,
+            thread_id: Optional[str],
+            last_event: int,
+            is_disconnected: Callable[[], Awaitable[bool]],
+            poll_interval: float
+        ) -> Optional[AsyncGenerator[bytes, None]]:
+        """
+        Attach the client to the stream of another worker through the journal.
+
+        :param stream_id: The identifier of the stream.
+        :param thread_id: The thread of the client.
+        :param last_event: The number of the last event the client has received.
+        :param is_disconnected: The function, checking if the client has gone.
+        :param poll_interval: The number of seconds between the checks of the client connection.
+        :return: The generator of the events after the last received one or None if the journal
+                 does not have the stream of the thread.
+        """
+        if self._journal is None or not thread_id:
+            return None
+        first = await self._journal.read(stream_id, thread_id, last_event)
+        if first is None:
+            return None
+        return self._follow_shared(stream_id, thread_id, last_event, first, is_disconnected, poll_interval)
+
+    async def _follow_shared(
+            self,
+            stream_id: str,
+            thread_id: str,
+            position: int,
+            first: Tuple[Events, bool, float],
+            is_disconnected: Callable[[], Awaitable[bool]],
+            poll_interval: float
+        ) -> AsyncGenerator[bytes, None]:
+        """
+        Relay the events of the stream from the journal until the stream has finished.
+
+        :param stream_id: The identifier of the stream.
+        :param thread_id: The thread of the client.
+        :param position: The number of the last event the client has received.
+        :param first: The first result of the journal read.
+        :param is_disconnected: The function, checking if the client has gone.
+        :param poll_interval: The number of seconds between the checks of the client connection.
+        :return: The generator of the events.
+        """
+        events, finished, updated = first
+        loop = asyncio.get_running_loop()
+        next_check = loop.time() + poll_interval
+        while True:
+            for position, chunk in events:
+                yield chunk
+            if finished and not events:
+                return
+            if not finished and time.time() - updated >= self._grace:
+                logger.warning(f"The worker of the stream {stream_id} has stopped writing it")
+                return
+            if not events:
+                await asyncio.sleep(StreamJournal.POLL_INTERVAL)
+            if loop.time() >= next_check:
+                if await is_disconnected():
+                    logger.info(f"The client of the stream {stream_id} has disconnected")
+                    return
+                next_check = loop.time() + poll_interval
+            result = await self._journal.read(stream_id, thread_id, position)
+            if result is None:
+                return
+            events, finished, updated = result
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the registry counters.
+
+        :return: The dictionary with the number of the kept and running streams.
+        """
+        return {
+            'size': len(self._streams),
+            'running': sum(not stream.finished for stream in self._streams.values()),
+        }
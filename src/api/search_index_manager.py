@@ -1,15 +1,18 @@
-from typing import Any, Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
-import csv
+import asyncio
+import collections
 import glob
-import json
+import hashlib
+import logging
 import os
 import time
 
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.search.documents.aio import AsyncSearchItemPaged, SearchClient 
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError, ServiceRequestError, ServiceResponseError
+from azure.core.pipeline.transport import AsyncHttpTransport
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
     AzureOpenAIVectorizerParameters,
@@ -25,8 +28,13 @@ from azure.search.documents.indexes.models import (
     VectorSearch,
     VectorSearchProfile,
 )
-from azure.search.documents.models import VectorizableTextQuery
+from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
 
+from api.async_cache import AsyncLRUCache
+from api.embeddings_store import EmbeddingsWriter, iter_embeddings, read_manifest, write_manifest
+from api.local_search import SearchBackend
+
+logger = logging.getLogger("azureaiapp")
 
 
 class SearchIndexManager:
@@ -44,11 +52,50 @@ class SearchIndexManager:
     :param embeddings_endpoint: The the endpoint used for embedding.
     :param embed_api_key: The api key used by the embedding resource.
     :param embedding_client: The embedding client, used t build the embedding. Needed only
-                             to create embedding file. Not used in inference time.
+                             to create embedding file. At inference time it is used only by
+                             search_many to embed the questions in one request.
+    :param readiness_timeout: The number of seconds during which the search retries empty results
+                              after the index was created or the documents were uploaded.
+    :param readiness_backoff: The initial delay in seconds between these retries; it doubles
+                              on every attempt up to READINESS_MAX_BACKOFF.
+    :param cache_size: The number of search results to cache, 0 disables the cache.
+    :param cache_ttl: The number of seconds the search result is kept in the cache.
+    :param backend: The search backend, used instead of Azure AI Search for search and semantic_search,
+                    for example LocalSearchBackend. The index is not required in this case.
+    :param transport: The HTTP transport of the search clients, which does not own its session,
+                      for example SharedTransport.transport(). None creates the new session per client.
     """
     
     MIN_DIFF_CHARACTERS_IN_LINE = 5
     MIN_LINE_LENGTH = 5
+
+    READINESS_TIMEOUT = 5.0
+    READINESS_BACKOFF = 0.1
+    READINESS_MAX_BACKOFF = 1.0
+
+    QUERY_CACHE_TTL = 300.0
+
+    SEARCH_CONCURRENCY = 8
+
+    UPLOAD_BATCH_SIZE = 500
+    UPLOAD_MAX_BATCH_BYTES = 8 * 1024 * 1024
+    UPLOAD_CONCURRENCY = 4
+    UPLOAD_MAX_RETRIES = 3
+    UPLOAD_RETRY_BACKOFF = 0.5
+    # The number of the document keys read from the index in one request.
+    KEY_PAGE_SIZE = 1000
+    # The version of the index schema, created by create_index. The indexes of the version 1
+    # have the key field, which is neither filterable nor sortable, and cannot be synchronized.
+    SCHEMA_VERSION = 2
+
+    EMBEDDING_BATCH_SIZE = 2000
+    EMBEDDING_CONCURRENCY = 4
+    EMBEDDING_MAX_RETRIES = 5
+    EMBEDDING_RETRY_BACKOFF = 1.0
+    _RETRIABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    # The approximate length of the float in the JSON payload.
+    _BYTES_PER_FLOAT = 12
     
     _SEMANTIC_CONFIG = "semantic_search"
     _EMBEDDING_CONFIG = "embedding_config"
@@ -65,7 +112,13 @@ class SearchIndexManager:
             deployment_name: str,
             embedding_endpoint: str, 
             embed_api_key: Optional[str],
-            embedding_client: Optional[Any] = None
+            embedding_client: Optional[Any] = None,
+            readiness_timeout: float = READINESS_TIMEOUT,
+            readiness_backoff: float = READINESS_BACKOFF,
+            cache_size: int = 0,
+            cache_ttl: float = QUERY_CACHE_TTL,
+            backend: Optional[SearchBackend] = None,
+            transport: Optional[AsyncHttpTransport] = None,
         ) -> None:
         """Constructor."""
         self._dimensions = dimensions
@@ -79,36 +132,424 @@ class SearchIndexManager:
         self._embed_api_key = embed_api_key
         self._client = None
         self._embedding_client = embedding_client
+        self._readiness_timeout = readiness_timeout
+        self._readiness_backoff = readiness_backoff
+        # The monotonic time until which the freshly populated index may return incomplete results.
+        self._cold_until: Optional[float] = None
+        self._cache = AsyncLRUCache(cache_size, cache_ttl) if cache_size > 0 else None
+        self._backend = backend
+        self._client_kwargs = {'transport': transport} if transport is not None else {}
 
     def _get_client(self):
         """Get search client if it is absent."""
         if self._client is None:
             self._client = SearchClient(
-                endpoint=self._endpoint, index_name=self._index.name, credential=self._credential)
+                endpoint=self._endpoint, index_name=self._index.name, credential=self._credential,
+                **self._client_kwargs)
         return self._client
     
-    async def upload_documents(self, embeddings_file: str) -> None:
+    async def upload_documents(
+            self,
+            embeddings_file: str,
+            batch_size: int = UPLOAD_BATCH_SIZE,
+            max_batch_bytes: int = UPLOAD_MAX_BATCH_BYTES,
+            concurrency: int = UPLOAD_CONCURRENCY,
+            max_retries: int = UPLOAD_MAX_RETRIES,
+        ) -> Dict[str, int]:
         """
         Upload the embeggings file to index search.
 
-        :param embeddings_file: The embeddings file to upload.
+        The file is read lazily and split into batches, limited both by the number of documents
+        and by the approximate payload size. Up to concurrency batches are uploaded at once,
+        the failed batches and documents are retried with exponential backoff. Only a bounded
+        number of batches is kept in memory regardless of the file size.
+
+        :param embeddings_file: The embeddings file to upload, CSV or binary (see embeddings_store).
+        :param batch_size: The maximal number of documents in one upload request.
+        :param max_batch_bytes: The approximate maximal size of one upload request.
+        :param concurrency: The maximal number of upload requests in flight.
+        :param max_retries: The number of retries for the failed batch.
+        :return: The upload report with the number of succeeded and failed batches and documents.
         """
         self._raise_if_no_index()
-        documents = []
-        index = 0
-        with open(embeddings_file, newline='') as fp:
-            reader = csv.DictReader(fp)
-            for row in reader:
-                documents.append(
-                    {
-                        'embedId': str(index),
-                        'token': row['token'],
-                        'embedding': json.loads(row['embedding']),
-                        'title': row['title'] 
-                    }
-                )
-                index += 1
-        await self._get_client().upload_documents(documents)
+        batches = self._iter_batches(self._iter_documents(embeddings_file), batch_size, max_batch_bytes)
+        report = await self._send_batches((('upload', batch) for batch in batches), concurrency, max_retries)
+        self._mark_index_cold()
+        self.invalidate_cache()
+        return report
+
+    async def sync_documents(
+            self,
+            embeddings_file: str,
+            batch_size: int = UPLOAD_BATCH_SIZE,
+            max_batch_bytes: int = UPLOAD_MAX_BATCH_BYTES,
+            concurrency: int = UPLOAD_CONCURRENCY,
+            max_retries: int = UPLOAD_MAX_RETRIES,
+        ) -> Dict[str, int]:
+        """
+        Make the index contain exactly the documents from the embeddings file.
+
+        Every document carries the fingerprint of its text, the embedding model and the number
+        of dimensions. The document, which is present in the index with the same key and the
+        same fingerprint, is left intact. The new documents and the documents with a different
+        fingerprint, for example re-embedded by another model, are uploaded, and the documents
+        absent from the embeddings file are deleted, so the traffic is proportional to the
+        change rather than to the size of the corpus. The fingerprint field is added to the
+        index, which does not have it yet. The index of the older schema version, whose key
+        cannot be enumerated, is recreated once and all documents are uploaded to it.
+
+        :param embeddings_file: The embeddings file, CSV or binary (see embeddings_store).
+        :param batch_size: The maximal number of documents in one request.
+        :param max_batch_bytes: The approximate maximal size of one upload request.
+        :param concurrency: The maximal number of requests in flight.
+        :param max_retries: The number of retries for the failed batch.
+        :return: The report with the number of unchanged, uploaded and deleted documents along
+                 with the number of succeeded and failed batches and documents; index_rebuilt
+                 is 1 if the index was recreated.
+        """
+        self._raise_if_no_index()
+        if (SearchIndexManager._get_schema_version(self._index) < SearchIndexManager.SCHEMA_VERSION
+                and await self._rebuild_index()):
+            report = await self.upload_documents(
+                embeddings_file, batch_size, max_batch_bytes, concurrency, max_retries)
+            report.update({
+                'documents_unchanged': 0,
+                'documents_to_upload': report['documents_succeeded'] + report['documents_failed'],
+                'documents_to_delete': 0,
+                'index_rebuilt': 1,
+            })
+            return report
+        await self._ensure_fingerprint_field()
+        fingerprints = await self._get_index_fingerprints()
+        counts = {'documents_unchanged': 0, 'documents_to_upload': 0, 'documents_to_delete': 0, 'index_rebuilt': 0}
+
+        def iter_changed_documents() -> Iterator[Tuple[Dict[str, Any], int]]:
+            for document, document_bytes in self._iter_documents(embeddings_file):
+                if fingerprints.pop(document['embedId'], None) == document['fingerprint']:
+                    counts['documents_unchanged'] += 1
+                else:
+                    counts['documents_to_upload'] += 1
+                    yield document, document_bytes
+
+        def iter_actions() -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+            for batch in self._iter_batches(iter_changed_documents(), batch_size, max_batch_bytes):
+                yield 'upload', batch
+            stale_keys = fingerprints.keys()
+            counts['documents_to_delete'] = len(stale_keys)
+            for batch in self._iter_batches(
+                    (({'embedId': key}, 0) for key in sorted(stale_keys)), batch_size, max_batch_bytes):
+                yield 'delete', batch
+
+        report = await self._send_batches(iter_actions(), concurrency, max_retries)
+        report.update(counts)
+        if counts['documents_to_upload']:
+            self._mark_index_cold()
+        if counts['documents_to_upload'] or counts['documents_to_delete']:
+            self.invalidate_cache()
+        return report
+
+    async def _get_index_fingerprints(self) -> Dict[str, Optional[str]]:
+        """
+        Get the keys and fingerprints of all documents in the index.
+
+        The keys are read in pages ordered by the key, every page starts after the last key of
+        the previous one, so the number of documents is not limited by the skip limit of search.
+
+        :return: The fingerprints of the documents by key, None for the documents without it.
+        :raises: ValueError if the key field of the index is not filterable and sortable.
+        """
+        fingerprints: Dict[str, Optional[str]] = {}
+        last_key = None
+        while True:
+            key_filter = None
+            if last_key is not None:
+                escaped_key = last_key.replace("'", "''")
+                key_filter = f"embedId gt '{escaped_key}'"
+            try:
+                response = await self._get_client().search(
+                    search_text='*',
+                    filter=key_filter,
+                    order_by=['embedId asc'],
+                    select=['embedId', 'fingerprint'],
+                    top=SearchIndexManager.KEY_PAGE_SIZE)
+                page = [document async for document in response]
+            except HttpResponseError as e:
+                if e.status_code == 400:
+                    raise ValueError(
+                        "The key field embedId must be filterable and sortable to synchronize the index, "
+                        f"please recreate the index with create_index: {e}") from e
+                raise
+            for document in page:
+                fingerprints[document['embedId']] = document.get('fingerprint')
+            if len(page) < SearchIndexManager.KEY_PAGE_SIZE:
+                return fingerprints
+            last_key = page[-1]['embedId']
+
+    @staticmethod
+    def _get_schema_version(index: SearchIndex) -> int:
+        """
+        Get the schema version of the index from its fields.
+
+        :param index: The index definition.
+        :return: 1 if the key field is not filterable or not sortable, SCHEMA_VERSION otherwise.
+        """
+        key_field = next(field for field in index.fields if field.key)
+        if not (key_field.filterable and key_field.sortable):
+            return 1
+        return SearchIndexManager.SCHEMA_VERSION
+
+    async def _rebuild_index(self) -> bool:
+        """
+        Recreate the index of the older schema version with the same number of dimensions.
+
+        The attributes of the key field cannot be changed in place, so the index is deleted
+        and created again. If another application instance has already recreated it,
+        that index is used instead.
+
+        :return: True if the index was recreated and is empty, False if another instance has recreated it.
+        """
+        dimensions = next(
+            field.vector_search_dimensions for field in self._index.fields if field.name == 'embedding')
+        logger.warning(
+            f"The index {self._index.name} has the schema version "
+            f"{SearchIndexManager._get_schema_version(self._index)}, recreating it with the version "
+            f"{SearchIndexManager.SCHEMA_VERSION}.")
+        async with SearchIndexClient(
+                endpoint=self._endpoint, credential=self._credential, **self._client_kwargs) as ix_client:
+            try:
+                await ix_client.delete_index(self._index.name)
+            except ResourceNotFoundError:
+                pass
+        self.invalidate_cache()
+        try:
+            self._index = await self._index_create(dimensions)
+        except HttpResponseError:
+            async with SearchIndexClient(
+                    endpoint=self._endpoint, credential=self._credential, **self._client_kwargs) as ix_client:
+                self._index = await ix_client.get_index(self._index_name)
+            return False
+        self._mark_index_cold()
+        return True
+
+    async def _ensure_fingerprint_field(self) -> None:
+        """Add the fingerprint field to the index, created before the field was introduced."""
+        if any(field.name == 'fingerprint' for field in self._index.fields):
+            return
+        self._index.fields.append(SearchIndexManager._get_fingerprint_field())
+        async with SearchIndexClient(
+                endpoint=self._endpoint, credential=self._credential, **self._client_kwargs) as ix_client:
+            self._index = await ix_client.create_or_update_index(self._index)
+
+    async def _send_batches(
+            self,
+            batches: Iterable[Tuple[str, List[Dict[str, Any]]]],
+            concurrency: int,
+            max_retries: int
+        ) -> Dict[str, int]:
+        """
+        Send the batches of index actions with bounded concurrency.
+
+        The batches are consumed lazily, at most concurrency batches are waiting in the queue.
+
+        :param batches: The iterable of the action name ('upload', 'merge' or 'delete') and the documents.
+        :param concurrency: The maximal number of requests in flight.
+        :param max_retries: The number of retries for the failed batch.
+        :return: The report with the number of succeeded and failed batches and documents.
+        """
+        report = {
+            'batches_succeeded': 0,
+            'batches_failed': 0,
+            'documents_succeeded': 0,
+            'documents_failed': 0,
+        }
+        queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+
+        async def index_worker() -> None:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                action, batch = item
+                failed = await self._send_batch(action, batch, max_retries)
+                report['batches_failed' if failed else 'batches_succeeded'] += 1
+                report['documents_failed'] += failed
+                report['documents_succeeded'] += len(batch) - failed
+
+        workers = [asyncio.create_task(index_worker()) for _ in range(concurrency)]
+        try:
+            for item in batches:
+                await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        return report
+
+    def _iter_documents(self, embeddings_file: str) -> Iterator[Tuple[Dict[str, Any], int]]:
+        """
+        Read the documents from the embeddings file one by one.
+
+        If the file does not contain embedId, the key is derived from the document title and text
+        in the same way as by build_embeddings_file. The fingerprint is derived from the text and
+        the embedding model and dimensions, recorded in the manifest of the file, if it exists.
+
+        :param embeddings_file: The embeddings file to read, CSV or binary.
+        :return: The iterator over the documents and their approximate serialized sizes.
+        """
+        manifest = read_manifest(embeddings_file) or {}
+        model = manifest.get('model') or self._embedding_model
+        occurrences: Dict[Tuple[str, str], int] = collections.Counter()
+        for row in iter_embeddings(embeddings_file):
+            embed_id = row.get('embedId')
+            if not embed_id:
+                occurrence_key = (row['title'], row['token'])
+                embed_id = SearchIndexManager._get_chunk_id(row['title'], row['token'], occurrences[occurrence_key])
+                occurrences[occurrence_key] += 1
+            document = {
+                'embedId': embed_id,
+                'token': row['token'],
+                'embedding': row['embedding'],
+                'title': row['title'],
+                'fingerprint': SearchIndexManager._get_fingerprint(
+                    row['title'], row['token'], model, len(row['embedding'])),
+            }
+            yield document, SearchIndexManager._BYTES_PER_FLOAT * len(row['embedding']) + len(
+                row['token']) + len(row['title'])
+
+    @staticmethod
+    def _iter_batches(
+            documents: Iterator[Tuple[Dict[str, Any], int]],
+            batch_size: int,
+            max_batch_bytes: int
+        ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Group the documents into batches.
+
+        :param documents: The iterator over the documents and their sizes.
+        :param batch_size: The maximal number of documents in the batch.
+        :param max_batch_bytes: The approximate maximal size of the batch. The document,
+                                larger than this size, is sent in its own batch.
+        :return: The iterator over the batches.
+        """
+        batch = []
+        batch_bytes = 0
+        for document, document_bytes in documents:
+            if batch and (len(batch) >= batch_size or batch_bytes + document_bytes > max_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(document)
+            batch_bytes += document_bytes
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _get_fingerprint(title: str, token: str, model: Optional[str], dimensions: int) -> str:
+        """
+        Get the fingerprint of the document, which changes if the document must be uploaded again.
+
+        :param title: The name of the source document.
+        :param token: The text of the document.
+        :param model: The embedding model.
+        :param dimensions: The number of dimensions of the embedding.
+        :return: The hash of the text, the model and the dimensions.
+        """
+        return hashlib.sha256(f"{model}\n{dimensions}\n{title}\n{token}".encode('utf-8')).hexdigest()[:32]
+
+    @staticmethod
+    def _get_fingerprint_field() -> SimpleField:
+        """
+        Get the index field with the document fingerprint.
+
+        :return: The field definition.
+        """
+        return SimpleField(name="fingerprint", type=SearchFieldDataType.String)
+
+    @staticmethod
+    def _is_transient(error: Exception) -> bool:
+        """
+        Check if the failed request may succeed if it is retried.
+
+        :param error: The error of the request.
+        :return: True for the throttling, server, connection and timeout errors.
+        """
+        if isinstance(error, HttpResponseError):
+            return error.status_code in SearchIndexManager._RETRIABLE_STATUS_CODES
+        return isinstance(error, (ServiceRequestError, ServiceResponseError, asyncio.TimeoutError))
+
+    async def _send_batch(self, action: str, batch: List[Dict[str, Any]], max_retries: int) -> int:
+        """
+        Send one batch, retrying the transient errors and the documents which were not indexed.
+
+        The errors, which will not go away on retry, such as the authorization or schema
+        errors, fail the batch at once. The last error of the failed batch is logged.
+
+        :param action: The index action: 'upload', 'merge' or 'delete'.
+        :param batch: The documents to send.
+        :param max_retries: The number of retries.
+        :return: The number of documents, which were not processed.
+        """
+        send = getattr(self._get_client(), f'{action}_documents')
+        pending = batch
+        for attempt in range(max_retries + 1):
+            if attempt:
+                await asyncio.sleep(SearchIndexManager.UPLOAD_RETRY_BACKOFF * 2 ** (attempt - 1))
+            try:
+                results = await send(pending)
+            except Exception as e:
+                if not SearchIndexManager._is_transient(e):
+                    logger.error(f"Failed to {action} the batch of {len(pending)} documents: {e}")
+                    return len(pending)
+                logger.warning(f"Transient error on {action} of the batch, attempt {attempt + 1}: {e}")
+                continue
+            pending = [document for document, result in zip(pending, results) if not result.succeeded]
+            if not pending:
+                return 0
+        logger.error(f"Failed to {action} {len(pending)} documents after {max_retries + 1} attempts")
+        return len(pending)
+
+    async def delete_documents(
+            self,
+            embed_ids: List[str],
+            batch_size: int = UPLOAD_BATCH_SIZE,
+            concurrency: int = UPLOAD_CONCURRENCY,
+            max_retries: int = UPLOAD_MAX_RETRIES,
+        ) -> Dict[str, int]:
+        """
+        Delete the documents from the index.
+
+        :param embed_ids: The keys of the documents to delete.
+        :param batch_size: The maximal number of documents in one request.
+        :param concurrency: The maximal number of requests in flight.
+        :param max_retries: The number of retries for the failed batch.
+        :return: The report with the number of succeeded and failed batches and documents.
+        """
+        self._raise_if_no_index()
+        batches = (
+            ('delete', [{'embedId': embed_id} for embed_id in embed_ids[i:i + batch_size]])
+            for i in range(0, len(embed_ids), batch_size))
+        report = await self._send_batches(batches, concurrency, max_retries)
+        self.invalidate_cache()
+        return report
+
+    def _mark_index_cold(self) -> None:
+        """Mark the index as not yet ready, so that the next searches wait for the documents."""
+        self._cold_until = time.monotonic() + self._readiness_timeout
+
+    def _is_index_cold(self) -> bool:
+        """
+        Return True if the index was recently created or populated and may not be searchable yet.
+
+        :return: True if the readiness window is still open.
+        """
+        if self._cold_until is None:
+            return False
+        if time.monotonic() >= self._cold_until:
+            self._cold_until = None
+            return False
+        return True
 
     def _raise_if_no_index(self) -> None:
         """
@@ -124,9 +565,12 @@ class SearchIndexManager:
     async def delete_index(self):
         """Delete the index from vector store."""
         self._raise_if_no_index()
-        async with SearchIndexClient(endpoint=self._endpoint, credential=self._credential) as ix_client:
+        async with SearchIndexClient(
+                endpoint=self._endpoint, credential=self._credential, **self._client_kwargs) as ix_client:
             await ix_client.delete_index(self._index.name)
         self._index = None
+        self._cold_until = None
+        self.invalidate_cache()
 
     def _check_dimensions(self, vector_index_dimensions: Optional[int] = None) -> int:
         """
@@ -153,46 +597,225 @@ class SearchIndexManager:
         :param response: The search results.
         :return: The formatted response string.
         """
-        results = [f"{result['token']}, source: {result['title']}" async for result in response]
-        return "\n------\n".join(results)
+        return SearchIndexManager._format_results([result async for result in response])
+
+    @staticmethod
+    def _format_results(results: Iterable[Dict]) -> str:
+        """
+        Format the found documents.
+
+        :param results: The documents with the token and title.
+        :return: The formatted response string.
+        """
+        return "\n------\n".join(f"{result['token']}, source: {result['title']}" for result in results)
 
-    async def semantic_search(self, message: str) -> str:
+    async def _search_when_ready(self, **kwargs: Any) -> str:
+        """
+        Run the search and format its results, waiting for the index if it is not ready yet.
+
+        Documents become searchable with a delay after the upload. While the index is cold
+        the empty results are retried with exponential backoff, without blocking the event
+        loop. On a warm index the search is performed exactly once.
+
+        :param kwargs: The parameters of SearchClient.search.
+        :return: The formatted response string.
+        """
+        backoff = self._readiness_backoff
+        while True:
+            response = await self._get_client().search(**kwargs)
+            result = await self._format_search_results(response)
+            if result:
+                self._cold_until = None
+                return result
+            if not self._is_index_cold():
+                return result
+            await asyncio.sleep(min(backoff, max(self._cold_until - time.monotonic(), 0)))
+            backoff = min(backoff * 2, SearchIndexManager.READINESS_MAX_BACKOFF)
+
+    def invalidate_cache(self) -> None:
+        """Drop the cached search results, it is called automatically when the index changes."""
+        if self._cache is not None:
+            self._cache.invalidate()
+
+    def cache_stats(self) -> Optional[Dict[str, int]]:
+        """
+        Get the search cache counters.
+
+        :return: The number of hits, misses, coalesced misses and evictions or None if the cache is disabled.
+        """
+        return self._cache.stats() if self._cache is not None else None
+
+    async def _cached_search(
+            self,
+            mode: str,
+            message: str,
+            k: Optional[int],
+            search: Callable[[], Awaitable[str]]
+        ) -> str:
+        """
+        Perform the search or return its cached result.
+
+        :param mode: The search mode, which is the part of the cache key.
+        :param message: The customer question.
+        :param k: The number of results, which is the part of the cache key.
+        :param search: The function, which performs the search and returns the formatted result.
+        :return: The formatted response string.
+        """
+        if self._cache is None:
+            return await search()
+        return await self._cache.get_or_load(SearchIndexManager._get_cache_key(mode, message, k), search)
+
+    @staticmethod
+    def _get_cache_key(mode: str, message: str, k: Optional[int]) -> Tuple[str, str, Optional[int]]:
+        """
+        Get the cache key of the search, the questions differing only in case and whitespace share it.
+
+        :param mode: The search mode.
+        :param message: The customer question.
+        :param k: The number of results.
+        :return: The cache key.
+        """
+        return mode, " ".join(message.split()).casefold(), k
+
+    async def semantic_search(self, message: str, k: Optional[int] = None) -> str:
         """
         Perform the semantic search on the search resource.
 
+        If the search backend was provided, its keyword search is used.
+
         :param message: The customer question.
+        :param k: The number of results to return, by default the service decides.
         :return: The context for the question.
         """
+        if self._backend is not None:
+            return await self._cached_search(
+                'semantic', message, k,
+                lambda: self._backend_search(self._backend.keyword_search(message, k)))
         self._raise_if_no_index()
-        response = await self._get_client().search(
-            search_text=message,
-            query_type="full",
-            search_fields=['token', 'title'],
-            semantic_configuration_name=SearchIndexManager._SEMANTIC_CONFIG,
+        search_parameters = {'top': k} if k is not None else {}
+        return await self._cached_search(
+            'semantic',
+            message,
+            k,
+            lambda: self._search_when_ready(
+                search_text=message,
+                query_type="full",
+                search_fields=['token', 'title'],
+                semantic_configuration_name=SearchIndexManager._SEMANTIC_CONFIG,
+                **search_parameters
+            )
         )
-        return await self._format_search_results(response)
-        
 
-    async def search(self, message: str) -> str:
+    async def search(self, message: str, k: int = 5) -> str:
         """
         Search the message in the vector store.
 
+        If the search backend was provided, its vector search is used.
+
         :param message: The customer question.
+        :param k: The number of the nearest neighbours to return.
         :return: The context for the question.
         """
+        return await self._vector_search(message, k)
+
+    async def _vector_search(self, message: str, k: int, vector: Optional[List[float]] = None) -> str:
+        """
+        Search the message in the vector store, using its embedding if it was already built.
+
+        :param message: The customer question.
+        :param k: The number of the nearest neighbours to return.
+        :param vector: The embedding of the message. If it is absent, the index vectorizer builds it.
+        :return: The context for the question.
+        """
+        if self._backend is not None:
+            return await self._cached_search(
+                'vector', message, k,
+                lambda: self._backend_search(self._backend.vector_search(message, k)))
         self._raise_if_no_index()
-        vector_query = VectorizableTextQuery(
-            text=message,
-            k_nearest_neighbors=5,
-            fields="embedding"
-        )
-        response = await self._get_client().search(
-            vector_queries=[vector_query],
-            select=['token', 'title'],
+        if vector is not None:
+            vector_query = VectorizedQuery(vector=vector, k_nearest_neighbors=k, fields="embedding")
+        else:
+            vector_query = VectorizableTextQuery(
+                text=message,
+                k_nearest_neighbors=k,
+                fields="embedding"
+            )
+        return await self._cached_search(
+            'vector',
+            message,
+            k,
+            lambda: self._search_when_ready(
+                vector_queries=[vector_query],
+                select=['token', 'title'],
+            )
         )
-        # This lag is necessary, despite it is not described in documentation.
-        time.sleep(1)
-        return await self._format_search_results(response)
+
+    async def search_many(
+            self,
+            messages: Sequence[str],
+            k: int = 5,
+            concurrency: int = SEARCH_CONCURRENCY
+        ) -> List[Union[str, Exception]]:
+        """
+        Search several messages in the vector store at once.
+
+        If the embedding client was provided, the messages, which are not cached, are embedded
+        in one request and the index vectorizer is bypassed. If this request fails, the index
+        vectorizer is used for every message. The searches run concurrently, so the total
+        latency is close to the latency of the slowest one.
+
+        :param messages: The customer questions.
+        :param k: The number of the nearest neighbours to return for every question.
+        :param concurrency: The maximal number of searches in flight.
+        :return: The context for every question in the order of messages. If the search
+                 of a question failed, its exception is returned in its place.
+        """
+        if self._backend is None:
+            self._raise_if_no_index()
+        vectors = await self._embed_queries(messages, k)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def search_one(message: str) -> str:
+            async with semaphore:
+                return await self._vector_search(message, k, vectors.get(message))
+
+        return await asyncio.gather(*[search_one(message) for message in messages], return_exceptions=True)
+
+    async def _embed_queries(self, messages: Sequence[str], k: int) -> Dict[str, List[float]]:
+        """
+        Embed the distinct messages, which results are not cached, in one request.
+
+        :param messages: The customer questions.
+        :param k: The number of the nearest neighbours, which is the part of the cache key.
+        :return: The embeddings by message. It is empty if there is no embedding client,
+                 the search backend is used or the request failed.
+        """
+        if self._embedding_client is None or self._backend is not None:
+            return {}
+        texts = []
+        for message in dict.fromkeys(messages):
+            if self._cache is None or not self._cache.get(SearchIndexManager._get_cache_key('vector', message, k))[0]:
+                texts.append(message)
+        if not texts:
+            return {}
+        try:
+            response = await self._embedding_client.embed(
+                input=texts,
+                dimensions=self._dimensions,
+                model=self._embedding_model
+            )
+        except Exception:
+            return {}
+        return {text: float_data['embedding'] for text, float_data in zip(texts, response["data"])}
+
+    async def _backend_search(self, results: Awaitable[List[Dict[str, Any]]]) -> str:
+        """
+        Await the search backend results and format them.
+
+        :param results: The awaitable search backend results.
+        :return: The formatted response string.
+        """
+        return SearchIndexManager._format_results(await results)
 
     async def create_index(
         self,
@@ -217,11 +840,14 @@ class SearchIndexManager:
         vector_index_dimensions = self._check_dimensions(vector_index_dimensions)
         try:
             self._index = await self._index_create(vector_index_dimensions)
+            self._mark_index_cold()
+            self.invalidate_cache()
             return True
         except HttpResponseError:
             if raise_on_error:
                 raise
-            async with SearchIndexClient(endpoint=self._endpoint, credential=self._credential) as ix_client:
+            async with SearchIndexClient(
+                    endpoint=self._endpoint, credential=self._credential, **self._client_kwargs) as ix_client:
                 self._index = await ix_client.get_index(self._index_name)
             return False
         
@@ -238,9 +864,12 @@ class SearchIndexManager:
                https://platform.openai.com/docs/models#embeddings
         :return: The newly created search index.
         """
-        async with SearchIndexClient(endpoint=self._endpoint, credential=self._credential) as ix_client:
+        async with SearchIndexClient(
+                endpoint=self._endpoint, credential=self._credential, **self._client_kwargs) as ix_client:
             fields = [
-                SimpleField(name="embedId", type=SearchFieldDataType.String, key=True),
+                # The key is filterable and sortable to enumerate the documents page by page.
+                SimpleField(
+                    name="embedId", type=SearchFieldDataType.String, key=True, filterable=True, sortable=True),
                 SearchField(
                     name="embedding",
                     type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
@@ -250,6 +879,7 @@ class SearchIndexManager:
                 ),
                 SearchField(name="token", searchable=True, type=SearchFieldDataType.String, hidden=False),
                 SearchField(name="title", type=SearchFieldDataType.String, hidden=False),
+                SearchIndexManager._get_fingerprint_field(),
             ]
             vector_search = VectorSearch(
                 profiles=[
@@ -300,20 +930,78 @@ class SearchIndexManager:
             input_directory: str,
             output_file: str,
             sentences_per_embedding: int=4,
-            ) -> None:
+            batch_size: int=EMBEDDING_BATCH_SIZE,
+            concurrency: int=EMBEDDING_CONCURRENCY,
+            incremental: bool=False,
+            ) -> List[str]:
         """
         In this method we do lazy loading of nltk and download the needed data set to split
 
         document into tokens. This operation takes time that is why we hide import nltk under this
         method. We also do not include nltk into requirements because this method is only used
         during rag generation.
+        Every chunk gets the embedId, derived from the source file and its text, the repeated
+        texts of the file are numbered. The chunk identifiers are kept in the manifest next to the output file.
+        In the incremental mode the embeddings of the chunks, which are present in the previous
+        output file, are reused and only new or changed chunks are sent to the embedding model.
         :param dimensions: The number of dimensions in the embeddings. Must be the same as
                the one used for SearchIndexManager creation.
         :param input_directory: The directory with the embedding files.
-        :param output_file: The file csv file to store embeddings.
+        :param output_file: The file to store embeddings, the binary format is used if the file
+               has the .f32 extension, otherwise the csv format is used (see embeddings_store).
         :param embeddings_client: The embedding client, used to create embeddings. 
                 Must be the same as the one used for SearchIndexManager creation.
         :param sentences_per_embedding: The number of sentences used to build embedding.
+        :param batch_size: The number of texts sent in one embedding request.
+        :param concurrency: The maximal number of embedding requests in flight.
+        :param incremental: Reuse the embeddings of the unchanged chunks from the previous output file.
+        :return: The embedIds of the chunks from the previous manifest, which no longer exist.
+                 If the index was created or loaded, these documents are deleted from it.
+        """
+        sentence_tokens, references, embed_ids = self._split_documents(input_directory, sentences_per_embedding)
+
+        manifest = {
+            'model': self._embedding_model,
+            'dimensions': self._dimensions,
+            'sentences_per_embedding': sentences_per_embedding,
+            'files': {},
+        }
+        for reference, embed_id in zip(references, embed_ids):
+            manifest['files'].setdefault(reference, []).append(embed_id)
+        previous_manifest = read_manifest(output_file) or {'files': {}}
+        known_embeddings = {}
+        if incremental and all(
+                previous_manifest.get(key) == manifest[key]
+                for key in ('model', 'dimensions', 'sentences_per_embedding')):
+            required = set(embed_ids)
+            known_embeddings = {
+                row['embedId']: row['embedding'] for row in iter_embeddings(output_file)
+                if row.get('embedId') in required}
+
+        # For each token build the embedding, which will be used in the search.
+        await self._write_embeddings(
+            sentence_tokens, references, output_file, batch_size, concurrency, embed_ids, known_embeddings)
+        write_manifest(output_file, manifest)
+
+        previous_ids = [
+            embed_id for file_ids in previous_manifest['files'].values() for embed_id in file_ids]
+        current_ids = set(embed_ids)
+        stale_ids = [embed_id for embed_id in previous_ids if embed_id not in current_ids]
+        if stale_ids and self._index is not None:
+            await self.delete_documents(stale_ids)
+        return stale_ids
+
+    def _split_documents(
+            self,
+            input_directory: str,
+            sentences_per_embedding: int
+        ) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Split the markdown files into chunks of sentences.
+
+        :param input_directory: The directory with the embedding files.
+        :param sentences_per_embedding: The number of sentences in one chunk.
+        :return: The tuple of chunk texts, their source file names and embedIds.
         """
         import nltk
         nltk.download('punkt')
@@ -322,9 +1010,13 @@ class SearchIndexManager:
         # Split the data to sentence tokens.
         sentence_tokens = []
         references = []
+        embed_ids = []
         globs = glob.glob(input_directory + '/*.md', recursive=True)
-        index = 0
         for fle in globs:
+            reference = os.path.split(fle)[-1]
+            first_chunk = len(sentence_tokens)
+            # The chunks never span several files.
+            index = 0
             with open(fle) as f:
                 for line in f:
                     line = line.strip()
@@ -334,31 +1026,155 @@ class SearchIndexManager:
                     for sentence in sent_tokenize(line):
                         if index % sentences_per_embedding == 0:
                             sentence_tokens.append(sentence)
-                            references.append(os.path.split(fle)[-1])
+                            references.append(reference)
                         else:
                             sentence_tokens[-1] += ' '
                             sentence_tokens[-1] += sentence
                         index += 1
-        
-        
-        # For each token build the embedding, which will be used in the search.
-        batch_size = 2000
-        with open(output_file, 'w') as fp:
-            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
-            writer.writeheader()
-            for i in range(0, len(sentence_tokens), batch_size):
-                emedding = (await self._embedding_client.embed(
-                    input=sentence_tokens[i:i+min(batch_size, len(sentence_tokens))],
+            embed_ids.extend(SearchIndexManager._get_chunk_ids(reference, sentence_tokens[first_chunk:]))
+        return sentence_tokens, references, embed_ids
+
+    @staticmethod
+    def _get_chunk_id(reference: str, token: str, occurrence: int = 0) -> str:
+        """
+        Get the identifier of the chunk, which is stable between the runs.
+
+        The identifier does not depend on the chunk position, so inserting or removing a chunk
+        does not change the identifiers of the other chunks of the file.
+
+        :param reference: The name of the source file.
+        :param token: The text of the chunk.
+        :param occurrence: The number of the previous chunks with the same text in the source file.
+        :return: The identifier, which can be used as the document key in the index.
+        """
+        return hashlib.sha256(f"{reference}\n{occurrence}\n{token}".encode('utf-8')).hexdigest()[:32]
+
+    @staticmethod
+    def _get_chunk_ids(reference: str, tokens: Iterable[str]) -> List[str]:
+        """
+        Get the identifiers of the chunks of one source file.
+
+        :param reference: The name of the source file.
+        :param tokens: The texts of the chunks in the order of the file.
+        :return: The identifiers in the order of the texts.
+        """
+        occurrences: Dict[str, int] = collections.Counter()
+        embed_ids = []
+        for token in tokens:
+            embed_ids.append(SearchIndexManager._get_chunk_id(reference, token, occurrences[token]))
+            occurrences[token] += 1
+        return embed_ids
+
+    async def _write_embeddings(
+            self,
+            sentence_tokens: List[str],
+            references: List[str],
+            output_file: str,
+            batch_size: int,
+            concurrency: int,
+            embed_ids: Optional[List[str]] = None,
+            known_embeddings: Optional[Dict[str, List[float]]] = None,
+        ) -> int:
+        """
+        Build the embeddings for the texts and write them to the file.
+
+        Up to concurrency batches are embedded at once, while the results are written
+        in the order of the texts as soon as the earliest pending batch is ready.
+
+        :param sentence_tokens: The texts to be embedded.
+        :param references: The names of the source documents of the texts.
+        :param output_file: The file to store embeddings.
+        :param batch_size: The number of texts sent in one embedding request.
+        :param concurrency: The maximal number of embedding requests in flight.
+        :param embed_ids: The identifiers of the texts.
+        :param known_embeddings: The embeddings, which were already built, by the text identifier.
+        :return: The number of texts sent to the embedding model.
+        """
+        embed_ids = embed_ids or [None] * len(sentence_tokens)
+        known_embeddings = known_embeddings or {}
+        missing = [i for i, embed_id in enumerate(embed_ids) if embed_id not in known_embeddings]
+        pending = collections.deque()
+        offsets = iter(range(0, len(missing), batch_size))
+        next_row = 0
+        try:
+            with EmbeddingsWriter(output_file) as writer:
+
+                def write_rows(end: int, embedding: Optional[List[float]] = None) -> None:
+                    """Write the known embeddings before end and then the new embedding at end."""
+                    nonlocal next_row
+                    for i in range(next_row, end):
+                        writer.write(
+                            token=sentence_tokens[i], title=references[i],
+                            embedding=known_embeddings[embed_ids[i]], embed_id=embed_ids[i])
+                    next_row = end
+                    if embedding is not None:
+                        writer.write(
+                            token=sentence_tokens[end], title=references[end],
+                            embedding=embedding, embed_id=embed_ids[end])
+                        next_row = end + 1
+
+                while True:
+                    for offset in offsets:
+                        pending.append((offset, asyncio.create_task(self._embed_batch(
+                            [sentence_tokens[i] for i in missing[offset:offset + batch_size]]))))
+                        if len(pending) >= concurrency:
+                            break
+                    if not pending:
+                        break
+                    offset, task = pending.popleft()
+                    embeddings = await task
+                    for i, embedding in zip(missing[offset:offset + batch_size], embeddings):
+                        write_rows(i, embedding)
+                write_rows(len(sentence_tokens))
+        finally:
+            for _, task in pending:
+                task.cancel()
+        return len(missing)
+
+    async def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed the batch of texts, retrying throttled and transient errors.
+
+        :param texts: The texts to be embedded.
+        :return: The embeddings in the order of the texts.
+        :raises: HttpResponseError if the request was not successful after all retries.
+        """
+        for attempt in range(SearchIndexManager.EMBEDDING_MAX_RETRIES + 1):
+            try:
+                response = await self._embedding_client.embed(
+                    input=texts,
                     dimensions=self._dimensions,
                     model=self._embedding_model
-                ))["data"]
-                for token, float_data, reference in zip(sentence_tokens, emedding, references):
-                    writer.writerow({
-                        'token': token,
-                        'embedding': json.dumps(float_data['embedding']),
-                        'title': reference})
+                )
+                return [float_data['embedding'] for float_data in response["data"]]
+            except HttpResponseError as e:
+                if (e.status_code not in SearchIndexManager._RETRIABLE_STATUS_CODES
+                        or attempt == SearchIndexManager.EMBEDDING_MAX_RETRIES):
+                    raise
+                await asyncio.sleep(self._get_retry_delay(e, attempt))
+
+    @staticmethod
+    def _get_retry_delay(error: HttpResponseError, attempt: int) -> float:
+        """
+        Get the delay before the next retry, honoring the retry-after headers of the response.
+
+        :param error: The error returned by the service.
+        :param attempt: The zero based number of the failed attempt.
+        :return: The delay in seconds.
+        """
+        headers = error.response.headers if error.response is not None else {}
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000
+            if headers.get('retry-after'):
+                return float(headers['retry-after'])
+        except ValueError:
+            pass
+        return SearchIndexManager.EMBEDDING_RETRY_BACKOFF * 2 ** attempt
 
     async def close(self):
         """Close the closeable resources, associated with SearchIndexManager."""
         if self._client:
             await self._client.close()
+        if self._backend is not None:
+            await self._backend.close()
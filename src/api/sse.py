@@ -0,0 +1,211 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+The encoder of the server-sent events.
+
+The events are encoded to bytes, which are sent to the client without further conversion.
+The message deltas, which are the most frequent events, are encoded by gluing the
+precomputed prefix and suffix around the JSON string of the text, without building and
+serializing the dictionary. The orjson package is used if it is installed.
+"""
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Dict, List, Optional
+
+import asyncio
+import json
+import time
+
+try:
+    import orjson
+
+    def _dumps(data: Any) -> bytes:
+        return orjson.dumps(data)
+except ModuleNotFoundError:
+    def _dumps(data: Any) -> bytes:
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+_DATA_PREFIX = b"data: "
+_EVENT_SUFFIX = b"\n\n"
+_DELTA_PREFIX = _DATA_PREFIX + b'{"content":'
+_DELTA_SUFFIX = b',"type":"message"}' + _EVENT_SUFFIX
+
+
+def encode_event(data: Dict[str, Any]) -> bytes:
+    """
+    Encode the event with the JSON data.
+
+    :param data: The event data.
+    :return: The encoded event.
+    """
+    return _DATA_PREFIX + _dumps(data) + _EVENT_SUFFIX
+
+
+def encode_message_delta(text: str) -> bytes:
+    """
+    Encode the message delta event, equal to encode_event({'content': text, 'type': 'message'}).
+
+    :param text: The text of the delta.
+    :return: The encoded event.
+    """
+    return _DELTA_PREFIX + _dumps(text) + _DELTA_SUFFIX
+
+
+def encode_event_id(event_id: str) -> bytes:
+    """
+    Encode the identifier field, which is put before the data of the event.
+
+    :param event_id: The event identifier without line breaks.
+    :return: The encoded field.
+    """
+    return b"id: " + event_id.encode('utf-8') + b"\n"
+
+
+def split_events(chunk: bytes) -> List[bytes]:
+    """
+    Split the encoded chunk into the separate events, so that each of them gets its own identifier.
+
+    :param chunk: One or more encoded events.
+    :return: The list of the encoded events.
+    """
+    if chunk.count(_EVENT_SUFFIX) <= 1:
+        return [chunk]
+    parts = chunk.split(_EVENT_SUFFIX)
+    events = [part + _EVENT_SUFFIX for part in parts[:-1]]
+    if parts[-1]:
+        events.append(parts[-1])
+    return events
+
+
+def encode_comment(text: str) -> bytes:
+    """
+    Encode the comment, which is ignored by the clients but flushes the connection.
+
+    :param text: The comment text without line breaks.
+    :return: The encoded comment.
+    """
+    return b": " + text.encode('utf-8') + _EVENT_SUFFIX
+
+
+class DeltaCoalescer:
+    """
+    The buffer, which joins the message deltas into fewer, larger events.
+
+    The buffered text is released when the interval has passed since the first buffered delta,
+    when the buffer reaches the size limit, or when the caller flushes it before the next
+    event of another type. The zero interval and size release every delta immediately.
+    The deltas are only checked when they arrive, so the stream is read with flush_when_idle
+    to release the text, which is due while the model pauses.
+
+    :param interval: The maximal number of seconds the delta is held in the buffer.
+    :param max_chars: The number of the buffered characters, at which the text is released.
+    :param clock: The monotonic clock, used in tests.
+    """
+
+    def __init__(
+            self,
+            interval: float = 0.0,
+            max_chars: int = 0,
+            clock: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        self._interval = interval
+        self._max_chars = max_chars
+        self._clock = clock
+        self._parts: List[str] = []
+        self._size = 0
+        self._started: Optional[float] = None
+        self.events = 0
+        self.deltas = 0
+
+    @property
+    def interval(self) -> float:
+        """The maximal number of seconds the delta is held in the buffer, 0 if it is not limited."""
+        return self._interval
+
+    @property
+    def enabled(self) -> bool:
+        """True if the deltas are joined."""
+        return self._interval > 0 or self._max_chars > 0
+
+    def add(self, text: str) -> Optional[bytes]:
+        """
+        Add the delta to the buffer.
+
+        :param text: The text of the delta.
+        :return: The encoded event with all buffered text if it is due, None otherwise.
+        """
+        self.deltas += 1
+        if not self.enabled:
+            self.events += 1
+            return encode_message_delta(text)
+        if not self._parts:
+            self._started = self._clock()
+        self._parts.append(text)
+        self._size += len(text)
+        if ((self._max_chars and self._size >= self._max_chars)
+                or (self._interval and self._clock() - self._started >= self._interval)):
+            return self.flush()
+        return None
+
+    def due_in(self) -> Optional[float]:
+        """
+        Get the time left until the buffered text is due.
+
+        :return: The number of seconds, 0 if the text is overdue, or None if the buffer is empty
+                 or the deltas are not held for the interval.
+        """
+        if not self._parts or not self._interval:
+            return None
+        return max(0.0, self._started + self._interval - self._clock())
+
+    def flush(self) -> Optional[bytes]:
+        """
+        Release the buffered text.
+
+        :return: The encoded event with all buffered text or None if the buffer is empty.
+        """
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        self._started = None
+        self.events += 1
+        return encode_message_delta(text)
+
+
+async def flush_when_idle(events: AsyncIterator[bytes], coalescer: DeltaCoalescer) -> AsyncGenerator[bytes, None]:
+    """
+    Pass the events through, releasing the buffered deltas when no event arrives in time.
+
+    The next event is awaited in the task, which is not cancelled when the buffered text is
+    due, so the source is never interrupted in the middle of reading. While the buffer is
+    empty, the source is checked every interval, so the text is held at most twice the interval.
+
+    :param events: The encoded events, produced while the deltas are added to the coalescer.
+    :param coalescer: The buffer of the deltas.
+    :return: The events and the buffered text, released while the source is idle.
+    """
+    if not coalescer.interval:
+        async for event in events:
+            yield event
+        return
+    next_event: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(events.__anext__())
+            due_in = coalescer.due_in()
+            await asyncio.wait((next_event,), timeout=coalescer.interval if due_in is None else due_in)
+            if not next_event.done():
+                if coalescer.due_in() == 0:
+                    yield coalescer.flush()
+                continue
+            event, next_event = next_event, None
+            try:
+                data = event.result()
+            except StopAsyncIteration:
+                return
+            yield data
+    finally:
+        if next_event is not None:
+            next_event.cancel()
@@ -0,0 +1,157 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+The journal of the chat streams, shared by the workers on the same host.
+
+The gunicorn workers do not share memory and the requests are not routed to the worker,
+which has started the run, so the reconnecting client usually reaches another worker.
+The worker, which runs the stream, appends its events to the SQLite database and the
+other worker replays them to the client and follows the run from there. The reading
+worker records when and up to which event it has read the stream, so the running worker
+keeps the run while the client is attached elsewhere and does not read the upstream too
+far ahead of it. The replicas on the other hosts do not share the journal.
+"""
+from typing import List, Optional, Tuple
+
+import asyncio
+import contextlib
+import os
+import sqlite3
+import tempfile
+import time
+
+# The events of the stream as the pairs of the event number and the encoded event.
+Events = List[Tuple[int, bytes]]
+
+
+class StreamJournal:
+    """
+    The events of the running and recently finished streams in the SQLite database.
+
+    :param path: The path to the SQLite database.
+    :param ttl: The number of seconds the stream is kept after it was started.
+    """
+
+    DEFAULT_PATH = os.path.join(tempfile.gettempdir(), "azureaiapp-streams.sqlite3")
+    DEFAULT_TTL = 3600.0
+    # The number of seconds between the reads of the stream, which is followed from another worker.
+    POLL_INTERVAL = 0.05
+    # The number of seconds between the writes of the running stream, which has no new events.
+    HEARTBEAT_INTERVAL = 1.0
+    # The maximal number of the events read at once.
+    READ_LIMIT = 256
+
+    def __init__(self, path: str = DEFAULT_PATH, ttl: float = DEFAULT_TTL) -> None:
+        """Constructor."""
+        self._path = path
+        self._ttl = ttl
+        with self._connect() as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS streams ("
+                "stream_id TEXT PRIMARY KEY, thread_id TEXT NOT NULL, finished INTEGER NOT NULL DEFAULT 0, "
+                "updated REAL NOT NULL, attached REAL, sent INTEGER NOT NULL DEFAULT 0, expires REAL NOT NULL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "stream_id TEXT NOT NULL, sequence INTEGER NOT NULL, data BLOB NOT NULL, "
+                "PRIMARY KEY (stream_id, sequence))")
+
+    def _connect(self) -> contextlib.closing:
+        """
+        Open the connection to the shared database.
+
+        :return: The connection, which is closed on exit from the context.
+        """
+        connection = sqlite3.connect(self._path, timeout=5.0)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return contextlib.closing(connection)
+
+    def _create(self, stream_id: str, thread_id: str) -> None:
+        """
+        Add the stream and delete the expired ones.
+
+        :param stream_id: The stream identifier.
+        :param thread_id: The thread of the run.
+        """
+        now = time.time()
+        with self._connect() as connection, connection:
+            connection.execute(
+                "DELETE FROM events WHERE stream_id IN (SELECT stream_id FROM streams WHERE expires < ?)", (now,))
+            connection.execute("DELETE FROM streams WHERE expires < ?", (now,))
+            connection.execute(
+                "INSERT OR REPLACE INTO streams (stream_id, thread_id, updated, expires) VALUES (?, ?, ?, ?)",
+                (stream_id, thread_id, now, now + self._ttl))
+
+    def _append(self, stream_id: str, events: Events, finished: bool) -> Tuple[Optional[float], int]:
+        """
+        Append the events of the stream.
+
+        :param stream_id: The stream identifier.
+        :param events: The new events.
+        :param finished: True if the stream has no more events.
+        :return: The time, when the stream was last read by another worker, and the last event read there.
+        """
+        with self._connect() as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO events (stream_id, sequence, data) VALUES (?, ?, ?)",
+                [(stream_id, sequence, data) for sequence, data in events])
+            connection.execute(
+                "UPDATE streams SET updated = ?, finished = ? WHERE stream_id = ?",
+                (time.time(), int(finished), stream_id))
+            row = connection.execute("SELECT attached, sent FROM streams WHERE stream_id = ?", (stream_id,)).fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    def _read(self, stream_id: str, thread_id: str, after: int) -> Optional[Tuple[Events, bool, float]]:
+        """
+        Read the events of the stream and record that the client has received the events up to after.
+
+        :param stream_id: The stream identifier.
+        :param thread_id: The thread of the client.
+        :param after: The number of the last event the client has received.
+        :return: The events after the given one, the flag showing if the stream has finished and the time
+                 of the last write, or None if the stream is not known or belongs to the other thread.
+        """
+        with self._connect() as connection, connection:
+            row = connection.execute(
+                "SELECT thread_id, finished, updated FROM streams WHERE stream_id = ?", (stream_id,)).fetchone()
+            if row is None or row[0] != thread_id:
+                return None
+            connection.execute(
+                "UPDATE streams SET attached = ?, sent = MAX(sent, ?) WHERE stream_id = ?",
+                (time.time(), after, stream_id))
+            events = connection.execute(
+                "SELECT sequence, data FROM events WHERE stream_id = ? AND sequence > ? ORDER BY sequence LIMIT ?",
+                (stream_id, after, StreamJournal.READ_LIMIT)).fetchall()
+        # The finished flag is read first, so all events of the finished stream are already written.
+        return [(sequence, bytes(data)) for sequence, data in events], bool(row[1]), row[2]
+
+    async def create(self, stream_id: str, thread_id: str) -> None:
+        """
+        Add the stream, which this worker runs.
+
+        :param stream_id: The stream identifier.
+        :param thread_id: The thread of the run.
+        """
+        await asyncio.to_thread(self._create, stream_id, thread_id)
+
+    async def append(self, stream_id: str, events: Events, finished: bool) -> Tuple[Optional[float], int]:
+        """
+        Append the events of the stream, which this worker runs.
+
+        :param stream_id: The stream identifier.
+        :param events: The new events, may be empty to show that the stream is still running.
+        :param finished: True if the stream has no more events.
+        :return: The time, when the stream was last read by another worker, and the last event read there.
+        """
+        return await asyncio.to_thread(self._append, stream_id, events, finished)
+
+    async def read(self, stream_id: str, thread_id: str, after: int) -> Optional[Tuple[Events, bool, float]]:
+        """
+        Read the events of the stream, which another worker runs.
+
+        :param stream_id: The stream identifier.
+        :param thread_id: The thread of the client.
+        :param after: The number of the last event the client has received.
+        :return: The events after the given one, the flag showing if the stream has finished and the time
+                 of the last write, or None if the stream is not known or belongs to the other thread.
+        """
+        return await asyncio.to_thread(self._read, stream_id, thread_id, after)
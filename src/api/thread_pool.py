@@ -0,0 +1,123 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from typing import Any, Dict, List, Optional
+
+import asyncio
+import collections
+import logging
+import time
+
+from azure.ai.agents.aio import AgentsClient
+from azure.ai.agents.models import AgentThread
+
+logger = logging.getLogger("azureaiapp")
+
+
+class WarmThreadPool:
+    """
+    The pool of the empty threads, created in advance for the new conversations.
+
+    The new conversation takes the ready thread instead of waiting for its creation, and the
+    pool is refilled in the background. If the pool is empty, the thread is created inline.
+
+    :param agent_client: The client used to create and delete the threads.
+    :param size: The number of the threads to keep ready, 0 disables the pool.
+    """
+
+    DEFAULT_SIZE = 2
+    REFILL_RETRY_DELAY = 5.0
+    CLOSE_TIMEOUT = 5.0
+
+    def __init__(self, agent_client: AgentsClient, size: int = DEFAULT_SIZE) -> None:
+        """Constructor."""
+        self._agent_client = agent_client
+        self._size = size
+        self._ready: collections.deque = collections.deque()
+        self._refill_needed = asyncio.Event()
+        self._refill_task: Optional[asyncio.Task] = None
+        self._hits = 0
+        self._misses = 0
+        self._created = 0
+        self._refill_failures = 0
+        self._refill_seconds = 0.0
+        self._last_refill_seconds = 0.0
+
+    def start(self) -> None:
+        """Start filling the pool in the background."""
+        if self._size > 0 and self._refill_task is None:
+            self._refill_task = asyncio.create_task(self._refill())
+            self._refill_needed.set()
+
+    async def acquire(self) -> AgentThread:
+        """
+        Take the ready thread or create the new one if the pool is empty.
+
+        :return: The empty thread, which is not given to anybody else.
+        """
+        if self._ready:
+            self._hits += 1
+            thread = self._ready.popleft()
+        else:
+            self._misses += 1
+            thread = await self._agent_client.threads.create()
+        self._refill_needed.set()
+        return thread
+
+    async def _refill(self) -> None:
+        """Create the threads while the pool is not full, then wait until a thread is taken."""
+        while True:
+            await self._refill_needed.wait()
+            self._refill_needed.clear()
+            while len(self._ready) < self._size:
+                start = time.perf_counter()
+                try:
+                    thread = await self._agent_client.threads.create()
+                except Exception as e:
+                    self._refill_failures += 1
+                    logger.warning(f"Failed to create the thread for the pool: {e}")
+                    await asyncio.sleep(WarmThreadPool.REFILL_RETRY_DELAY)
+                    continue
+                self._last_refill_seconds = time.perf_counter() - start
+                self._refill_seconds += self._last_refill_seconds
+                self._created += 1
+                self._ready.append(thread)
+
+    async def close(self) -> None:
+        """Stop the refill and delete the threads, which were not used."""
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+            self._refill_task = None
+        unused: List[AgentThread] = list(self._ready)
+        self._ready.clear()
+        if not unused:
+            return
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*[self._agent_client.threads.delete(thread.id) for thread in unused],
+                               return_exceptions=True),
+                WarmThreadPool.CLOSE_TIMEOUT)
+            failed = sum(isinstance(result, Exception) for result in results)
+            logger.info(f"Deleted {len(unused) - failed} unused threads, failed to delete {failed}")
+        except asyncio.TimeoutError:
+            logger.warning(f"Timed out deleting {len(unused)} unused threads")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the pool metrics.
+
+        :return: The dictionary with the number of ready threads, hits, misses, the hit rate,
+                 the number of created threads, refill failures and the refill latency in milliseconds.
+        """
+        acquired = self._hits + self._misses
+        return {
+            'size': len(self._ready),
+            'target_size': self._size,
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': self._hits / acquired if acquired else 0.0,
+            'created': self._created,
+            'refill_failures': self._refill_failures,
+            'refill_latency_ms': 1000 * self._refill_seconds / self._created if self._created else 0.0,
+            'last_refill_latency_ms': 1000 * self._last_refill_seconds,
+        }
@@ -0,0 +1,138 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+from typing import Dict, Optional, Tuple
+
+import asyncio
+import contextlib
+import os
+import sqlite3
+import tempfile
+import time
+
+
+class ThreadRegistry:
+    """
+    The registry of the threads, which this deployment has created or seen, by agent.
+
+    The known threads are trusted without requesting them from the service. The registry
+    is kept in memory and, if the path is provided, in the SQLite database, so that the
+    workers on the same host share it. If a trusted thread was deleted, the caller gets the
+    not found error on the first request to it and should forget the thread.
+
+    :param path: The path to the SQLite database, None keeps the registry in memory only.
+    :param ttl: The number of seconds the thread is trusted after it was seen.
+    """
+
+    DEFAULT_TTL = 24 * 3600.0
+    MAX_SIZE = 100000
+    DEFAULT_PATH = os.path.join(tempfile.gettempdir(), "azureaiapp-threads.sqlite3")
+
+    def __init__(self, path: Optional[str] = DEFAULT_PATH, ttl: float = DEFAULT_TTL) -> None:
+        """Constructor."""
+        self._path = path
+        self._ttl = ttl
+        # (thread_id, agent_id) -> expiration time.
+        self._known: Dict[Tuple[str, str], float] = {}
+        self._hits = 0
+        self._misses = 0
+        if self._path:
+            with self._connect() as connection, connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS threads ("
+                    "thread_id TEXT NOT NULL, agent_id TEXT NOT NULL, expires REAL NOT NULL, "
+                    "PRIMARY KEY (thread_id, agent_id))")
+
+    def _connect(self) -> contextlib.closing:
+        """
+        Open the connection to the shared database.
+
+        :return: The connection, which is closed on exit from the context.
+        """
+        connection = sqlite3.connect(self._path, timeout=5.0)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return contextlib.closing(connection)
+
+    def _load(self, thread_id: str, agent_id: str) -> Optional[float]:
+        """
+        Read the expiration time of the thread from the shared database.
+
+        :param thread_id: The thread identifier.
+        :param agent_id: The agent identifier.
+        :return: The expiration time or None if the thread is not there.
+        """
+        with self._connect() as connection, connection:
+            row = connection.execute(
+                "SELECT expires FROM threads WHERE thread_id = ? AND agent_id = ?", (thread_id, agent_id)).fetchone()
+        return row[0] if row else None
+
+    def _store(self, thread_id: str, agent_id: str, expires: Optional[float]) -> None:
+        """
+        Write the thread to the shared database or delete it from there.
+
+        :param thread_id: The thread identifier.
+        :param agent_id: The agent identifier, None deletes the thread for all agents.
+        :param expires: The expiration time, None deletes the thread.
+        """
+        with self._connect() as connection, connection:
+            if expires is None:
+                connection.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
+            else:
+                connection.execute(
+                    "INSERT OR REPLACE INTO threads (thread_id, agent_id, expires) VALUES (?, ?, ?)",
+                    (thread_id, agent_id, expires))
+                connection.execute("DELETE FROM threads WHERE expires < ?", (time.time(),))
+
+    async def is_known(self, thread_id: str, agent_id: str) -> bool:
+        """
+        Check if the thread of the agent was created or seen recently.
+
+        :param thread_id: The thread identifier.
+        :param agent_id: The agent identifier.
+        :return: True if the thread may be used without checking it.
+        """
+        key = (thread_id, agent_id)
+        expires = self._known.get(key)
+        if expires is None and self._path:
+            expires = await asyncio.to_thread(self._load, thread_id, agent_id)
+        if expires is None or expires <= time.time():
+            self._known.pop(key, None)
+            self._misses += 1
+            return False
+        self._known.setdefault(key, expires)
+        self._hits += 1
+        return True
+
+    async def remember(self, thread_id: str, agent_id: str) -> None:
+        """
+        Remember that the thread of the agent exists.
+
+        :param thread_id: The thread identifier.
+        :param agent_id: The agent identifier.
+        """
+        expires = time.time() + self._ttl
+        self._known.pop((thread_id, agent_id), None)
+        self._known[(thread_id, agent_id)] = expires
+        while len(self._known) > ThreadRegistry.MAX_SIZE:
+            # The dictionary keeps the insertion order, so the oldest thread is the first.
+            del self._known[next(iter(self._known))]
+        if self._path:
+            await asyncio.to_thread(self._store, thread_id, agent_id, expires)
+
+    async def forget(self, thread_id: str) -> None:
+        """
+        Forget the thread, which does not exist anymore.
+
+        :param thread_id: The thread identifier.
+        """
+        for key in [key for key in self._known if key[0] == thread_id]:
+            del self._known[key]
+        if self._path:
+            await asyncio.to_thread(self._store, thread_id, None, None)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the registry counters.
+
+        :return: The dictionary with the number of threads known to this worker, hits and misses.
+        """
+        return {'size': len(self._known), 'hits': self._hits, 'misses': self._misses}
@@ -0,0 +1,186 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+The builder of the vector store for the file search tool.
+
+The content of the files is identified by the SHA-256 hashes. The vector store gets the hash
+of all files in its metadata, so the store with the same files is reused without uploading
+anything. The local manifest maps the file names to the hashes and identifiers of the
+uploaded files, so only the new and changed files are uploaded when the store is rebuilt.
+"""
+from typing import Dict, List, Optional, Union
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+from azure.ai.agents.aio import AgentsClient
+from azure.ai.agents.models import FilePurpose
+
+from .embeddings_store import hash_file
+
+logger = logging.getLogger("azureaiapp")
+
+CONTENT_HASH_KEY = 'content_hash'
+DEFAULT_UPLOAD_CONCURRENCY = 8
+# The maximal number of files added to the vector store in one batch.
+FILE_BATCH_SIZE = 500
+
+
+def get_content_hash(file_hashes: Dict[str, str]) -> str:
+    """
+    Get the hash, which identifies the set of the files and their content.
+
+    :param file_hashes: The hashes of the files by file name.
+    :return: The hexadecimal hash.
+    """
+    return hashlib.sha256(json.dumps(sorted(file_hashes.items())).encode('utf-8')).hexdigest()
+
+
+def read_manifest(path: Optional[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Read the manifest of the uploaded files.
+
+    :param path: The path to the manifest, None if the manifest is not used.
+    :return: The dictionary with the 'sha256' and 'id' of the uploaded files by file name.
+    """
+    if not path or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, encoding='utf-8') as fp:
+            return json.load(fp)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring the invalid manifest {path}: {e}")
+        return {}
+
+
+def write_manifest(path: Optional[str], manifest: Dict[str, Dict[str, str]]) -> None:
+    """
+    Write the manifest of the uploaded files, replacing the old one at once.
+
+    :param path: The path to the manifest, None if the manifest is not used.
+    :param manifest: The dictionary with the 'sha256' and 'id' of the uploaded files by file name.
+    """
+    if not path:
+        return
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as fp:
+            json.dump(manifest, fp, indent=1, sort_keys=True)
+        os.replace(temporary_path, path)
+    except OSError as e:
+        logger.warning(f"Failed to write the manifest {path}: {e}")
+
+
+async def find_vector_store(
+        agents_client: AgentsClient,
+        name: str,
+        content_hash: str,
+        file_count: int) -> Optional[str]:
+    """
+    Find the complete vector store with the same files.
+
+    :param agents_client: The agents client.
+    :param name: The name of the vector store.
+    :param content_hash: The hash of the files.
+    :param file_count: The number of the files.
+    :return: The vector store identifier or None if there is no such store.
+    """
+    async for vector_store in agents_client.vector_stores.list():
+        if (vector_store.name == name
+                and (vector_store.metadata or {}).get(CONTENT_HASH_KEY) == content_hash
+                and vector_store.status == 'completed'
+                and vector_store.file_counts.completed == file_count):
+            return vector_store.id
+    return None
+
+
+async def upload_files(
+        agents_client: AgentsClient,
+        file_paths: List[str],
+        concurrency: int = DEFAULT_UPLOAD_CONCURRENCY) -> List[Union[str, BaseException]]:
+    """
+    Upload the files concurrently.
+
+    The failed upload does not cancel the others, so the caller can record the uploaded files.
+
+    :param agents_client: The agents client.
+    :param file_paths: The paths to the files.
+    :param concurrency: The maximal number of the files uploaded at the same time.
+    :return: The identifiers of the uploaded files or the upload errors in the order of the paths.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload(file_path: str) -> str:
+        async with semaphore:
+            file = await agents_client.files.upload_and_poll(file_path=file_path, purpose=FilePurpose.AGENTS)
+            return file.id
+
+    return list(await asyncio.gather(*[upload(file_path) for file_path in file_paths], return_exceptions=True))
+
+
+async def get_or_create_vector_store(
+        agents_client: AgentsClient,
+        file_paths: List[str],
+        name: str,
+        concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+        manifest_path: Optional[str] = None) -> str:
+    """
+    Get the vector store with the files, uploading only the files, which are not uploaded yet.
+
+    :param agents_client: The agents client.
+    :param file_paths: The paths to the files.
+    :param name: The name of the vector store.
+    :param concurrency: The maximal number of the files uploaded at the same time.
+    :param manifest_path: The path to the manifest of the uploaded files, None disables the reuse of the files.
+    :return: The vector store identifier.
+    :raises: The first upload error, after the uploaded files are recorded in the manifest,
+             or RuntimeError if some files were not added to the vector store.
+    """
+    file_hashes = {os.path.basename(path): hash_file(path) for path in file_paths}
+    content_hash = get_content_hash(file_hashes)
+    vector_store_id = await find_vector_store(agents_client, name, content_hash, len(file_paths))
+    if vector_store_id:
+        logger.info(f"Reusing the vector store {vector_store_id} with the same {len(file_paths)} files")
+        return vector_store_id
+
+    manifest = read_manifest(manifest_path)
+    uploaded = {}
+    if manifest:
+        available = {file.id for file in (await agents_client.files.list(purpose=FilePurpose.AGENTS)).data}
+        uploaded = {
+            file_name: entry for file_name, entry in manifest.items()
+            if entry.get('id') in available and entry.get('sha256') == file_hashes.get(file_name)}
+    new_paths = [path for path in file_paths if os.path.basename(path) not in uploaded]
+    logger.info(f"Uploading {len(new_paths)} files, reusing {len(file_paths) - len(new_paths)} uploaded files")
+    new_ids = await upload_files(agents_client, new_paths, concurrency)
+    errors = []
+    for path, file_id in zip(new_paths, new_ids):
+        if isinstance(file_id, BaseException):
+            errors.append(file_id)
+            continue
+        file_name = os.path.basename(path)
+        uploaded[file_name] = {'sha256': file_hashes[file_name], 'id': file_id}
+    # The uploaded files are recorded even if some uploads failed, so they are not uploaded again.
+    write_manifest(manifest_path, uploaded)
+    if errors:
+        logger.error(f"Failed to upload {len(errors)} of {len(new_paths)} files: {errors[0]}")
+        raise errors[0]
+
+    vector_store = await agents_client.vector_stores.create_and_poll(name=name)
+    file_ids = [uploaded[os.path.basename(path)]['id'] for path in file_paths]
+    failed = 0
+    for start in range(0, len(file_ids), FILE_BATCH_SIZE):
+        batch = await agents_client.vector_store_file_batches.create_and_poll(
+            vector_store_id=vector_store.id, file_ids=file_ids[start:start + FILE_BATCH_SIZE])
+        failed += batch.file_counts.failed
+    # The store is marked as reusable only when all files were added, the partial store is deleted,
+    # so it is not left behind when the next start creates the store again.
+    if failed:
+        await agents_client.vector_stores.delete(vector_store.id)
+        raise RuntimeError(f"Failed to add {failed} files to the vector store {vector_store.id}")
+    await agents_client.vector_stores.modify(vector_store.id, metadata={CONTENT_HASH_KEY: content_hash})
+    return vector_store.id
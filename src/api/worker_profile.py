@@ -0,0 +1,133 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+The execution profiles of the gunicorn server.
+
+The application mostly waits for the agent service, so a few event loops with many
+concurrent runs each serve the same load as many workers with less memory: every worker
+holds its own clients, connection pools and telemetry exporters. The number of workers
+follows the CPU quota of the container rather than the CPUs of the host.
+"""
+from typing import Dict, NamedTuple, Optional
+
+import math
+import os
+
+DEFAULT_CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+class WorkerProfile(NamedTuple):
+    """
+    The number of workers per CPU and the number of active runs per worker.
+
+    :param workers_per_cpu: The number of workers for every CPU of the quota.
+    :param extra_workers: The number of workers added to the workers per CPU.
+    :param max_active: The default maximal number of the active runs of one worker.
+    """
+
+    workers_per_cpu: float
+    extra_workers: int
+    max_active: int
+
+
+PROFILES: Dict[str, WorkerProfile] = {
+    # One event loop per CPU with many concurrent runs, for the I/O-bound streaming.
+    'async': WorkerProfile(workers_per_cpu=1, extra_workers=0, max_active=64),
+    # The previous model of 2 * CPUs + 1 workers with fewer runs each.
+    'legacy': WorkerProfile(workers_per_cpu=2, extra_workers=1, max_active=16),
+}
+DEFAULT_PROFILE = 'async'
+
+
+def _read_first_line(path: str) -> Optional[str]:
+    """
+    Read the first line of the file.
+
+    :param path: The path to the file.
+    :return: The stripped line or None if the file cannot be read.
+    """
+    try:
+        with open(path, encoding='utf-8') as fp:
+            return fp.readline().strip()
+    except OSError:
+        return None
+
+
+def get_cgroup_cpu_quota(cgroup_root: str = DEFAULT_CGROUP_ROOT) -> Optional[float]:
+    """
+    Get the CPU quota of the container from the cgroup v2 or v1 files.
+
+    :param cgroup_root: The mount point of the cgroup file system.
+    :return: The number of CPUs, which may be fractional, or None if the quota is not set.
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>".
+    line = _read_first_line(os.path.join(cgroup_root, 'cpu.max'))
+    if line:
+        quota, _, period = line.partition(' ')
+        if quota != 'max' and period:
+            try:
+                return int(quota) / int(period)
+            except (ValueError, ZeroDivisionError):
+                return None
+        return None
+    # cgroup v1: the quota is -1 if it is not set.
+    quota = _read_first_line(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_quota_us'))
+    period = _read_first_line(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_period_us'))
+    try:
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+    except (ValueError, ZeroDivisionError):
+        pass
+    return None
+
+
+def get_available_cpus(cgroup_root: str = DEFAULT_CGROUP_ROOT) -> float:
+    """
+    Get the number of CPUs, available to this process.
+
+    :param cgroup_root: The mount point of the cgroup file system.
+    :return: The smaller of the CPU affinity and the cgroup quota.
+    """
+    try:
+        cpus: float = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = get_cgroup_cpu_quota(cgroup_root)
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return cpus
+
+
+def get_profile(name: Optional[str]) -> WorkerProfile:
+    """
+    Get the execution profile by name.
+
+    :param name: The profile name, None or empty for the default profile.
+    :return: The profile.
+    :raises ValueError: If the profile is not known.
+    """
+    name = name or DEFAULT_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown worker profile '{name}', expected one of {', '.join(PROFILES)}")
+    return PROFILES[name]
+
+
+def get_worker_count(
+        profile: WorkerProfile,
+        cpus: float,
+        workers: Optional[int] = None,
+        max_workers: Optional[int] = None) -> int:
+    """
+    Get the number of the gunicorn workers.
+
+    :param profile: The execution profile.
+    :param cpus: The number of available CPUs.
+    :param workers: The explicit number of workers, which overrides the profile.
+    :param max_workers: The maximal number of workers, None for no limit.
+    :return: The number of workers, at least 1.
+    """
+    if not workers:
+        workers = math.ceil(cpus * profile.workers_per_cpu) + profile.extra_workers
+    if max_workers:
+        workers = min(workers, max_workers)
+    return max(1, workers)
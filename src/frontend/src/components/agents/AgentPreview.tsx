@@ -76,6 +76,9 @@ const preprocessContent = (
   return content;
 };
 
+// The number of attempts to resume the interrupted answer.
+const MAX_STREAM_RECONNECTS = 3;
+
 export function AgentPreview({ agentDetails }: IAgentPreviewProps): ReactNode {
   const [isSettingsPanelOpen, setIsSettingsPanelOpen] = useState(false);
   const [messageList, setMessageList] = useState<IChatItem[]>([]);
@@ -217,7 +220,7 @@ export function AgentPreview({ agentDetails }: IAgentPreviewProps): ReactNode {
       }
 
       console.log("[ChatClient] Starting to handle streaming response...");
-      handleMessages(response.body);
+      handleMessages(response.body, postData);
     } catch (error: any) {
       setIsResponding(false);
       if (error.name === "AbortError") {
@@ -229,17 +232,23 @@ export function AgentPreview({ agentDetails }: IAgentPreviewProps): ReactNode {
   };
 
   const handleMessages = (
-    stream: ReadableStream<Uint8Array<ArrayBufferLike>>
+    stream: ReadableStream<Uint8Array<ArrayBufferLike>>,
+    postData: { message: string }
   ) => {
     let chatItem: IChatItem | null = null;
     let accumulatedContent = "";
     let isStreaming = true;
     let buffer = "";
     let annotations: IAnnotation[] = [];
+    // The identifier of the last received event, used to resume the answer after a network error.
+    let eventId: string | null = null;
+    let eventData: string | null = null;
+    let lastEventId: string | null = null;
+    let reconnects = 0;
 
     // Create a reader for the SSE stream
-    const reader = stream.getReader();
-    const decoder = new TextDecoder();
+    let reader = stream.getReader();
+    let decoder = new TextDecoder();
 
     const readStream = async () => {
       while (true) {
@@ -263,9 +272,23 @@ export function AgentPreview({ agentDetails }: IAgentPreviewProps): ReactNode {
 
           console.log("[ChatClient] SSE line:", chunk); // log each line we extract
 
-          if (chunk.startsWith("data: ")) {
+          if (chunk.startsWith("id: ")) {
+            eventId = chunk.slice(4);
+          } else if (chunk.startsWith("data: ")) {
+            eventData = chunk.slice(6);
+          }
+
+          // The event is applied only when it is complete, together with its identifier, so the
+          // event cut by the network error is requested again on resume instead of applied twice.
+          if (chunk === "" && eventId !== null) {
+            lastEventId = eventId;
+            eventId = null;
+          }
+
+          if (chunk === "" && eventData !== null) {
             // Attempt to parse JSON
-            const jsonStr = chunk.slice(6);
+            const jsonStr = eventData;
+            eventData = null;
             let data;
             try {
               data = JSON.parse(jsonStr);
@@ -346,8 +369,60 @@ export function AgentPreview({ agentDetails }: IAgentPreviewProps): ReactNode {
       }
     };
 
+    // Reconnect to the same answer, the server replays the events after the last received one.
+    const resumeStream = async (): Promise<boolean> => {
+      if (lastEventId === null || reconnects >= MAX_STREAM_RECONNECTS) {
+        return false;
+      }
+      reconnects += 1;
+      console.log("[ChatClient] Resuming the stream after event:", lastEventId);
+      const response = await fetch("/chat", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          "Last-Event-ID": lastEventId,
+        },
+        body: JSON.stringify(postData),
+        credentials: "include",
+      });
+      if (response.status === 404 || response.status === 410) {
+        // The server does not know the stream anymore, so the partial answer is replaced
+        // by the thread history instead of sending the message again.
+        console.log("[ChatClient] The stream cannot be resumed, reloading the history.");
+        accumulatedContent = "";
+        chatItem = null;
+        setMessageList([]);
+        await loadChatHistory();
+        return false;
+      }
+      if (!response.ok || !response.body) {
+        return false;
+      }
+      reader = response.body.getReader();
+      decoder = new TextDecoder();
+      buffer = "";
+      eventId = null;
+      eventData = null;
+      return true;
+    };
+
+    const readStreamWithResume = async () => {
+      while (true) {
+        try {
+          await readStream();
+          return;
+        } catch (error) {
+          console.error("[ChatClient] Stream reading failed:", error);
+          if (!(await resumeStream())) {
+            setIsResponding(false);
+            return;
+          }
+        }
+      }
+    };
+
     // Catch errors from the stream reading process
-    readStream().catch((error) => {
+    readStreamWithResume().catch((error) => {
       console.error("[ChatClient] Stream reading failed:", error);
     });
   };
@@ -7,7 +7,6 @@ import asyncio
 import csv
 import json
 import logging
-import multiprocessing
 import os
 import sys
 
@@ -16,7 +15,6 @@ from azure.ai.agents.models import (
     Agent,
     AsyncToolSet,
     AzureAISearchTool,
-    FilePurpose,
     FileSearchTool,
     Tool,
 )
@@ -49,6 +47,8 @@ def list_files_in_files_directory() -> List[str]:
     return files
 
 FILES_NAMES = list_files_in_files_directory()
+# The hashes and identifiers of the uploaded files, the empty value uploads all files.
+FILE_UPLOAD_MANIFEST = os.path.join(os.path.dirname(__file__), 'data', 'uploaded_files.json')
 
 
 async def create_index_maybe(
@@ -56,6 +56,9 @@ async def create_index_maybe(
     """
     Create the index and upload documents if the index does not exist.
 
+    If the index exists, it is synchronized with the embeddings file, which recreates
+    the index once if it was created with the older schema.
+
     This code is executed only once, when called on_starting hook is being
     called. This code ensures that the index is being populated only once.
     rag.create_index return True if the index was created, meaning that this
@@ -64,6 +67,8 @@ async def create_index_maybe(
     :param ai_client: The project client to be used to create an index.
     :param creds: The credentials, used for the index.
     """
+    from api.embeddings_store import get_current_embeddings_path, is_binary, load_vectors
+    from api.http_transport import SharedTransport
     from api.search_index_manager import SearchIndexManager
     endpoint = os.environ.get('AZURE_AI_SEARCH_ENDPOINT')
     embedding = os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME')    
@@ -79,27 +84,44 @@ async def create_index_maybe(
         if aoai_connection.credentials and isinstance(aoai_connection.credentials, ApiKeyCredentials):
             embed_api_key = aoai_connection.credentials.api_key
 
-        search_mgr = SearchIndexManager(
-            endpoint=endpoint,
-            credential=creds,
-            index_name=os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
-            dimensions=None,
-            model=embedding,
-            deployment_name=embedding,
-            embedding_endpoint=aoai_connection.target,
-            embed_api_key=embed_api_key
-        )
-        # If another application instance already have created the index,
-        # do not upload the documents.
-        if await search_mgr.create_index(
-            vector_index_dimensions=int(
-                os.getenv('AZURE_AI_EMBED_DIMENSIONS'))):
-            embeddings_path = os.path.join(
-                os.path.dirname(__file__), 'data', 'embeddings.csv')
-
-            assert embeddings_path, f'File {embeddings_path} not found.'
-            await search_mgr.upload_documents(embeddings_path)
+        # The search clients share one connection pool for the index creation and the upload batches.
+        http_transport = SharedTransport(
+            limit_per_host=int(os.environ.get("HTTP_POOL_SIZE_PER_HOST", SharedTransport.DEFAULT_LIMIT_PER_HOST)))
+        try:
+            search_mgr = SearchIndexManager(
+                endpoint=endpoint,
+                credential=creds,
+                index_name=os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
+                dimensions=None,
+                model=embedding,
+                deployment_name=embedding,
+                embedding_endpoint=aoai_connection.target,
+                embed_api_key=embed_api_key,
+                transport=http_transport.transport()
+            )
+            # Prefer the binary embeddings, which are memory mapped instead of being parsed,
+            # if they were converted from the current CSV file.
+            embeddings_path = get_current_embeddings_path(
+                os.path.join(os.path.dirname(__file__), 'data', 'embeddings.csv'))
+            dimensions = os.getenv('AZURE_AI_EMBED_DIMENSIONS')
+            if dimensions:
+                dimensions = int(dimensions)
+            elif is_binary(embeddings_path):
+                dimensions = load_vectors(embeddings_path).shape[1]
+            # If another application instance already have created the index,
+            # only send the documents, which have changed since it was populated.
+            if await search_mgr.create_index(
+                vector_index_dimensions=dimensions):
+                assert os.path.isfile(embeddings_path), f'File {embeddings_path} not found.'
+                report = await search_mgr.upload_documents(embeddings_path)
+                logger.info(f"Uploaded documents from {embeddings_path}: {report}")
+            elif os.path.isfile(embeddings_path):
+                report = await search_mgr.sync_documents(embeddings_path)
+                logger.info(f"Synchronized documents from {embeddings_path}: {report}")
+            logger.info(f"Search connection pool: {http_transport.stats()}")
             await search_mgr.close()
+        finally:
+            await http_transport.close()
 
 
 def _get_file_path(file_name: str) -> str:
@@ -124,8 +146,6 @@ async def get_available_tool(
     :param creds: The credentials, used for the index.
     :return: The tool set, available based on the environment.
     """
-    # File name -> {"id": file_id, "path": file_path}
-    file_ids: List[str] = []
     # First try to get an index search.
     conn_id = ""
     if os.environ.get('AZURE_AI_SEARCH_INDEX_NAME'):
@@ -146,22 +166,18 @@ async def get_available_tool(
         logger.info(
             "agent: index was not initialized, falling back to file search.")
         
-        # Upload files for file search
-        for file_name in FILES_NAMES:
-            file_path = _get_file_path(file_name)
-            file = await project_client.agents.files.upload_and_poll(
-                file_path=file_path, purpose=FilePurpose.AGENTS)
-            # Store both file id and the file path using the file name as key.
-            file_ids.append(file.id)
-
-        # Create the vector store using the file IDs.
-        vector_store = await project_client.agents.vector_stores.create_and_poll(
-            file_ids=file_ids,
-            name="sample_store"
-        )
+        # Upload the new and changed files for file search concurrently, the store
+        # with the same files is reused.
+        from api.vector_store_builder import DEFAULT_UPLOAD_CONCURRENCY, get_or_create_vector_store
+        vector_store_id = await get_or_create_vector_store(
+            project_client.agents,
+            [_get_file_path(file_name) for file_name in FILES_NAMES],
+            name="sample_store",
+            concurrency=int(os.environ.get("FILE_UPLOAD_CONCURRENCY", DEFAULT_UPLOAD_CONCURRENCY)),
+            manifest_path=os.environ.get("FILE_UPLOAD_MANIFEST", FILE_UPLOAD_MANIFEST) or None)
         logger.info("agent: file store and vector store success")
 
-        return FileSearchTool(vector_store_ids=[vector_store.id])
+        return FileSearchTool(vector_store_ids=[vector_store_id])
 
 
 async def create_agent(ai_client: AIProjectClient,
@@ -182,7 +198,27 @@ async def create_agent(ai_client: AIProjectClient,
     return agent
 
 
+async def save_bootstrap(ai_client: AIProjectClient, agent: Agent) -> None:
+    """
+    Store the agent and the telemetry configuration for the workers, so that they
+    do not fetch them from the project at the same time.
+
+    :param ai_client: The project client.
+    :param agent: The resolved agent.
+    """
+    from api.bootstrap import WorkerBootstrap
+    connection_string = None
+    if os.getenv("ENABLE_AZURE_MONITOR_TRACING", "").lower() == "true":
+        try:
+            connection_string = await ai_client.telemetry.get_connection_string()
+        except Exception as e:
+            logger.warning(f"Failed to get Application Insights connection string, error: {e}")
+    WorkerBootstrap(proj_endpoint, agent, connection_string).save()
+
+
 async def initialize_resources():
+    from api.agent_state import AgentStateFile, resolve_agent
+    agent_state = AgentStateFile(os.environ.get("AGENT_STATE_PATH", AgentStateFile.DEFAULT_PATH))
     try:
         async with DefaultAzureCredential(
                 exclude_shared_token_cache_credential=True) as creds:
@@ -190,36 +226,19 @@ async def initialize_resources():
                 credential=creds,
                 endpoint=proj_endpoint
             ) as ai_client:
-                # If the environment already has AZURE_AI_AGENT_ID or AZURE_EXISTING_AGENT_ID, try
-                # fetching that agent
-                if agentID is not None:
-                    try:
-                        agent = await ai_client.agents.get_agent(
-                            agentID)
-                        logger.info(f"Found agent by ID: {agent.id}")
-                        return
-                    except Exception as e:
-                        logger.warning(
-                            "Could not retrieve agent by AZURE_EXISTING_AGENT_ID = "
-                            f"{agentID}, error: {e}")
-
-                # Check if an agent with the same name already exists
-                agent_list = ai_client.agents.list_agents()
-                if agent_list:
-                    async for agent_object in agent_list:
-                        if agent_object.name == os.environ[
-                                "AZURE_AI_AGENT_NAME"]:
-                            logger.info(
-                                "Found existing agent named "
-                                f"'{agent_object.name}'"
-                                f", ID: {agent_object.id}")
-                            os.environ["AZURE_EXISTING_AGENT_ID"] = agent_object.id
-                            return
-                        
-                # Create a new agent
-                agent = await create_agent(ai_client, creds)
+                # Use the configured agent, the agent found by the previous start or the
+                # agent with the same name. The workers get the ID through the environment.
+                agent = await resolve_agent(
+                    ai_client.agents, proj_endpoint, agentID, os.environ.get("AZURE_AI_AGENT_NAME"), agent_state)
+                if agent is not None:
+                    logger.info(f"Found agent, ID: {agent.id}")
+                else:
+                    # Create a new agent
+                    agent = await create_agent(ai_client, creds)
+                    agent_state.write(proj_endpoint, os.environ.get("AZURE_AI_AGENT_NAME"), agent.id)
+                    logger.info(f"Created agent, agent ID: {agent.id}")
                 os.environ["AZURE_EXISTING_AGENT_ID"] = agent.id
-                logger.info(f"Created agent, agent ID: {agent.id}")
+                await save_bootstrap(ai_client, agent)
 
     except Exception as e:
         logger.info("Error creating agent: {e}", exc_info=True)
@@ -244,8 +263,21 @@ if not os.getenv("RUNNING_IN_PRODUCTION"):
 # Please see the documentation on gunicorn
 # https://docs.gunicorn.org/en/stable/settings.html
 preload_app = True
-num_cpus = multiprocessing.cpu_count()
-workers = (num_cpus * 2) + 1
+
+# The profile sets the number of the workers per CPU of the container quota and the number
+# of the concurrent runs per worker. GUNICORN_WORKERS overrides the number of the workers.
+from api.worker_profile import DEFAULT_PROFILE, get_available_cpus, get_profile, get_worker_count  # noqa: E402
+worker_profile_name = os.environ.get("WORKER_PROFILE") or DEFAULT_PROFILE
+worker_profile = get_profile(worker_profile_name)
+num_cpus = get_available_cpus()
+workers = get_worker_count(
+    worker_profile,
+    num_cpus,
+    workers=int(os.environ.get("GUNICORN_WORKERS", os.environ.get("WEB_CONCURRENCY", "0"))),
+    max_workers=int(os.environ.get("GUNICORN_MAX_WORKERS", "0")))
+# The workers inherit the limit of the active runs, unless it is set explicitly.
+os.environ.setdefault("ADMISSION_MAX_ACTIVE", str(worker_profile.max_active))
+logger.info(f"Starting {workers} workers for {num_cpus:g} CPUs, profile '{worker_profile_name}'")
 worker_class = "uvicorn.workers.UvicornWorker"
 
 timeout = 120
@@ -0,0 +1,102 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import tempfile
+import unittest
+
+from api.admission import AdmissionController, AdmissionRejected, fcntl
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+    """Tests for the limit of the active runs."""
+
+    async def _run(self, admission, duration, log, name):
+        release = await admission.acquire()
+        log.append(name)
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            release()
+
+    async def test_active_runs_are_limited(self):
+        """Test that no more than max_active runs are active and the waiting ones start in order."""
+        admission = AdmissionController(max_active=2, max_waiting=10, wait_timeout=5)
+        log = []
+        active = []
+
+        async def run(name):
+            release = await admission.acquire()
+            log.append(name)
+            active.append(admission.stats()['active'])
+            await asyncio.sleep(0.01)
+            release()
+            # The second call does not free the slot again.
+            release()
+
+        await asyncio.gather(*[run(i) for i in range(6)])
+        self.assertEqual(log, list(range(6)))
+        self.assertLessEqual(max(active), 2)
+        stats = admission.stats()
+        self.assertEqual((stats['active'], stats['waiting'], stats['admitted']), (0, 0, 6))
+        self.assertEqual(stats['wait']['count'], 6)
+        self.assertGreater(stats['average_run_ms'], 0)
+
+    async def test_full_queue_rejects_at_once(self):
+        """Test that the request, which does not fit into the queue, is rejected without waiting."""
+        admission = AdmissionController(max_active=1, max_waiting=1, wait_timeout=5)
+        release = await admission.acquire()
+        waiting = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        self.assertEqual(admission.stats()['waiting'], 1)
+        with self.assertRaises(AdmissionRejected) as context:
+            await admission.acquire()
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+        release()
+        (await waiting)()
+        self.assertEqual(admission.stats()['rejected'], 1)
+        self.assertEqual(admission.stats()['active'], 0)
+
+    async def test_wait_timeout(self):
+        """Test that the request, which waits longer than the timeout, is rejected and leaves the queue."""
+        admission = AdmissionController(max_active=1, max_waiting=5, wait_timeout=0.02)
+        release = await admission.acquire()
+        with self.assertRaises(AdmissionRejected):
+            await admission.acquire()
+        stats = admission.stats()
+        self.assertEqual((stats['timed_out'], stats['waiting']), (1, 0))
+        release()
+        (await admission.acquire())()
+
+    async def test_cancelled_waiter_leaves_queue(self):
+        """Test that the client, which has gone while waiting, does not keep the slot."""
+        admission = AdmissionController(max_active=1, max_waiting=5, wait_timeout=5)
+        release = await admission.acquire()
+        waiting = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        self.assertEqual(admission.stats()['waiting'], 0)
+        release()
+        self.assertEqual(admission.stats()['active'], 0)
+
+    @unittest.skipIf(fcntl is None, "The host limit needs fcntl")
+    async def test_host_limit(self):
+        """Test that the controllers of the different workers share the host limit."""
+        with tempfile.TemporaryDirectory() as d:
+            first = AdmissionController(max_active=2, wait_timeout=0.1, host_max_active=2, host_directory=d)
+            second = AdmissionController(max_active=2, wait_timeout=0.1, host_max_active=2, host_directory=d)
+            releases = [await first.acquire(), await second.acquire()]
+            with self.assertRaises(AdmissionRejected):
+                await second.acquire()
+            # The local slot is given back when the host slot is not available.
+            self.assertEqual(second.stats()['active'], 1)
+            self.assertEqual(second.stats()['host_waits'], 1)
+            releases.pop(0)()
+            releases.append(await second.acquire())
+            for release in releases:
+                release()
+
+
+if __name__ == "__main__":
+    unittest.main()
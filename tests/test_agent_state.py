@@ -0,0 +1,90 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from api.agent_state import AgentStateFile, resolve_agent
+
+
+class FakeAgentsClient:
+    """The agents client with many agents, which counts the requests."""
+
+    def __init__(self, count=1000):
+        self.agents = {f'asst_{i}': SimpleNamespace(id=f'asst_{i}', name=f'agent {i}') for i in range(count)}
+        self.get_calls = 0
+        self.listed = 0
+
+    async def get_agent(self, agent_id):
+        self.get_calls += 1
+        if agent_id not in self.agents:
+            raise ResourceNotFoundError("No agent found.")
+        return self.agents[agent_id]
+
+    async def list_agents(self):
+        for agent in list(self.agents.values()):
+            self.listed += 1
+            yield agent
+
+
+class TestAgentState(unittest.IsolatedAsyncioTestCase):
+    """Tests for the resolution of the agent."""
+
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self.state = AgentStateFile(os.path.join(self._directory.name, 'agent.json'))
+        self.client = FakeAgentsClient()
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self) -> None:
+        self._directory.cleanup()
+        unittest.TestCase.tearDown(self)
+
+    async def _resolve(self, agent_id=None, agent_name='agent 900', endpoint='https://project'):
+        return await resolve_agent(self.client, endpoint, agent_id, agent_name, self.state)
+
+    async def test_agent_is_listed_once(self):
+        """Test that the agent found by name is then taken from the state file with one request."""
+        agent = await self._resolve()
+        self.assertEqual(agent.id, 'asst_900')
+        self.assertEqual(self.client.listed, 901)
+
+        self.client.listed = 0
+        self.client.get_calls = 0
+        self.assertEqual((await self._resolve()).id, 'asst_900')
+        self.assertEqual((self.client.listed, self.client.get_calls), (0, 1))
+
+    async def test_configured_agent(self):
+        """Test that the configured agent is fetched with one request and stored."""
+        self.assertEqual((await self._resolve(agent_id='asst_5')).id, 'asst_5')
+        self.assertEqual((self.client.listed, self.client.get_calls), (0, 1))
+        self.assertEqual(self.state.read('https://project', 'agent 900'), 'asst_5')
+
+    async def test_state_is_validated(self):
+        """Test that the stored agent of the other project, name or the deleted agent is not used."""
+        await self._resolve()
+        self.assertIsNone(self.state.read('https://other', 'agent 900'))
+        self.assertIsNone(self.state.read('https://project', 'agent 1'))
+
+        del self.client.agents['asst_900']
+        self.client.agents['asst_new'] = SimpleNamespace(id='asst_new', name='agent 900')
+        self.assertEqual((await self._resolve()).id, 'asst_new')
+        self.assertEqual(self.state.read('https://project', 'agent 900'), 'asst_new')
+
+        # The agent, which was renamed, is not the agent with this name anymore.
+        self.client.agents['asst_new'].name = 'renamed'
+        self.assertIsNone(await self._resolve())
+
+    async def test_invalid_state_file(self):
+        """Test that the damaged state file is ignored."""
+        with open(self.state._path, 'w') as fp:
+            fp.write('{')
+        self.assertEqual((await self._resolve()).id, 'asst_900')
+
+
+if __name__ == "__main__":
+    unittest.main()
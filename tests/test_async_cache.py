@@ -0,0 +1,107 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from api.async_cache import AsyncLRUCache
+
+
+class TestAsyncLRUCache(unittest.IsolatedAsyncioTestCase):
+    """Tests for the async LRU cache."""
+
+    async def test_hits_and_evictions(self):
+        """Test that the least recently used entry is evicted."""
+        cache = AsyncLRUCache(maxsize=2)
+        calls = []
+
+        async def load(key):
+            calls.append(key)
+            return key * 2
+
+        for key in (1, 2, 1, 3, 1, 2):
+            self.assertEqual(await cache.get_or_load(key, lambda: load(key)), key * 2)
+        self.assertEqual(calls, [1, 2, 3, 2])
+        self.assertEqual(cache.stats(), {
+            'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 4, 'coalesced': 0, 'evictions': 2})
+
+    async def test_ttl(self):
+        """Test that the expired entries are loaded again."""
+        cache = AsyncLRUCache(maxsize=10, ttl=60)
+        with patch('api.async_cache.time.monotonic', return_value=1000):
+            cache.set('key', 'old')
+            self.assertEqual(cache.get('key'), (True, 'old'))
+        with patch('api.async_cache.time.monotonic', return_value=1061):
+            self.assertEqual(cache.get('key'), (False, None))
+            self.assertEqual(len(cache), 0)
+
+    async def test_concurrent_misses_are_coalesced(self):
+        """Test that the concurrent misses of the same key call the loader once."""
+        cache = AsyncLRUCache(maxsize=10)
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 'value'
+
+        results = await asyncio.gather(*[cache.get_or_load('key', load) for _ in range(10)])
+        self.assertEqual(results, ['value'] * 10)
+        self.assertEqual(calls, 1)
+        self.assertEqual(cache.stats()['coalesced'], 9)
+
+    async def test_errors_are_not_cached(self):
+        """Test that the error is propagated to all waiters and the next call retries."""
+        cache = AsyncLRUCache(maxsize=10)
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('Mock error')
+
+        results = await asyncio.gather(
+            cache.get_or_load('key', fail), cache.get_or_load('key', fail), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+        async def load():
+            return 'value'
+
+        self.assertEqual(await cache.get_or_load('key', load), 'value')
+
+    async def test_invalidate_during_load(self):
+        """Test that the result of the load, started before the invalidation, is not stored."""
+        cache = AsyncLRUCache(maxsize=10)
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def load():
+            started.set()
+            await release.wait()
+            return 'stale'
+
+        task = asyncio.create_task(cache.get_or_load('key', load))
+        await started.wait()
+        cache.invalidate()
+        release.set()
+        self.assertEqual(await task, 'stale')
+        self.assertEqual(cache.get('key'), (False, None))
+
+    async def test_cancelled_caller_does_not_cancel_load(self):
+        """Test that other callers get the value if the first caller was cancelled."""
+        cache = AsyncLRUCache(maxsize=10)
+
+        async def load():
+            await asyncio.sleep(0.01)
+            return 'value'
+
+        first = asyncio.create_task(cache.get_or_load('key', load))
+        second = asyncio.create_task(cache.get_or_load('key', load))
+        await asyncio.sleep(0)
+        first.cancel()
+        self.assertEqual(await second, 'value')
+        self.assertEqual(cache.get('key'), (True, 'value'))
+
+
+if __name__ == "__main__":
+    unittest.main()
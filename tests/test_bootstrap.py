@@ -0,0 +1,53 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import time
+import unittest
+
+from azure.ai.agents.models import Agent
+
+from api.bootstrap import WorkerBootstrap, get_startup_delay
+
+
+class TestWorkerBootstrap(unittest.TestCase):
+    """Tests for the start-up state, shared with the workers."""
+
+    def setUp(self) -> None:
+        self.environ = {}
+        self.agent = Agent({
+            'id': 'asst_1', 'object': 'assistant', 'name': 'agent', 'model': 'gpt-4o-mini',
+            'tool_resources': {'file_search': {'vector_store_ids': ['vs_1']}}})
+        unittest.TestCase.setUp(self)
+
+    def test_save_and_load(self):
+        """Test that the worker gets the agent with its tools and the connection string."""
+        WorkerBootstrap('https://project', self.agent, 'InstrumentationKey=1').save(self.environ)
+        bootstrap = WorkerBootstrap.load('https://project', 'asst_1', environ=self.environ)
+        self.assertEqual(bootstrap.agent.id, 'asst_1')
+        self.assertEqual(bootstrap.agent.model, 'gpt-4o-mini')
+        self.assertEqual(bootstrap.agent.tool_resources.file_search.vector_store_ids, ['vs_1'])
+        self.assertEqual(bootstrap.telemetry_connection_string, 'InstrumentationKey=1')
+        self.assertIsNotNone(WorkerBootstrap.load('https://project', None, environ=self.environ))
+
+    def test_load_is_validated(self):
+        """Test that the missing, invalid, old or foreign state is not used."""
+        self.assertIsNone(WorkerBootstrap.load('https://project', 'asst_1', environ=self.environ))
+        self.environ[WorkerBootstrap.ENV_NAME] = '{'
+        self.assertIsNone(WorkerBootstrap.load('https://project', 'asst_1', environ=self.environ))
+
+        WorkerBootstrap('https://project', self.agent, created=time.time() - 100).save(self.environ)
+        self.assertIsNone(WorkerBootstrap.load('https://other', 'asst_1', environ=self.environ))
+        self.assertIsNone(WorkerBootstrap.load('https://project', 'asst_2', environ=self.environ))
+        self.assertIsNone(WorkerBootstrap.load('https://project', 'asst_1', max_age=10, environ=self.environ))
+        self.assertIsNotNone(WorkerBootstrap.load('https://project', 'asst_1', max_age=1000, environ=self.environ))
+
+    def test_startup_delay(self):
+        """Test that the start-up delay is within the jitter."""
+        self.assertEqual(get_startup_delay(0), 0.0)
+        delays = [get_startup_delay(2.0) for _ in range(100)]
+        self.assertTrue(all(0 <= delay <= 2.0 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from api.embeddings_store import (
+    EmbeddingsWriter,
+    convert_csv_to_binary,
+    get_binary_path,
+    get_current_embeddings_path,
+    get_metadata_path,
+    iter_embeddings,
+    load_embeddings,
+    load_vectors,
+)
+
+
+class TestEmbeddingsStore(unittest.TestCase):
+    """Tests for the embeddings file formats."""
+
+    EMBEDDINGS_FILE = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'data', 'embeddings.csv')
+
+    def test_convert_csv_to_binary(self):
+        """Test that the binary file contains the same rows as the CSV file."""
+        with tempfile.TemporaryDirectory() as d:
+            binary_file = convert_csv_to_binary(
+                TestEmbeddingsStore.EMBEDDINGS_FILE, os.path.join(d, 'embeddings.f32'))
+            self.assertTrue(os.path.isfile(get_metadata_path(binary_file)))
+            csv_rows = list(iter_embeddings(TestEmbeddingsStore.EMBEDDINGS_FILE))
+            binary_rows = list(iter_embeddings(binary_file))
+            self.assertEqual(len(csv_rows), len(binary_rows))
+            for csv_row, binary_row in zip(csv_rows, binary_rows):
+                self.assertEqual(csv_row['token'], binary_row['token'])
+                self.assertEqual(csv_row['title'], binary_row['title'])
+                np.testing.assert_allclose(csv_row['embedding'], binary_row['embedding'], rtol=1e-6)
+            self.assertEqual(os.path.getsize(binary_file), len(csv_rows) * len(csv_rows[0]['embedding']) * 4)
+
+    def test_load_vectors_memmap(self):
+        """Test that the binary matrix is memory mapped and matches the parsed CSV."""
+        with tempfile.TemporaryDirectory() as d:
+            binary_file = convert_csv_to_binary(
+                TestEmbeddingsStore.EMBEDDINGS_FILE, os.path.join(d, 'embeddings.f32'))
+            vectors = load_vectors(binary_file)
+            self.assertIsInstance(vectors, np.memmap)
+            self.assertEqual(vectors.dtype, np.float32)
+            csv_vectors, metadata = load_embeddings(TestEmbeddingsStore.EMBEDDINGS_FILE)
+            np.testing.assert_array_equal(vectors, csv_vectors)
+            self.assertEqual(load_embeddings(binary_file)[1], metadata)
+            del vectors
+
+    def test_writer_dimensions(self):
+        """Test the binary writer validation and the empty file."""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'empty.f32')
+            with EmbeddingsWriter(path):
+                pass
+            self.assertEqual(load_vectors(path).shape[0], 0)
+            self.assertEqual(list(iter_embeddings(path)), [])
+
+            path = os.path.join(d, 'vectors.f32')
+            with EmbeddingsWriter(path) as writer:
+                writer.write('a', 'a.md', [0.5, 1.0])
+                with self.assertRaisesRegex(ValueError, "The embedding has 3 dimensions.+"):
+                    writer.write('b', 'b.md', [0.5, 1.0, 2.0])
+            self.assertEqual(list(iter_embeddings(path)), [{'token': 'a', 'title': 'a.md', 'embedding': [0.5, 1.0]}])
+
+    def test_load_empty_csv(self):
+        """Test that the CSV file without rows gives the empty matrix."""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'empty.csv')
+            with EmbeddingsWriter(path):
+                pass
+            vectors, metadata = load_embeddings(path)
+            self.assertEqual(vectors.shape, (0, 0))
+            self.assertEqual(metadata, [])
+
+    def test_current_embeddings_path(self):
+        """Test that the binary file is used only if it was converted from the current CSV file."""
+        with tempfile.TemporaryDirectory() as d:
+            csv_file = os.path.join(d, 'embeddings.csv')
+            self.assertEqual(get_current_embeddings_path(csv_file), csv_file)
+            with EmbeddingsWriter(csv_file) as writer:
+                writer.write('a', 'a.md', [0.5, 1.0])
+            binary_file = convert_csv_to_binary(csv_file)
+            self.assertEqual(binary_file, get_binary_path(csv_file))
+            self.assertEqual(get_current_embeddings_path(csv_file), binary_file)
+
+            # The regenerated CSV file makes the binary file stale.
+            with EmbeddingsWriter(csv_file) as writer:
+                writer.write('b', 'b.md', [1.0, 0.5])
+            self.assertEqual(get_current_embeddings_path(csv_file), csv_file)
+
+            # The binary file without the source hash is compared by the modification time.
+            with EmbeddingsWriter(binary_file) as writer:
+                writer.write('b', 'b.md', [1.0, 0.5])
+            os.utime(csv_file, (0, 0))
+            self.assertEqual(get_current_embeddings_path(csv_file), binary_file)
+            os.utime(binary_file, (0, 0))
+            os.utime(csv_file)
+            self.assertEqual(get_current_embeddings_path(csv_file), csv_file)
+
+
+if __name__ == "__main__":
+    unittest.main()
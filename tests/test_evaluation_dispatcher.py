@@ -0,0 +1,130 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+
+from api.evaluation_dispatcher import EvaluationDispatcher
+
+
+class FakeEvaluations:
+    """The evaluation service, which fails the given number of times and tracks the concurrency."""
+
+    def __init__(self, failures=0, status_code=None, latency=0.01, error=None):
+        self._failures = failures
+        self._status_code = status_code
+        self._error = error
+        self._latency = latency
+        self.created = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def create(self, thread_id, run_id):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._latency)
+            if self._failures:
+                self._failures -= 1
+                if self._error is not None:
+                    raise self._error
+                error = HttpResponseError("Evaluation failed")
+                error.status_code = self._status_code
+                raise error
+            self.created.append((thread_id, run_id))
+            return {'id': f'evaluation_{run_id}'}
+        finally:
+            self.in_flight -= 1
+
+
+class TestEvaluationDispatcher(unittest.IsolatedAsyncioTestCase):
+    """Tests for the background evaluation queue."""
+
+    async def test_concurrency_is_limited(self):
+        """Test that the evaluations are queued at once and sent by the limited number of workers."""
+        evaluations = FakeEvaluations()
+        dispatcher = EvaluationDispatcher(evaluations.create, concurrency=2)
+        dispatcher.start()
+        self.assertTrue(all(dispatcher.enqueue('thread', f'run_{i}') for i in range(10)))
+        self.assertEqual(dispatcher.stats()['queued'], 10)
+        await dispatcher.close()
+        self.assertEqual(len(evaluations.created), 10)
+        self.assertEqual(evaluations.max_in_flight, 2)
+        stats = dispatcher.stats()
+        self.assertEqual((stats['queued'], stats['succeeded'], stats['in_flight']), (0, 10, 0))
+        self.assertEqual(stats['latency']['count'], 10)
+
+    async def test_full_queue_drops(self):
+        """Test that the run, which does not fit into the queue, is dropped and counted."""
+        dispatcher = EvaluationDispatcher(FakeEvaluations().create, queue_size=2)
+        self.assertTrue(dispatcher.enqueue('thread', 'run_1'))
+        self.assertTrue(dispatcher.enqueue('thread', 'run_2'))
+        self.assertFalse(dispatcher.enqueue('thread', 'run_3'))
+        self.assertEqual(dispatcher.stats()['dropped'], 1)
+        await dispatcher.close()
+
+    async def test_sampling(self):
+        """Test that only the sampled percent of the runs is evaluated."""
+        dispatcher = EvaluationDispatcher(FakeEvaluations().create, sampling_percent=25)
+        with patch('api.evaluation_dispatcher.random.random', side_effect=[0.1, 0.3, 0.2, 0.9]):
+            queued = [dispatcher.enqueue('thread', f'run_{i}') for i in range(4)]
+        self.assertEqual(queued, [True, False, True, False])
+        self.assertEqual(dispatcher.stats()['sampled_out'], 2)
+        await dispatcher.close()
+
+    async def test_transient_failures_are_retried(self):
+        """Test that the throttled evaluation is retried with the backoff."""
+        evaluations = FakeEvaluations(failures=2, status_code=429)
+        dispatcher = EvaluationDispatcher(evaluations.create, retry_delay=0.01)
+        dispatcher.start()
+        dispatcher.enqueue('thread', 'run')
+        await dispatcher.close()
+        self.assertEqual(evaluations.created, [('thread', 'run')])
+        stats = dispatcher.stats()
+        self.assertEqual((stats['retries'], stats['succeeded'], stats['failed']), (2, 1, 0))
+
+    async def test_invalid_request_is_not_retried(self):
+        """Test that the evaluation rejected as invalid fails without retries."""
+        evaluations = FakeEvaluations(failures=1, status_code=400)
+        dispatcher = EvaluationDispatcher(evaluations.create, retry_delay=0.01)
+        dispatcher.start()
+        dispatcher.enqueue('thread', 'run')
+        await dispatcher.close()
+        stats = dispatcher.stats()
+        self.assertEqual((stats['retries'], stats['failed']), (0, 1))
+
+    async def test_connection_error_is_retried(self):
+        """Test that the evaluation, which did not reach the service, is retried."""
+        evaluations = FakeEvaluations(failures=1, error=ServiceRequestError("Connection refused"))
+        dispatcher = EvaluationDispatcher(evaluations.create, retry_delay=0.01)
+        dispatcher.start()
+        dispatcher.enqueue('thread', 'run')
+        await dispatcher.close()
+        stats = dispatcher.stats()
+        self.assertEqual((stats['retries'], stats['succeeded'], stats['failed']), (1, 1, 0))
+
+    async def test_programming_error_is_not_retried(self):
+        """Test that the error, which is not a network or service error, fails without retries."""
+        evaluations = FakeEvaluations(failures=1, error=TypeError("Unexpected argument"))
+        dispatcher = EvaluationDispatcher(evaluations.create, retry_delay=0.01)
+        dispatcher.start()
+        dispatcher.enqueue('thread', 'run')
+        await dispatcher.close()
+        self.assertEqual(evaluations.created, [])
+        stats = dispatcher.stats()
+        self.assertEqual((stats['retries'], stats['failed']), (0, 1))
+
+    async def test_close_timeout(self):
+        """Test that the shutdown does not wait for the slow evaluations longer than the timeout."""
+        dispatcher = EvaluationDispatcher(FakeEvaluations(latency=10).create)
+        dispatcher.start()
+        dispatcher.enqueue('thread', 'run')
+        await asyncio.sleep(0)
+        await asyncio.wait_for(dispatcher.close(timeout=0.05), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from azure.ai.agents.models import ThreadMessage
+
+from api.file_name_cache import FileNameCache
+from api.routes import get_message_and_annotations
+
+
+class FakeFiles:
+    """The files operations, which answer after the latency."""
+
+    def __init__(self, latency=0.05):
+        self._latency = latency
+        self.calls = 0
+        self.list_calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get(self, file_id):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._latency)
+        finally:
+            self.in_flight -= 1
+        return SimpleNamespace(id=file_id, filename=f"{file_id}.md")
+
+    async def list(self, purpose=None):
+        self.list_calls += 1
+        return SimpleNamespace(data=[SimpleNamespace(id=f"file_{i}", filename=f"file_{i}.md") for i in range(5)])
+
+
+class FakeVectorStoreFiles:
+    """The vector store files operations, listing the files of the single vector store."""
+
+    async def list(self, vector_store_id):
+        for i in (1, 3):
+            yield SimpleNamespace(id=f"file_{i}")
+
+
+def get_message(file_ids):
+    """Get the assistant message with the file citations."""
+    return ThreadMessage({
+        'id': 'msg',
+        'role': 'assistant',
+        'created_at': 0,
+        'content': [{'type': 'text', 'text': {'value': 'answer', 'annotations': [
+            {'type': 'file_citation', 'text': f'[{i}]', 'file_citation': {'file_id': file_id}}
+            for i, file_id in enumerate(file_ids)]}}]})
+
+
+class TestFileNameCache(unittest.IsolatedAsyncioTestCase):
+    """Tests for the file name cache."""
+
+    def setUp(self) -> None:
+        self.files = FakeFiles()
+        self.agent_client = SimpleNamespace(files=self.files, vector_store_files=FakeVectorStoreFiles())
+        unittest.TestCase.setUp(self)
+
+    async def test_get_many(self):
+        """Test that the citations of 50 messages are resolved in one parallel burst and then locally."""
+        cache = FileNameCache()
+        messages = [get_message([f"file_{i % 10}", f"file_{(i + 1) % 10}"]) for i in range(50)]
+        await cache.get_many(
+            self.agent_client,
+            (a.file_citation.file_id for message in messages for a in message.file_citation_annotations))
+        self.assertEqual(self.files.calls, 10)
+        self.assertEqual(self.files.max_in_flight, 10)
+
+        formatted = [await get_message_and_annotations(self.agent_client, message, cache) for message in messages]
+        self.assertEqual(self.files.calls, 10)
+        self.assertEqual(
+            [a['file_name'] for a in formatted[3]['annotations']], ["file_3.md", "file_4.md"])
+        self.assertEqual(formatted[3]['content'], 'answer')
+
+    async def test_concurrent_lookups_are_coalesced(self):
+        """Test that the concurrent lookups of the same file share one request."""
+        cache = FileNameCache()
+        names = await asyncio.gather(*[cache.get(self.agent_client, "file_1") for _ in range(5)])
+        self.assertEqual(names, ["file_1.md"] * 5)
+        self.assertEqual(self.files.calls, 1)
+        self.assertEqual(cache.stats()['coalesced'], 4)
+
+    async def test_warm(self):
+        """Test that the warm cache resolves the files of the vector store without requests."""
+        cache = FileNameCache()
+        self.assertEqual(await cache.warm(self.agent_client, ["vs_1"]), 2)
+        self.assertEqual(self.files.list_calls, 1)
+        self.assertEqual(await cache.get_many(self.agent_client, ["file_1", "file_3"]),
+                         {"file_1": "file_1.md", "file_3": "file_3.md"})
+        self.assertEqual(self.files.calls, 0)
+        await cache.get(self.agent_client, "file_2")
+        self.assertEqual(self.files.calls, 1)
+        self.assertEqual(await FileNameCache().warm(self.agent_client), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
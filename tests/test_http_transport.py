@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from azure.core.pipeline.transport import HttpRequest
+
+from api.http_transport import SharedTransport
+
+
+class TestSharedTransport(unittest.IsolatedAsyncioTestCase):
+    """Tests for the shared connection pool."""
+
+    async def asyncSetUp(self) -> None:
+        from aiohttp import web
+
+        async def handle(request):
+            await asyncio.sleep(0.05)
+            return web.Response(text='ok')
+
+        app = web.Application()
+        app.router.add_get('/', handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{self._runner.addresses[0][1]}/'
+
+    async def asyncTearDown(self) -> None:
+        await self._runner.cleanup()
+
+    async def test_pool_saturation(self):
+        """Test that the requests over the per host limit wait for the connection and reuse it."""
+        transport = SharedTransport(limit_per_host=1)
+        try:
+            async def get():
+                async with transport.session.get(self.url) as response:
+                    return await response.text()
+
+            self.assertEqual(await asyncio.gather(get(), get(), get()), ['ok'] * 3)
+            stats = transport.stats()
+            self.assertEqual(stats['limit_per_host'], 1)
+            self.assertEqual((stats['requests'], stats['in_flight'], stats['failed']), (3, 0, 0))
+            self.assertEqual(stats['connections_created'], 1)
+            self.assertEqual(stats['connections_reused'], 2)
+            self.assertEqual((stats['queued'], stats['waiting']), (2, 0))
+            self.assertEqual(stats['latency']['queue']['count'], 2)
+        finally:
+            await transport.close()
+        self.assertTrue(transport.session.closed)
+
+    async def test_clients_do_not_close_session(self):
+        """Test that closing the SDK transport keeps the shared session open."""
+        transport = SharedTransport()
+        try:
+            for _ in range(2):
+                async with transport.transport() as client_transport:
+                    response = await client_transport.send(HttpRequest('GET', self.url))
+                    await response.load_body()
+                    self.assertEqual(response.status_code, 200)
+            self.assertFalse(transport.session.closed)
+            self.assertEqual(transport.stats()['connections_created'], 1)
+        finally:
+            await transport.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from api.embeddings_store import load_embeddings
+from api.ivf_index import IVFIndex
+from api.local_search import LocalSearchBackend
+
+
+class TestIVFIndex(unittest.TestCase):
+    """Tests for the inverted file index."""
+
+    EMBEDDINGS_FILE = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'api', 'data', 'embeddings.csv')
+    N_LISTS = 32
+    K = 10
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        vectors, _ = load_embeddings(TestIVFIndex.EMBEDDINGS_FILE)
+        cls.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        rng = np.random.default_rng(1)
+        queries = cls.vectors[rng.choice(len(cls.vectors), 100)]
+        queries = queries + rng.normal(0, 0.02, queries.shape).astype(np.float32)
+        cls.queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        cls.index = IVFIndex.build(cls.vectors, n_lists=TestIVFIndex.N_LISTS)
+
+    def _exact(self, vectors, query, k):
+        return np.argsort(-(vectors @ query))[:k]
+
+    def _recall(self, index, vectors, nprobe):
+        found = 0
+        for query in self.queries:
+            expected = set(self._exact(vectors, query, TestIVFIndex.K).tolist())
+            found += len(expected & set(index.search(query, TestIVFIndex.K, nprobe=nprobe)[0].tolist()))
+        return found / (len(self.queries) * TestIVFIndex.K)
+
+    def test_recall(self):
+        """Test that the recall grows with nprobe and the full probe is the exact search."""
+        recalls = [self._recall(self.index, self.vectors, nprobe) for nprobe in (1, 2, 4, 8, 16, TestIVFIndex.N_LISTS)]
+        self.assertEqual(recalls, sorted(recalls))
+        self.assertGreaterEqual(recalls[3], 0.9)
+        self.assertEqual(recalls[-1], 1.0)
+
+    @unittest.skipUnless(os.environ.get("RUN_BENCHMARKS"), "Only for benchmarks, set RUN_BENCHMARKS=1.")
+    def test_scan_fraction_benchmark(self):
+        """Test that on the large corpus the small nprobe is faster than the exact search."""
+        rng = np.random.default_rng(2)
+        # Scale the shipped vectors up to 50000 noisy copies.
+        vectors = np.repeat(self.vectors, 53, axis=0)[:50000]
+        vectors = vectors + rng.normal(0, 0.05, vectors.shape).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        index = IVFIndex.train(vectors[rng.choice(len(vectors), 5000, replace=False)], n_lists=128, nprobe=4)
+        index.add(vectors)
+        index.compact()
+        timings = {}
+        for name, search in (
+                ('ivf', lambda query: index.search(query, TestIVFIndex.K)),
+                ('exact', lambda query: self._exact(vectors, query, TestIVFIndex.K))):
+            start = time.perf_counter()
+            for query in self.queries[:20]:
+                search(query)
+            timings[name] = (time.perf_counter() - start) / 20
+        self.assertLess(timings['ivf'], timings['exact'])
+
+    def test_incremental_insert(self):
+        """Test that the added vectors are found before and after compaction."""
+        index = IVFIndex.build(self.vectors[:900], n_lists=TestIVFIndex.N_LISTS)
+        index.add(self.vectors[900:])
+        self.assertEqual(len(index), len(self.vectors))
+        for row in (900, len(self.vectors) - 1):
+            self.assertEqual(index.search(self.vectors[row], 1)[0].tolist(), [row])
+        index.compact()
+        for row in (0, 900, len(self.vectors) - 1):
+            self.assertEqual(index.search(self.vectors[row], 1)[0].tolist(), [row])
+        index.add(self.vectors[:2], ids=[10 ** 6, 10 ** 6 + 1])
+        self.assertEqual(set(index.search(self.vectors[1], 2, nprobe=TestIVFIndex.N_LISTS)[0].tolist()),
+                         {1, 10 ** 6 + 1})
+        with self.assertRaises(ValueError):
+            index.add(self.vectors[:2], ids=[1])
+
+    def test_save_load(self):
+        """Test that the loaded index is memory mapped and returns the same results."""
+        with tempfile.TemporaryDirectory() as d:
+            self.index.save(d)
+            loaded = IVFIndex.load(d)
+            self.assertIsInstance(loaded._vectors, np.memmap)
+            self.assertEqual(loaded.nprobe, self.index.nprobe)
+            for query in self.queries[:10]:
+                ids, scores = self.index.search(query, TestIVFIndex.K)
+                loaded_ids, loaded_scores = loaded.search(query, TestIVFIndex.K)
+                self.assertEqual(ids.tolist(), loaded_ids.tolist())
+                np.testing.assert_allclose(scores, loaded_scores)
+            loaded.add(self.vectors[:1], ids=[-1])
+            loaded.compact()
+            self.assertEqual(len(loaded), len(self.vectors) + 1)
+            del loaded
+
+    def test_local_search_backend(self):
+        """Test that the local backend uses the ANN index for the vector search."""
+        backend = LocalSearchBackend(TestIVFIndex.EMBEDDINGS_FILE)
+        exact = backend.search_vector(self.vectors[7], 5)
+        backend.build_ann_index(n_lists=TestIVFIndex.N_LISTS, nprobe=TestIVFIndex.N_LISTS)
+        self.assertEqual(backend.search_vector(self.vectors[7], 5), exact)
+        with self.assertRaises(ValueError):
+            LocalSearchBackend(TestIVFIndex.EMBEDDINGS_FILE, ann_index=IVFIndex.build(self.vectors[:100], n_lists=4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import numpy as np
+
+from api.embeddings_store import convert_csv_to_binary, iter_embeddings
+from api.local_search import LocalSearchBackend
+from search_index_manager import SearchIndexManager
+
+
+class CorpusEmbeddingClient:
+    """The embedding client, which returns the embeddings of the known texts from the corpus."""
+
+    def __init__(self, embeddings_file):
+        self._embeddings = {row['token']: row['embedding'] for row in iter_embeddings(embeddings_file)}
+
+    async def embed(self, input, dimensions, model):
+        return {'data': [{'embedding': self._embeddings[text]} for text in input]}
+
+
+class TestLocalSearchBackend(unittest.IsolatedAsyncioTestCase):
+    """Tests for the local search backend."""
+
+    EMBEDDINGS_FILE = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'api', 'data', 'embeddings.csv')
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.rows = list(iter_embeddings(TestLocalSearchBackend.EMBEDDINGS_FILE))
+        cls.backend = LocalSearchBackend(
+            TestLocalSearchBackend.EMBEDDINGS_FILE,
+            embedding_client=CorpusEmbeddingClient(TestLocalSearchBackend.EMBEDDINGS_FILE))
+
+    def test_search_vector_matches_exact_cosine(self):
+        """Test that the top k is the same as the full sort of cosine similarities."""
+        vectors = np.array([row['embedding'] for row in self.rows], dtype=np.float64)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        for row in (0, 17, len(self.rows) - 1):
+            expected = np.argsort(-(vectors @ vectors[row]))[:5].tolist()
+            result = self.backend.search_vector(self.rows[row]['embedding'], 5)
+            self.assertEqual(result[0], row)
+            self.assertEqual(set(result), set(expected))
+        self.assertEqual(len(self.backend.search_vector(self.rows[0]['embedding'], 10 ** 6)), len(self.rows))
+
+    @unittest.skipUnless(os.environ.get("RUN_BENCHMARKS"), "Only for benchmarks, set RUN_BENCHMARKS=1.")
+    def test_search_vector_latency(self):
+        """Test that the vector search over the shipped corpus takes less than a millisecond."""
+        query = self.rows[3]['embedding']
+        timings = []
+        for _ in range(50):
+            start = time.perf_counter()
+            self.backend.search_vector(query, 5)
+            timings.append(time.perf_counter() - start)
+        self.assertLess(float(np.median(timings)), 1e-3)
+
+    def test_binary_embeddings_are_not_copied(self):
+        """Test that the memory mapped embeddings are searched in place with the same results."""
+        with tempfile.TemporaryDirectory() as d:
+            binary_file = convert_csv_to_binary(
+                TestLocalSearchBackend.EMBEDDINGS_FILE, os.path.join(d, 'embeddings.f32'))
+            with patch.object(LocalSearchBackend, 'NORM_CHUNK_ROWS', 7):
+                backend = LocalSearchBackend(binary_file)
+                self.assertIsInstance(backend._vectors, np.memmap)
+                for row in (0, 17, len(self.rows) - 1):
+                    self.assertEqual(
+                        backend.search_vector(self.rows[row]['embedding'], 5),
+                        self.backend.search_vector(self.rows[row]['embedding'], 5))
+                self.assertIsInstance(backend._vectors, np.memmap)
+            del backend
+
+    def test_search_keywords(self):
+        """Test that BM25 ranks the documents with the rare query words first."""
+        rows = self.backend.search_keywords("TrailMaster X4 Tent", 5)
+        self.assertTrue(rows)
+        self.assertEqual(self.rows[rows[0]]['title'], 'product_info_1.md')
+        self.assertEqual(self.backend.search_keywords("qwertyuiop", 5), [])
+
+    async def test_search_index_manager_backend(self):
+        """Test that SearchIndexManager formats the results of the backend without the index."""
+        rag = SearchIndexManager(
+            endpoint="",
+            credential=AsyncMock(),
+            index_name="test_index",
+            dimensions=100,
+            model="mock_embedding_model",
+            deployment_name="mock_embedding_model",
+            embedding_endpoint="",
+            embed_api_key=None,
+            backend=self.backend,
+        )
+        row = self.rows[5]
+        result = await rag.search(row['token'], k=2)
+        self.assertTrue(result.startswith(f"{row['token']}, source: {row['title']}\n------\n"))
+        self.assertEqual(result.count("\n------\n"), 1)
+        result = await rag.semantic_search("TrailMaster X4 Tent", k=3)
+        self.assertEqual(result.count("\n------\n"), 2)
+        self.assertIn("source: product_info_1.md", result.split("\n------\n")[0])
+        await rag.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
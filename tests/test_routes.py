@@ -0,0 +1,401 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from azure.ai.agents.models import MessageDeltaChunk, ThreadMessage
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from fastapi import HTTPException
+
+from api import routes
+from api.admission import AdmissionController
+from api.file_name_cache import FileNameCache
+from api.history_cache import ThreadHistoryCache
+from api.latency import LatencyRecorder
+from api.run_stream import StreamRegistry
+from api.stream_journal import StreamJournal
+from api.thread_pool import WarmThreadPool
+from api.thread_registry import ThreadRegistry
+
+
+def get_message(number, status="completed"):
+    """Get the thread message with the number in its identifier."""
+    return ThreadMessage({
+        'id': f'msg_{number:04d}',
+        'thread_id': 'thread',
+        'role': 'user' if number % 2 else 'assistant',
+        'status': status,
+        'created_at': 1700000000 + number,
+        'content': [{'type': 'text', 'text': {'value': f'text {number}', 'annotations': []}}]})
+
+
+class FakePage:
+    """The page of the messages."""
+
+    def __init__(self, items):
+        self._items = items
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for item in self._items:
+            yield item
+
+
+class FakeMessages:
+    """The messages operations over the thread, listing the messages newest first."""
+
+    DEFAULT_LIMIT = 20
+
+    def __init__(self, count):
+        self.messages = [get_message(number) for number in range(count, 0, -1)]
+        self.requests = []
+        self.deleted_threads = set()
+
+    def list(self, thread_id, limit=None, before=None):
+        if thread_id in self.deleted_threads:
+            raise ResourceNotFoundError("No thread found.")
+        if limit is not None and not 1 <= limit <= 100:
+            raise HttpResponseError("The limit must be between 1 and 100.")
+        return SimpleNamespace(by_page=lambda continuation_token=None: self._pages(
+            limit or FakeMessages.DEFAULT_LIMIT, before, continuation_token))
+
+    async def _pages(self, limit, before, after):
+        ids = [message.id for message in self.messages]
+        while True:
+            self.requests.append({'limit': limit, 'before': before, 'after': after})
+            end = ids.index(before) if before else len(ids)
+            start = ids.index(after) + 1 if after else 0
+            if before and not after:
+                start = max(start, end - limit)
+            items = self.messages[start:min(end, start + limit)]
+            yield FakePage(items)
+            if not items:
+                return
+            after = items[-1].id
+
+
+class FakeRunStream:
+    """The run stream, which sends the deltas to the event handler."""
+
+    def __init__(self, event_handler, deltas, run=None, delay=0.0):
+        self._event_handler = event_handler
+        self._deltas = deltas
+        self._run = run
+        self._delay = delay
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        if self._run is not None:
+            yield 'thread.run.created', self._run, await self._event_handler.on_thread_run(self._run)
+        for text in self._deltas:
+            await asyncio.sleep(self._delay)
+            delta = MessageDeltaChunk({'id': 'delta', 'object': 'thread.message.delta', 'delta': {
+                'role': 'assistant', 'content': [{'index': 0, 'type': 'text', 'text': {'value': text}}]}})
+            yield 'thread.message.delta', delta, await self._event_handler.on_message_delta(delta)
+        yield 'done', 'done', await self._event_handler.on_done()
+
+
+class FakeRuns:
+    """The runs operations, which stream the fixed answer."""
+
+    def __init__(self, messages):
+        self._messages = messages
+        self.calls = []
+        self.cancelled = []
+        self.deltas = ['Hello', ' world']
+        self.run = None
+        self.delay = 0.0
+
+    async def stream(self, thread_id, agent_id, additional_messages, event_handler):
+        self.calls.append((thread_id, [message.content for message in additional_messages]))
+        if thread_id in self._messages.deleted_threads:
+            raise ResourceNotFoundError("No thread found.")
+        return FakeRunStream(event_handler, self.deltas, self.run, self.delay)
+
+    async def cancel(self, thread_id, run_id):
+        self.cancelled.append((thread_id, run_id))
+
+
+class TestRoutes(unittest.IsolatedAsyncioTestCase):
+    """Tests for the chat history route."""
+
+    def setUp(self) -> None:
+        self.messages = FakeMessages(250)
+        self.runs = FakeRuns(self.messages)
+        self.chat_metrics = LatencyRecorder()
+        self.stream_registry = StreamRegistry(grace=0.05)
+        self.admission = AdmissionController(max_active=1, max_waiting=0)
+        self.stream_metrics = self.stream_registry.metrics
+        self.agent_client = SimpleNamespace(
+            messages=self.messages,
+            runs=self.runs,
+            threads=SimpleNamespace(get=self._get_thread, create=self._create_thread))
+        self.history_cache = ThreadHistoryCache()
+        self.file_name_cache = FileNameCache()
+        self.thread_registry = ThreadRegistry(path=None)
+        self.thread_pool = WarmThreadPool(self.agent_client, size=0)
+        self.thread_requests = 0
+        unittest.TestCase.setUp(self)
+
+    async def _get_thread(self, thread_id):
+        self.thread_requests += 1
+        return SimpleNamespace(id=thread_id)
+
+    async def _create_thread(self):
+        self.thread_requests += 1
+        return SimpleNamespace(id=f'new_thread_{self.thread_requests}')
+
+    async def _history(self, limit=None, after=None, before=None, stream=False):
+        request = SimpleNamespace(cookies={'thread_id': 'thread', 'agent_id': 'agent'})
+        self.messages.requests.clear()
+        return await routes.history(
+            request, limit=limit, after=after, before=before, stream=stream,
+            ai_project=SimpleNamespace(agents=self.agent_client), agent=SimpleNamespace(id='agent'),
+            file_name_cache=self.file_name_cache, history_cache=self.history_cache,
+            thread_registry=self.thread_registry, thread_pool=self.thread_pool, _=None)
+
+    async def _chat(self, thread_id='thread', last_event_id=None):
+        async def get_json():
+            return {'message': 'hello'}
+
+        async def is_disconnected():
+            return False
+
+        request = SimpleNamespace(
+            cookies={'thread_id': thread_id, 'agent_id': 'agent'}, json=get_json, is_disconnected=is_disconnected,
+            headers={'last-event-id': last_event_id} if last_event_id else {})
+        return await routes.chat(
+            request, agent=SimpleNamespace(id='agent'), ai_project=SimpleNamespace(agents=self.agent_client),
+            evaluation_dispatcher=None, file_name_cache=self.file_name_cache,
+            history_cache=self.history_cache, thread_registry=self.thread_registry,
+            thread_pool=self.thread_pool, chat_metrics=self.chat_metrics, stream_registry=self.stream_registry,
+            admission=self.admission, _=None)
+
+    async def test_full_history_is_cached(self):
+        """Test that the reopened thread costs one request for the new messages."""
+        response = await self._history()
+        content = json.loads(response.body)
+        self.assertEqual([message['id'] for message in content], [message.id for message in self.messages.messages])
+        self.assertEqual(content[0]['content'], 'text 250')
+        self.assertEqual(len(self.messages.requests), 4)
+
+        response = await self._history()
+        self.assertEqual(json.loads(response.body), content)
+        self.assertEqual(self.messages.requests, [{'limit': 100, 'before': 'msg_0250', 'after': None}])
+
+        self.messages.messages[:0] = [get_message(252), get_message(251)]
+        content = json.loads((await self._history()).body)
+        self.assertEqual([message['id'] for message in content[:3]], ['msg_0252', 'msg_0251', 'msg_0250'])
+        self.assertEqual(len(content), 252)
+        self.assertEqual(len(self.messages.requests), 1)
+
+    async def test_incomplete_thread_is_not_cached(self):
+        """Test that the thread with the message in progress is fetched again."""
+        self.messages.messages[0] = get_message(250, status="in_progress")
+        await self._history()
+        await self._history()
+        self.assertEqual(len(self.messages.requests), 4)
+
+    async def test_pagination(self):
+        """Test that the pages are fetched with one request and the cursors are returned in headers."""
+        response = await self._history(limit=10)
+        content = json.loads(response.body)
+        self.assertEqual([message['id'] for message in content], [f'msg_{n:04d}' for n in range(250, 240, -1)])
+        self.assertEqual(response.headers['X-Has-More'], 'true')
+        self.assertEqual(response.headers['X-First-Id'], 'msg_0250')
+        self.assertEqual(response.headers['X-Last-Id'], 'msg_0241')
+        self.assertEqual(self.messages.requests, [{'limit': 11, 'before': None, 'after': None}])
+
+        response = await self._history(limit=99, after='msg_0241')
+        self.assertEqual(len(json.loads(response.body)), 99)
+        self.assertEqual(response.headers['X-Has-More'], 'true')
+        response = await self._history(limit=99, after='msg_0041')
+        self.assertEqual(len(json.loads(response.body)), 40)
+        self.assertEqual(response.headers['X-Has-More'], 'false')
+
+        # The cached thread is paged locally after the refresh request.
+        await self._history()
+        response = await self._history(limit=5, before='msg_0241')
+        self.assertEqual([message['id'] for message in json.loads(response.body)],
+                         [f'msg_{n:04d}' for n in range(246, 241, -1)])
+        self.assertEqual(response.headers['X-Has-More'], 'true')
+        self.assertEqual(len(self.messages.requests), 1)
+
+    async def test_largest_page(self):
+        """Test that the largest page does not request more messages than the service lists."""
+        response = await self._history(limit=routes.HISTORY_PAGE_LIMIT)
+        self.assertEqual(len(json.loads(response.body)), routes.HISTORY_PAGE_LIMIT - 1)
+        self.assertEqual(response.headers['X-Has-More'], 'true')
+        self.assertEqual(self.messages.requests[0]['limit'], routes.HISTORY_PAGE_LIMIT)
+
+    async def test_stream(self):
+        """Test that the messages are streamed as the newline delimited JSON."""
+        response = await self._history(stream=True)
+        self.assertEqual(response.media_type, "application/x-ndjson")
+        lines = [line async for line in response.body_iterator]
+        self.assertEqual(len(lines), 250)
+        self.assertEqual(json.loads(lines[0])['id'], 'msg_0250')
+        self.assertIsNotNone(self.history_cache.get('thread'))
+
+    async def test_known_thread_is_not_requested(self):
+        """Test that the thread is requested only once and then trusted."""
+        await self._history()
+        await self._history()
+        await self._chat()
+        self.assertEqual(self.thread_requests, 1)
+        self.assertEqual(self.thread_registry.stats()['hits'], 2)
+
+    async def test_missing_thread_is_replaced(self):
+        """Test that the deleted known thread is replaced by the new one."""
+        await self._history()
+        self.messages.deleted_threads.add('thread')
+        response = await self._history()
+        self.assertEqual(json.loads(response.body), [])
+        self.assertIn('thread_id=new_thread_2', response.headers['set-cookie'])
+        self.assertFalse(await self.thread_registry.is_known('thread', 'agent'))
+
+        await self.thread_registry.remember('thread', 'agent')
+        response = await self._chat()
+        events = [event async for event in response.body_iterator]
+        self.assertEqual([thread_id for thread_id, _ in self.runs.calls], ['thread', 'new_thread_3'])
+        self.assertIn(b'Hello', b''.join(events))
+        self.assertTrue(await self.thread_registry.is_known('new_thread_3', 'agent'))
+
+    async def test_chat_fast_path(self):
+        """Test that the message is posted by the run and the stream starts before the run."""
+        response = await self._chat()
+        self.assertEqual(response.headers['X-Accel-Buffering'], 'no')
+        events = [event async for event in response.body_iterator]
+        self.assertEqual(events[0], routes.SSE_STREAM_START)
+        self.assertEqual([event.split(b'\n')[0].rsplit(b'.', 1)[1] for event in events[1:]], [b'1', b'2', b'3'])
+        self.assertEqual([json.loads(event.split(b'data: ')[1]) for event in events[1:]], [
+            {'content': 'Hello', 'type': 'message'},
+            {'content': ' world', 'type': 'message'},
+            {'type': 'stream_end'}])
+        self.assertEqual(self.runs.calls, [('thread', ['hello'])])
+        stats = self.chat_metrics.stats()
+        self.assertEqual(stats['ttfb']['count'], 1)
+        self.assertEqual(stats['ttft']['count'], 1)
+        self.assertLessEqual(stats['ttfb']['p99_ms'], stats['ttft']['p99_ms'])
+
+    async def test_abandoned_run_is_cancelled(self):
+        """Test that the run is cancelled when the client stops reading the stream."""
+        self.runs.run = SimpleNamespace(id='run', thread_id='thread', status='in_progress')
+        self.runs.deltas = ['token'] * 1000
+        self.runs.delay = 0.001
+        self.stream_metrics.record_usage(1000)
+        response = await self._chat()
+        body = response.body_iterator
+        for _ in range(5):
+            await body.__anext__()
+        await body.aclose()
+        await asyncio.sleep(0.01)
+        # The client may still reconnect during the grace period.
+        self.assertEqual(self.runs.cancelled, [])
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.runs.cancelled, [('thread', 'run')])
+        stats = self.stream_metrics.stats()
+        self.assertEqual((stats['started'], stats['cancelled'], stats['completed']), (1, 1, 0))
+        self.assertGreater(stats['estimated_tokens_saved'], 900)
+        self.assertEqual(self.admission.stats()['active'], 0)
+
+    async def test_busy_worker_rejects_run(self):
+        """Test that the run over the limit is rejected with 503 and the slot is freed when the run ends."""
+        self.runs.delay = 0.02
+        response = await self._chat()
+        with self.assertRaises(HTTPException) as context:
+            await self._chat()
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertGreaterEqual(int(context.exception.headers['Retry-After']), 1)
+
+        [event async for event in response.body_iterator]
+        self.assertEqual(len(self.runs.calls), 1)
+        await asyncio.sleep(0)
+        response = await self._chat()
+        [event async for event in response.body_iterator]
+        self.assertEqual(len(self.runs.calls), 2)
+        stats = self.admission.stats()
+        self.assertEqual((stats['admitted'], stats['rejected'], stats['active']), (2, 1, 0))
+
+    async def test_interrupted_stream_is_resumed(self):
+        """Test that the reconnected client continues the same run without starting a new one."""
+        self.stream_registry = StreamRegistry(grace=1)
+        self.stream_metrics = self.stream_registry.metrics
+        self.runs.deltas = [f'token {n} ' for n in range(20)]
+        self.runs.delay = 0.001
+        response = await self._chat()
+        body = response.body_iterator
+        events = [await body.__anext__() for _ in range(4)]
+        await body.aclose()
+        last_event_id = events[-1].split(b'\n')[0][len(b'id: '):].decode()
+
+        response = await self._chat(last_event_id=last_event_id)
+        resumed = [event async for event in response.body_iterator]
+        self.assertEqual(resumed[0], routes.SSE_STREAM_START)
+        text = ''.join(json.loads(event.split(b'data: ')[1]).get('content', '') for event in events[1:] + resumed[1:])
+        self.assertEqual(text, ''.join(self.runs.deltas))
+        self.assertEqual(len(self.runs.calls), 1)
+        self.assertEqual(self.runs.cancelled, [])
+        self.assertEqual(self.stream_metrics.stats()['resumed'], 1)
+
+        # The stream, which is not known anymore, is rejected without posting the message again.
+        with self.assertRaises(HTTPException) as context:
+            await self._chat(last_event_id='unknown.3')
+        self.assertEqual(context.exception.status_code, 410)
+        self.assertEqual(len(self.runs.calls), 1)
+
+    async def test_stream_is_resumed_in_another_worker(self):
+        """Test that the client reconnected to another worker continues the run through the journal."""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'streams.sqlite3')
+            self.stream_registry = StreamRegistry(grace=1, journal=StreamJournal(path))
+            self.runs.deltas = [f'token {n} ' for n in range(20)]
+            self.runs.delay = 0.005
+            response = await self._chat()
+            body = response.body_iterator
+            events = [await body.__anext__() for _ in range(4)]
+            await body.aclose()
+            last_event_id = events[-1].split(b'\n')[0][len(b'id: '):].decode()
+
+            self.stream_registry = StreamRegistry(grace=1, journal=StreamJournal(path))
+            response = await self._chat(last_event_id=last_event_id)
+            resumed = [event async for event in response.body_iterator]
+            text = ''.join(
+                json.loads(event.split(b'data: ')[1]).get('content', '') for event in events[1:] + resumed[1:])
+            self.assertEqual(text, ''.join(self.runs.deltas))
+            self.assertEqual(len(self.runs.calls), 1)
+            self.assertEqual(self.runs.cancelled, [])
+            self.assertEqual(self.stream_registry.metrics.stats()['shared_resumes'], 1)
+
+    async def test_registry_is_shared(self):
+        """Test that the registries with the same file share the known threads."""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'threads.sqlite3')
+            first, second = ThreadRegistry(path), ThreadRegistry(path)
+            await first.remember('thread', 'agent')
+            self.assertTrue(await second.is_known('thread', 'agent'))
+            self.assertFalse(await second.is_known('thread', 'other_agent'))
+            await second.forget('thread')
+            self.assertFalse(await ThreadRegistry(path).is_known('thread', 'agent'))
+            expired = ThreadRegistry(path, ttl=-1)
+            await expired.remember('old_thread', 'agent')
+            self.assertFalse(await first.is_known('old_thread', 'agent'))
+
+
+if __name__ == "__main__":
+    unittest.main()
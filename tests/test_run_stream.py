@@ -0,0 +1,189 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import os
+import tempfile
+import unittest
+
+from api.run_stream import StreamMetrics, StreamRegistry, format_event_id, parse_event_id
+from api.stream_journal import StreamJournal
+
+
+class TestResumableStream(unittest.IsolatedAsyncioTestCase):
+    """Tests for the relay of the run events to the client."""
+
+    def setUp(self) -> None:
+        self.produced = 0
+        self.source_closed = False
+        self.disconnected = False
+        self.cancelled = 0
+        self.registry = StreamRegistry(buffer_size=16, max_ahead=4, grace=0.05)
+        self.metrics = self.registry.metrics
+        unittest.TestCase.setUp(self)
+
+    async def _source(self, count, delay=0.0):
+        try:
+            for i in range(count):
+                if delay:
+                    await asyncio.sleep(delay)
+                self.produced += 1
+                yield f"data: {i}\n\n".encode()
+        finally:
+            self.source_closed = True
+
+    async def _is_disconnected(self):
+        return self.disconnected
+
+    async def _on_abandon(self):
+        self.cancelled += 1
+
+    def _subscribe(self, stream, last_event=0, poll_interval=0.01):
+        return stream.subscribe(last_event, self._is_disconnected, poll_interval)
+
+    async def test_all_events_are_relayed(self):
+        """Test that the events are relayed in order with the identifiers and nothing is cancelled."""
+        stream = self.registry.create('thread', self._source(10), self._on_abandon)
+        events = [event async for event in self._subscribe(stream)]
+        self.assertEqual(events, [
+            f"id: {stream.stream_id}.{i + 1}\ndata: {i}\n\n".encode() for i in range(10)])
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.cancelled, 0)
+        self.assertTrue(self.source_closed)
+
+    async def test_slow_client_bounds_buffer(self):
+        """Test that the source is not read ahead of the slow client by more than max_ahead events."""
+        stream = self.registry.create('thread', self._source(50), self._on_abandon)
+        consumed = 0
+        async for _ in self._subscribe(stream):
+            consumed += 1
+            self.assertLessEqual(self.produced - consumed, 4 + 1)
+            await asyncio.sleep(0.001)
+        self.assertEqual(consumed, 50)
+        self.assertGreater(self.metrics.backpressure_waits, 0)
+
+    async def test_reconnect_replays_missed_events(self):
+        """Test that the reconnected client gets the missed events and then the live ones."""
+        stream = self.registry.create('thread', self._source(30, delay=0.001), self._on_abandon)
+        first = self._subscribe(stream)
+        received = [await first.__anext__() for _ in range(5)]
+        await first.aclose()
+        # The events produced while the client was away are kept up to max_ahead.
+        await asyncio.sleep(0.02)
+        self.assertLess(self.produced, 30)
+
+        last_id = parse_event_id(received[2].split(b"\n")[0][len(b"id: "):].decode())
+        self.assertEqual(last_id, (stream.stream_id, 3))
+        resumed = self.registry.get(stream.stream_id, 'thread')
+        self.assertIs(resumed, stream)
+        self.assertIsNone(self.registry.get(stream.stream_id, 'other_thread'))
+        events = [event async for event in self._subscribe(resumed, last_event=last_id[1])]
+        self.assertEqual(events[0], received[3])
+        self.assertEqual(len(events), 27)
+        self.assertEqual(self.produced, 30)
+        self.assertEqual(self.cancelled, 0)
+        self.assertEqual(self.metrics.replayed_events, 6)
+
+    async def test_new_connection_detaches_old_one(self):
+        """Test that only the last connected client receives the events."""
+        stream = self.registry.create('thread', self._source(20, delay=0.001), self._on_abandon)
+        first = self._subscribe(stream)
+        await first.__anext__()
+        events = [event async for event in self._subscribe(stream, last_event=1)]
+        self.assertEqual(len(events), 19)
+        with self.assertRaises(StopAsyncIteration):
+            await first.__anext__()
+        self.assertEqual(self.cancelled, 0)
+
+    async def test_disconnect_cancels_after_grace(self):
+        """Test that the run is cancelled when the client does not come back during the grace period."""
+        stream = self.registry.create('thread', self._source(1000, delay=0.001), self._on_abandon)
+        received = []
+        async for event in self._subscribe(stream):
+            received.append(event)
+            if len(received) == 5:
+                self.disconnected = True
+        self.assertLess(len(received), 1000)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.cancelled, 0)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.cancelled, 1)
+        self.assertTrue(self.source_closed)
+        self.assertLess(self.produced, 1000)
+        self.assertIsNone(self.registry.get(stream.stream_id, 'thread'))
+
+    async def test_source_error_ends_stream(self):
+        """Test that the error of the source ends the stream without cancelling anything."""
+        async def failing():
+            yield b"data: first\n\n"
+            raise RuntimeError("Service unavailable")
+
+        stream = self.registry.create('thread', failing(), self._on_abandon)
+        events = [event async for event in self._subscribe(stream)]
+        self.assertEqual(len(events), 1)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.cancelled, 0)
+
+    async def test_resume_in_another_worker(self):
+        """Test that the client follows the run of another worker through the journal and keeps it running."""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'streams.sqlite3')
+            owner = StreamRegistry(buffer_size=16, max_ahead=4, grace=0.3, journal=StreamJournal(path))
+            other = StreamRegistry(grace=0.3, journal=StreamJournal(path))
+            stream = owner.create('thread', self._source(40, delay=0.02), self._on_abandon)
+            first = self._subscribe(stream)
+            received = [await first.__anext__() for _ in range(3)]
+            await first.aclose()
+
+            self.assertIsNone(await other.subscribe_shared(
+                stream.stream_id, 'other_thread', 3, self._is_disconnected, 0.01))
+            self.assertIsNone(await other.subscribe_shared('unknown', 'thread', 3, self._is_disconnected, 0.01))
+            shared = await other.subscribe_shared(stream.stream_id, 'thread', 3, self._is_disconnected, 0.01)
+            events = received + [event async for event in shared]
+            # The run took longer than the grace period without the client in the owner worker.
+            self.assertEqual(events, [
+                f"id: {stream.stream_id}.{i + 1}\ndata: {i}\n\n".encode() for i in range(40)])
+            self.assertEqual(self.cancelled, 0)
+            self.assertFalse(stream.abandoned)
+            await stream._journal_task
+
+    async def test_shared_stream_is_abandoned(self):
+        """Test that the run is cancelled when the client of another worker has gone."""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'streams.sqlite3')
+            owner = StreamRegistry(buffer_size=16, max_ahead=4, grace=0.1, journal=StreamJournal(path))
+            other = StreamRegistry(grace=0.1, journal=StreamJournal(path))
+            stream = owner.create('thread', self._source(1000, delay=0.005), self._on_abandon)
+            await asyncio.sleep(0.02)
+            shared = await other.subscribe_shared(stream.stream_id, 'thread', 0, self._is_disconnected, 0.01)
+            received = 0
+            async for _ in shared:
+                received += 1
+                if received == 5:
+                    self.disconnected = True
+            await asyncio.wait_for(stream._journal_task, timeout=5)
+            self.assertTrue(stream.abandoned)
+            self.assertEqual(self.cancelled, 1)
+            self.assertLess(self.produced, 1000)
+
+    def test_event_id(self):
+        """Test that the event identifiers are parsed back and the invalid ones are ignored."""
+        self.assertEqual(parse_event_id(format_event_id('a-b_c', 12)), ('a-b_c', 12))
+        for value in (None, '', '12', 'stream.', 'stream.x', '.5'):
+            self.assertIsNone(parse_event_id(value))
+
+    def test_tokens_saved(self):
+        """Test that the saved tokens are estimated from the completed runs."""
+        metrics = StreamMetrics()
+        metrics.record_usage(100)
+        metrics.record_usage(300)
+        metrics.record_cancelled(50)
+        metrics.record_cancelled(500)
+        stats = metrics.stats()
+        self.assertEqual(stats['cancelled'], 2)
+        self.assertEqual(stats['average_completion_tokens'], 200)
+        self.assertEqual(stats['estimated_tokens_saved'], 150)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
+import asyncio
 import csv
 import json
 import os
@@ -10,9 +11,12 @@ from unittest.mock import AsyncMock, patch
 from azure.identity.aio import DefaultAzureCredential
 
 from search_index_manager import SearchIndexManager
+from api.embeddings_store import convert_csv_to_binary, iter_embeddings, write_manifest
 from azure.ai.projects.aio import AIProjectClient
 from azure.ai.projects.models._enums import ConnectionType
-from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.search.documents.indexes.models import SearchField, SearchFieldDataType, SearchIndex, SimpleField
+from azure.search.documents.models import VectorizableTextQuery
 
 from ddt import ddt, data
 
@@ -29,18 +33,160 @@ class MockAsyncIterator:
             yield dt
 
 
+class IndexingResult:
+
+    def __init__(self, succeeded):
+        self.succeeded = succeeded
+
+
+class FakeUploadClient:
+    """The search client, which records the uploaded batches and fails on demand."""
+
+    def __init__(self, latency=0.01, failing_calls=(), failing_documents=0, failing_status=503):
+        self._latency = latency
+        self._failing_status = failing_status
+        self._failing_calls = set(failing_calls)
+        self._failing_documents = failing_documents
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.uploaded = []
+
+    async def upload_documents(self, documents):
+        self.calls += 1
+        call = self.calls
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._latency)
+        finally:
+            self.in_flight -= 1
+        if call in self._failing_calls:
+            error = HttpResponseError('Mock http error')
+            error.status_code = self._failing_status
+            raise error
+        results = []
+        for document in documents:
+            if self._failing_documents:
+                self._failing_documents -= 1
+                results.append(IndexingResult(False))
+            else:
+                self.uploaded.append(document)
+                results.append(IndexingResult(True))
+        return results
+
+    async def close(self):
+        pass
+
+
+class FakeEmbeddingClient:
+    """The embedding client, which encodes the text number into the embedding after the latency."""
+
+    def __init__(self, latency=0.05, throttled_calls=()):
+        self._latency = latency
+        self._throttled_calls = set(throttled_calls)
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def embed(self, input, dimensions, model):
+        self.calls += 1
+        call = self.calls
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._latency)
+        finally:
+            self.in_flight -= 1
+        if call in self._throttled_calls:
+            error = HttpResponseError('Too many requests')
+            error.status_code = 429
+            raise error
+        return {'data': [{'embedding': [float(text.split()[-1]), 0.0]} for text in input]}
+
+
+class FakeIndexClient:
+    """The search client, which keeps the index in memory."""
+
+    def __init__(self):
+        self.documents = {}
+        self.uploaded = 0
+        self.deleted = 0
+        self.searches = 0
+
+    async def search(self, search_text, filter=None, order_by=None, select=None, top=None):
+        """Return the keys and fingerprints after the key in the filter, ordered by key."""
+        self.searches += 1
+        assert order_by == ['embedId asc']
+        after = filter.split("'")[1] if filter else ''
+        keys = sorted(key for key in self.documents if key > after)[:top]
+        documents = [{name: self.documents[key].get(name) for name in select} for key in keys]
+        return MockAsyncIterator(documents) if documents else EmptyAsyncIterator()
+
+    async def upload_documents(self, documents):
+        self.uploaded += len(documents)
+        self.documents.update((document['embedId'], document) for document in documents)
+        return [IndexingResult(True) for _ in documents]
+
+    async def delete_documents(self, documents):
+        self.deleted += len(documents)
+        for document in documents:
+            self.documents.pop(document['embedId'], None)
+        return [IndexingResult(True) for _ in documents]
+
+    async def close(self):
+        pass
+
+
+class EmptyAsyncIterator:
+
+    async def __aiter__(self):
+        return
+        yield
+
+
+class FakeSearchClient:
+    """The local search client, which answers after the given latency."""
+
+    def __init__(self, list_data, latency=0.05, empty_responses=0, failed_calls=()):
+        self._data = list_data
+        self._latency = latency
+        self._empty_responses = empty_responses
+        self._failed_calls = set(failed_calls)
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.vector_queries = []
+
+    async def search(self, **kwargs):
+        self.calls += 1
+        call = self.calls
+        self.vector_queries.extend(kwargs.get('vector_queries', []))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._latency)
+        finally:
+            self.in_flight -= 1
+        if call in self._failed_calls:
+            raise HttpResponseError('Service unavailable')
+        if self._empty_responses:
+            self._empty_responses -= 1
+            return EmptyAsyncIterator()
+        return MockAsyncIterator(self._data)
+
+    async def close(self):
+        pass
+
+
 @ddt
 class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
     """Tests for the RAG helper."""
 
-    INPUT_DIR = os.path.join(
-                os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'files')
-    # INPUT_DIR = os.path.join(
-    #     os.path.dirname(
-    #         os.path.dirname(
-    #             os.path.dirname(os.path.dirname(__file__)))), 'data_')
-    EMBEDDINGS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
-                                   'data', 'embeddings.csv')
+    SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    INPUT_DIR = os.path.join(SRC_DIR, 'files')
+    EMBEDDINGS_FILE = os.path.join(SRC_DIR, 'data', 'embeddings.csv')
+    LARGE_EMBEDDINGS_FILE = os.path.join(SRC_DIR, 'api', 'data', 'embeddings.csv')
 
     @classmethod
     def setUpClass(cls) -> None:
@@ -192,6 +338,416 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
                 self.assertEqual(search_result,
                                  "a, source: a.txt\n------\nb, source: b.txt")
 
+    @patch.object(SearchIndexManager, 'UPLOAD_RETRY_BACKOFF', 0)
+    async def test_upload_documents_batches(self):
+        """Test that documents are uploaded in bounded concurrent batches with retries."""
+        upload_client = FakeUploadClient(failing_calls=[2], failing_documents=3)
+        with patch('search_index_manager.SearchClient', return_value=upload_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = AsyncMock()
+            report = await rag.upload_documents(
+                TestSearchIndexManager.LARGE_EMBEDDINGS_FILE,
+                batch_size=100,
+                concurrency=3)
+        with open(TestSearchIndexManager.LARGE_EMBEDDINGS_FILE, newline='') as fp:
+            n_documents = sum(1 for _ in csv.DictReader(fp))
+        self.assertEqual(report, {
+            'batches_succeeded': (n_documents + 99) // 100,
+            'batches_failed': 0,
+            'documents_succeeded': n_documents,
+            'documents_failed': 0,
+        })
+        with open(TestSearchIndexManager.LARGE_EMBEDDINGS_FILE, newline='') as fp:
+            expected_keys = self._get_chunk_ids(csv.DictReader(fp))
+        self.assertEqual(
+            sorted(doc['embedId'] for doc in upload_client.uploaded), sorted(expected_keys))
+        self.assertLessEqual(upload_client.max_in_flight, 3)
+        self.assertGreater(upload_client.max_in_flight, 1)
+
+    async def test_upload_documents_binary(self):
+        """Test that the binary embeddings file uploads the same documents as the CSV file."""
+        uploaded = []
+        with tempfile.TemporaryDirectory() as d:
+            for embeddings_file in (
+                    TestSearchIndexManager.EMBEDDINGS_FILE,
+                    convert_csv_to_binary(TestSearchIndexManager.EMBEDDINGS_FILE, os.path.join(d, 'embeddings.f32'))):
+                upload_client = FakeUploadClient(latency=0)
+                with patch('search_index_manager.SearchClient', return_value=upload_client):
+                    rag = self._get_mock_rag(AsyncMock())
+                    rag._index = AsyncMock()
+                    report = await rag.upload_documents(embeddings_file)
+                self.assertEqual(report['documents_failed'], 0)
+                uploaded.append(sorted(upload_client.uploaded, key=lambda doc: doc['embedId']))
+        csv_documents, binary_documents = uploaded
+        self.assertEqual(len(csv_documents), len(binary_documents))
+        for csv_document, binary_document in zip(csv_documents, binary_documents):
+            self.assertEqual(csv_document['token'], binary_document['token'])
+            self.assertEqual(len(csv_document['embedding']), len(binary_document['embedding']))
+
+    @patch.object(SearchIndexManager, 'UPLOAD_RETRY_BACKOFF', 0)
+    async def test_upload_documents_partial_failure(self):
+        """Test that the batch failed after all retries is reported, the others are uploaded."""
+        upload_client = FakeUploadClient(failing_calls=[1, 2, 3])
+        with patch('search_index_manager.SearchClient', return_value=upload_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = AsyncMock()
+            report = await rag.upload_documents(
+                TestSearchIndexManager.LARGE_EMBEDDINGS_FILE,
+                max_batch_bytes=200000,
+                concurrency=1,
+                max_retries=2)
+        self.assertEqual(report['batches_failed'], 1)
+        self.assertGreater(report['batches_succeeded'], 1)
+        self.assertEqual(report['documents_succeeded'], len(upload_client.uploaded))
+        self.assertGreater(report['documents_failed'], 0)
+
+    @patch.object(SearchIndexManager, 'UPLOAD_RETRY_BACKOFF', 0)
+    async def test_upload_documents_permanent_failure(self):
+        """Test that the batch, rejected by the service, is not retried."""
+        upload_client = FakeUploadClient(latency=0, failing_calls=[1], failing_status=403)
+        with patch('search_index_manager.SearchClient', return_value=upload_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = AsyncMock()
+            with self.assertLogs('azureaiapp', level='ERROR') as logs:
+                report = await rag.upload_documents(
+                    TestSearchIndexManager.EMBEDDINGS_FILE, concurrency=1, max_retries=3)
+        self.assertEqual(upload_client.calls, 1)
+        self.assertEqual(report['batches_failed'], 1)
+        self.assertEqual(report['documents_succeeded'], 0)
+        self.assertIn('Mock http error', logs.output[0])
+
+    @staticmethod
+    def _get_chunk_ids(rows):
+        """Get the keys of the rows without embedId, the same as build_embeddings_file gives."""
+        rows_by_title = {}
+        for row in rows:
+            rows_by_title.setdefault(row['title'], []).append(row['token'])
+        return [embed_id for title, tokens in rows_by_title.items()
+                for embed_id in SearchIndexManager._get_chunk_ids(title, tokens)]
+
+    @staticmethod
+    def _get_index(fingerprint=True, schema_version=SearchIndexManager.SCHEMA_VERSION):
+        """Get the index with or without the fingerprint field and with the key of the given schema version."""
+        sortable = schema_version >= 2
+        fields = [
+            SimpleField(
+                name='embedId', type=SearchFieldDataType.String, key=True, filterable=sortable, sortable=sortable),
+            SearchField(
+                name='embedding', type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                vector_search_dimensions=2),
+        ]
+        if fingerprint:
+            fields.append(SearchIndexManager._get_fingerprint_field())
+        return SearchIndex(name='index', fields=fields)
+
+    @patch.object(SearchIndexManager, 'KEY_PAGE_SIZE', 7)
+    async def test_sync_documents(self):
+        """Test that only the changed documents are sent to the index."""
+        index_client = FakeIndexClient()
+        with patch('search_index_manager.SearchClient', return_value=index_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = self._get_index()
+            with tempfile.TemporaryDirectory() as d:
+                embeddings_file = os.path.join(d, 'embeddings.csv')
+                with open(TestSearchIndexManager.LARGE_EMBEDDINGS_FILE, newline='') as fp:
+                    rows = list(csv.DictReader(fp))
+                n_documents = len(rows)
+                with open(embeddings_file, 'w', newline='') as fp:
+                    writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
+                    writer.writeheader()
+                    writer.writerows(rows)
+
+                report = await rag.sync_documents(embeddings_file, batch_size=100)
+                self.assertEqual(report['documents_to_upload'], n_documents)
+                self.assertEqual(report['documents_to_delete'], 0)
+                self.assertEqual(len(index_client.documents), n_documents)
+
+                # Nothing changed, nothing is sent. The keys are read page by page.
+                index_client.uploaded = 0
+                index_client.searches = 0
+                report = await rag.sync_documents(embeddings_file, batch_size=100)
+                self.assertEqual(report['documents_unchanged'], n_documents)
+                self.assertEqual(index_client.uploaded, 0)
+                self.assertEqual(index_client.deleted, 0)
+                self.assertEqual(index_client.searches, n_documents // 7 + 1)
+
+                # Insert one row at the beginning, edit one and delete two rows.
+                rows.insert(0, dict(rows[0], token='The new chunk'))
+                rows[10] = dict(rows[10], token=rows[10]['token'] + ' Edited.')
+                del rows[20:22]
+                with open(embeddings_file, 'w', newline='') as fp:
+                    writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
+                    writer.writeheader()
+                    writer.writerows(rows)
+                report = await rag.sync_documents(embeddings_file, batch_size=100)
+                self.assertEqual(report['documents_to_upload'], 2)
+                self.assertEqual(report['documents_to_delete'], 3)
+                self.assertEqual(report['documents_failed'], 0)
+                self.assertEqual(index_client.uploaded, 2)
+                self.assertEqual(index_client.deleted, 3)
+                self.assertEqual(set(index_client.documents), set(self._get_chunk_ids(rows)))
+
+                # The embeddings of another model replace all documents under the same keys.
+                index_client.uploaded = 0
+                index_client.deleted = 0
+                write_manifest(embeddings_file, {'model': 'other-model'})
+                report = await rag.sync_documents(embeddings_file, batch_size=100)
+                self.assertEqual(report['documents_to_upload'], len(rows))
+                self.assertEqual(report['documents_unchanged'], 0)
+                self.assertEqual((index_client.uploaded, index_client.deleted), (len(rows), 0))
+
+    async def test_sync_documents_adds_fingerprint(self):
+        """Test that the fingerprint field is added to the index, created without it."""
+        index_client = FakeIndexClient()
+        ix_client = AsyncMock()
+        ix_client.__aenter__.return_value = ix_client
+        ix_client.create_or_update_index.side_effect = lambda index: index
+        with patch('search_index_manager.SearchClient', return_value=index_client), \
+                patch('search_index_manager.SearchIndexClient', return_value=ix_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = self._get_index(fingerprint=False)
+            report = await rag.sync_documents(TestSearchIndexManager.EMBEDDINGS_FILE)
+        ix_client.create_or_update_index.assert_called_once()
+        self.assertIn('fingerprint', [field.name for field in rag._index.fields])
+        self.assertEqual(report['documents_failed'], 0)
+        self.assertTrue(all(document['fingerprint'] for document in index_client.documents.values()))
+
+    async def test_sync_documents_rebuilds_old_index(self):
+        """Test that the index with the key, which is not sortable, is recreated once."""
+        index_client = FakeIndexClient()
+        index_client.documents['stale'] = {'embedId': 'stale'}
+        ix_client = AsyncMock()
+        ix_client.__aenter__.return_value = ix_client
+        ix_client.create_index.side_effect = lambda index: index
+        ix_client.delete_index.side_effect = lambda name: index_client.documents.clear()
+        with patch('search_index_manager.SearchClient', return_value=index_client), \
+                patch('search_index_manager.SearchIndexClient', return_value=ix_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = self._get_index(fingerprint=False, schema_version=1)
+            report = await rag.sync_documents(TestSearchIndexManager.EMBEDDINGS_FILE)
+            self.assertEqual(report['index_rebuilt'], 1)
+            self.assertEqual(report['documents_failed'], 0)
+            self.assertEqual(report['documents_to_upload'], len(index_client.documents))
+            ix_client.delete_index.assert_called_once_with('index')
+            created = ix_client.create_index.call_args.args[0]
+            self.assertEqual(SearchIndexManager._get_schema_version(created), SearchIndexManager.SCHEMA_VERSION)
+            embedding = next(field for field in created.fields if field.name == 'embedding')
+            self.assertEqual(embedding.vector_search_dimensions, 2)
+            self.assertNotIn('stale', index_client.documents)
+
+            # The recreated index is synchronized as usual.
+            report = await rag.sync_documents(TestSearchIndexManager.EMBEDDINGS_FILE)
+        self.assertEqual(report['index_rebuilt'], 0)
+        self.assertEqual(report['documents_to_upload'], 0)
+        ix_client.delete_index.assert_called_once()
+
+    async def test_sync_documents_old_index_rebuilt_elsewhere(self):
+        """Test that the index, recreated by another instance at the same time, is synchronized."""
+        index_client = FakeIndexClient()
+        ix_client = AsyncMock()
+        ix_client.__aenter__.return_value = ix_client
+        ix_client.delete_index.side_effect = ResourceNotFoundError('Mock not found')
+        ix_client.create_index.side_effect = HttpResponseError('Mock index exists')
+        ix_client.get_index.return_value = self._get_index()
+        with patch('search_index_manager.SearchClient', return_value=index_client), \
+                patch('search_index_manager.SearchIndexClient', return_value=ix_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = self._get_index(schema_version=1)
+            report = await rag.sync_documents(TestSearchIndexManager.EMBEDDINGS_FILE)
+        self.assertEqual(report['index_rebuilt'], 0)
+        self.assertEqual(report['documents_failed'], 0)
+        self.assertEqual(report['documents_to_upload'], len(index_client.documents))
+        self.assertIs(rag._index, ix_client.get_index.return_value)
+
+    async def test_search_cache(self):
+        """Test that the repeated queries are served from the cache until the index changes."""
+        search_client = FakeSearchClient([{'token': 'a', 'title': 'a.txt'}], latency=0.01)
+        search_client.upload_documents = AsyncMock()
+        with patch('search_index_manager.SearchClient', return_value=search_client):
+            rag = SearchIndexManager(
+                endpoint=self.search_endpoint,
+                credential=AsyncMock(),
+                index_name=self.index_name,
+                dimensions=100,
+                model=self.model,
+                deployment_name=self.model,
+                embedding_endpoint="",
+                embed_api_key=self.embed_key,
+                cache_size=10,
+            )
+            rag._index = AsyncMock()
+            results = await asyncio.gather(
+                rag.search('What is the  temperature rating?'),
+                rag.search('what is the temperature rating?'))
+            self.assertEqual(results, ["a, source: a.txt"] * 2)
+            self.assertEqual(search_client.calls, 1)
+            await rag.search('What is the temperature rating?', k=3)
+            await rag.semantic_search('What is the temperature rating?')
+            self.assertEqual(search_client.calls, 3)
+            await rag.search('What is the temperature rating?')
+            self.assertEqual(search_client.calls, 3)
+            self.assertEqual(rag.cache_stats()['hits'], 1)
+            self.assertEqual(rag.cache_stats()['coalesced'], 1)
+
+            await rag.upload_documents(TestSearchIndexManager.EMBEDDINGS_FILE)
+            await rag.search('What is the temperature rating?')
+            self.assertEqual(search_client.calls, 4)
+
+    async def test_concurrent_search(self):
+        """Test that concurrent searches on the warm index do not block each other."""
+        n_queries = 20
+        search_client = FakeSearchClient([{'token': 'a', 'title': 'a.txt'}], latency=0.05)
+        with patch('search_index_manager.SearchClient', return_value=search_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = AsyncMock()
+            results = await asyncio.gather(*[rag.search(f'query {i}') for i in range(n_queries)])
+        self.assertEqual(results, ["a, source: a.txt"] * n_queries)
+        self.assertEqual(search_client.calls, n_queries)
+        # All searches wait for the service at the same time.
+        self.assertEqual(search_client.max_in_flight, n_queries)
+
+    async def test_search_many(self):
+        """Test that the questions are embedded in one request and searched concurrently."""
+        n_queries = 20
+        embedding_client = FakeEmbeddingClient(latency=0.05)
+        search_client = FakeSearchClient([{'token': 'a', 'title': 'a.txt'}], latency=0.05, failed_calls=[3])
+        with patch('search_index_manager.SearchClient', return_value=search_client):
+            rag = self._get_mock_rag(embedding_client)
+            rag._index = AsyncMock()
+            messages = [f'question {i}' for i in range(n_queries)]
+            results = await rag.search_many(messages, k=3, concurrency=n_queries)
+        self.assertEqual(embedding_client.calls, 1)
+        self.assertEqual(len(results), n_queries)
+        self.assertIsInstance(results[2], HttpResponseError)
+        self.assertEqual(results[:2] + results[3:], ["a, source: a.txt"] * (n_queries - 1))
+        self.assertEqual(
+            sorted(query.vector[0] for query in search_client.vector_queries), [float(i) for i in range(n_queries)])
+        self.assertTrue(all(query.k_nearest_neighbors == 3 for query in search_client.vector_queries))
+        self.assertEqual(search_client.max_in_flight, n_queries)
+
+    async def test_search_many_falls_back_to_vectorizer(self):
+        """Test that the index vectorizer is used if the embedding failed and the concurrency is bounded."""
+        embedding_client = FakeEmbeddingClient(latency=0, throttled_calls=[1])
+        search_client = FakeSearchClient([{'token': 'a', 'title': 'a.txt'}], latency=0.01)
+        with patch('search_index_manager.SearchClient', return_value=search_client):
+            rag = self._get_mock_rag(embedding_client)
+            rag._index = AsyncMock()
+            results = await rag.search_many(['question 1', 'question 2', 'question 1'], concurrency=2)
+        self.assertEqual(results, ["a, source: a.txt"] * 3)
+        self.assertEqual(search_client.max_in_flight, 2)
+        self.assertEqual(
+            [type(query) for query in search_client.vector_queries], [VectorizableTextQuery] * 3)
+
+    async def test_search_waits_for_cold_index(self):
+        """Test that the empty results are retried only while the index is cold."""
+        search_client = FakeSearchClient(
+            [{'token': 'a', 'title': 'a.txt'}], latency=0, empty_responses=2)
+        with patch('search_index_manager.SearchClient', return_value=search_client):
+            rag = SearchIndexManager(
+                endpoint=self.search_endpoint,
+                credential=AsyncMock(),
+                index_name=self.index_name,
+                dimensions=100,
+                model=self.model,
+                deployment_name=self.model,
+                embedding_endpoint="",
+                embed_api_key=self.embed_key,
+                readiness_timeout=1.0,
+                readiness_backoff=0.01,
+            )
+            rag._index = AsyncMock()
+            rag._mark_index_cold()
+            self.assertEqual(await rag.search('test'), "a, source: a.txt")
+            self.assertEqual(search_client.calls, 3)
+
+            # The index is warm now, empty result is returned without retries.
+            search_client._empty_responses = 1
+            self.assertEqual(await rag.search('test'), "")
+            self.assertEqual(search_client.calls, 4)
+
+    @patch.object(SearchIndexManager, 'EMBEDDING_RETRY_BACKOFF', 0)
+    async def test_write_embeddings_concurrently(self):
+        """Test that the batches are embedded concurrently and written in order."""
+        n_texts = 100
+        batch_size = 5
+        sentence_tokens = [f"text {i}" for i in range(n_texts)]
+        references = [f"file_{i}.md" for i in range(n_texts)]
+        for concurrency in (1, 10):
+            embedding_client = FakeEmbeddingClient(latency=0.05, throttled_calls=[3])
+            rag = self._get_mock_rag(embedding_client)
+            with tempfile.TemporaryDirectory() as d:
+                out_file = os.path.join(d, 'embeddings.csv')
+                await rag._write_embeddings(sentence_tokens, references, out_file, batch_size, concurrency)
+                with open(out_file, newline='') as fp:
+                    rows = list(csv.DictReader(fp))
+            self.assertEqual(embedding_client.calls, n_texts // batch_size + 1)
+            self.assertEqual(embedding_client.max_in_flight, concurrency)
+            self.assertEqual([row['token'] for row in rows], sentence_tokens)
+            self.assertEqual([row['title'] for row in rows], references)
+            self.assertEqual([json.loads(row['embedding'])[0] for row in rows], list(range(n_texts)))
+
+    async def test_build_embeddings_file_incremental(self):
+        """Test that only new and changed chunks are embedded and stale ones are deleted."""
+
+        def split(texts):
+            references = [f"file_{i % 3}.md" for i in range(len(texts))]
+            embed_ids = [SearchIndexManager._get_chunk_id(ref, text) for ref, text in zip(references, texts)]
+            return texts, references, embed_ids
+
+        texts = [f"text {i}" for i in range(30)]
+        embedding_client = FakeEmbeddingClient(latency=0)
+        search_client = AsyncMock()
+        with patch('search_index_manager.SearchClient', return_value=search_client):
+            rag = self._get_mock_rag(embedding_client)
+            with tempfile.TemporaryDirectory() as d:
+                for extension in ('.csv', '.f32'):
+                    out_file = os.path.join(d, 'embeddings' + extension)
+                    embedding_client.calls = 0
+                    with patch.object(rag, '_split_documents', return_value=split(texts)):
+                        self.assertEqual(await rag.build_embeddings_file(
+                            d, out_file, batch_size=4, incremental=True), [])
+                    self.assertEqual(embedding_client.calls, 8)
+
+                    # Change one chunk, drop the last one.
+                    new_texts = texts[:-1]
+                    new_texts[5] = "changed 100"
+                    embedding_client.calls = 0
+                    rag._index = AsyncMock()
+                    with patch.object(rag, '_split_documents', return_value=split(new_texts)):
+                        stale_ids = await rag.build_embeddings_file(
+                            d, out_file, batch_size=4, incremental=True)
+                    rag._index = None
+                    self.assertEqual(embedding_client.calls, 1)
+                    self.assertEqual(stale_ids, [split(texts)[2][5], split(texts)[2][-1]])
+                    search_client.delete_documents.assert_called_once_with(
+                        [{'embedId': embed_id} for embed_id in stale_ids])
+                    search_client.delete_documents.reset_mock()
+
+                    rows = list(iter_embeddings(out_file))
+                    self.assertEqual([row['token'] for row in rows], new_texts)
+                    self.assertEqual([row['embedId'] for row in rows], split(new_texts)[2])
+                    self.assertEqual(
+                        [row['embedding'][0] for row in rows],
+                        [float(text.split()[-1]) for text in new_texts])
+
+    def test_chunk_ids_are_stable(self):
+        """Test that inserting a chunk keeps the identifiers of the other chunks and the repeated texts differ."""
+        texts = ["a", "b", "c", "b"]
+        embed_ids = SearchIndexManager._get_chunk_ids('file.md', texts)
+        self.assertEqual(len(set(embed_ids)), 4)
+        new_ids = SearchIndexManager._get_chunk_ids('file.md', ["new"] + texts)
+        self.assertEqual(new_ids[1:], embed_ids)
+        self.assertNotEqual(SearchIndexManager._get_chunk_ids('other.md', texts), embed_ids)
+
+    async def test_embed_batch_raises_not_retriable(self):
+        """Test that the errors other than throttling are not retried."""
+        embedding_client = AsyncMock()
+        embedding_client.embed.side_effect = HttpResponseError('Bad request')
+        rag = self._get_mock_rag(embedding_client)
+        with self.assertRaisesRegex(HttpResponseError, 'Bad request'):
+            await rag._embed_batch(['text'])
+        embedding_client.embed.assert_called_once()
+
     @data(2, 4)
     async def test_build_embeddings_file_mock(self, sentences_per_embedding):
         """Use this test to build
@@ -0,0 +1,108 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import json
+import os
+import time
+import unittest
+
+from api.sse import (
+    DeltaCoalescer, encode_comment, encode_event, encode_message_delta, flush_when_idle, split_events)
+
+
+def parse(event):
+    """Parse the data of the encoded event."""
+    assert event.startswith(b"data: ") and event.endswith(b"\n\n")
+    return json.loads(event[len(b"data: "):])
+
+
+class TestSSE(unittest.TestCase):
+    """Tests for the server-sent events encoder."""
+
+    def test_encode(self):
+        """Test that the events are encoded as the JSON data lines."""
+        for text in ("Hello", "", 'quote " and \\ backslash', "line\nbreak", "юникод 🙂"):
+            self.assertEqual(parse(encode_message_delta(text)), {'content': text, 'type': 'message'})
+        data = {'type': 'completed_message', 'content': 'a', 'annotations': [{'file_name': 'b.md'}]}
+        self.assertEqual(parse(encode_event(data)), data)
+        self.assertEqual(encode_comment("ping"), b": ping\n\n")
+
+    def test_split_events(self):
+        """Test that the chunk of several events is split into the separate events."""
+        first, second = encode_message_delta("a\n\nb"), encode_event({'type': 'stream_end'})
+        self.assertEqual(split_events(first), [first])
+        self.assertEqual(split_events(first + second), [first, second])
+
+    def test_coalescer(self):
+        """Test that the deltas are released by time, size and flush."""
+        now = [0.0]
+        coalescer = DeltaCoalescer(interval=0.02, max_chars=10, clock=lambda: now[0])
+        self.assertIsNone(coalescer.add("ab"))
+        now[0] = 0.01
+        self.assertIsNone(coalescer.add("cd"))
+        now[0] = 0.021
+        self.assertEqual(parse(coalescer.add("ef"))['content'], "abcdef")
+        self.assertEqual(parse(coalescer.add("0123456789"))['content'], "0123456789")
+        self.assertIsNone(coalescer.add("g"))
+        self.assertEqual(parse(coalescer.flush())['content'], "g")
+        self.assertIsNone(coalescer.flush())
+        self.assertEqual((coalescer.deltas, coalescer.events), (5, 3))
+
+        disabled = DeltaCoalescer()
+        self.assertEqual(parse(disabled.add("x"))['content'], "x")
+
+    def test_buffered_text_is_sent_when_idle(self):
+        """Test that the buffered text is sent while the model pauses, not with the next delta."""
+        coalescer = DeltaCoalescer(interval=0.01)
+        resume = asyncio.Event()
+
+        async def events():
+            for text in ("a", "b"):
+                event = coalescer.add(text)
+                if event:
+                    yield event
+            # The model pauses until the client has received the buffered text.
+            await resume.wait()
+            yield encode_event({'type': 'thread_run'})
+
+        async def read():
+            received = []
+            async for event in flush_when_idle(events(), coalescer):
+                received.append(parse(event))
+                resume.set()
+            return received
+
+        received = asyncio.run(asyncio.wait_for(read(), timeout=5))
+        self.assertEqual(received, [{'content': "ab", 'type': 'message'}, {'type': 'thread_run'}])
+        self.assertIsNone(coalescer.due_in())
+
+    def test_coalesced_events(self):
+        """Test that the many small deltas are sent as the few events with the same content."""
+        texts = [f" token{i}" for i in range(100000)]
+        coalescer = DeltaCoalescer(max_chars=64)
+        events = [coalescer.add(text) for text in texts] + [coalescer.flush()]
+        events = [event for event in events if event is not None]
+        self.assertEqual(coalescer.deltas, len(texts))
+        self.assertEqual(coalescer.events, len(events))
+        self.assertLess(coalescer.events, len(texts) / 5)
+        self.assertEqual("".join(parse(event)['content'] for event in events), "".join(texts))
+
+    @unittest.skipUnless(os.environ.get("RUN_BENCHMARKS"), "Only for benchmarks, set RUN_BENCHMARKS=1.")
+    def test_encoder_benchmark(self):
+        """Test that the delta encoder is faster than serializing the dictionary with json."""
+        texts = [f" token{i}" for i in range(100000)]
+
+        def baseline(text):
+            return f"data: {json.dumps({'content': text, 'type': 'message'})}\n\n"
+
+        rates = {}
+        for name, encode in (('json', baseline), ('encoder', encode_message_delta)):
+            start = time.perf_counter()
+            for text in texts:
+                encode(text)
+            rates[name] = len(texts) / (time.perf_counter() - start)
+        self.assertGreater(rates['encoder'], rates['json'])
+
+if __name__ == "__main__":
+    unittest.main()
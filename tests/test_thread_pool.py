@@ -0,0 +1,92 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from api.thread_pool import WarmThreadPool
+
+
+class FakeThreads:
+    """The threads operations, which create the threads after the latency."""
+
+    def __init__(self, latency=0.05, failures=0):
+        self._latency = latency
+        self._failures = failures
+        self.created = 0
+        self.deleted = []
+
+    async def create(self):
+        await asyncio.sleep(self._latency)
+        if self._failures:
+            self._failures -= 1
+            raise RuntimeError("Service unavailable")
+        self.created += 1
+        return SimpleNamespace(id=f"thread_{self.created}")
+
+    async def delete(self, thread_id):
+        self.deleted.append(thread_id)
+
+
+class TestWarmThreadPool(unittest.IsolatedAsyncioTestCase):
+    """Tests for the pool of the warm threads."""
+
+    async def _wait_for_size(self, pool, size):
+        """Wait until the pool holds the given number of threads."""
+        while pool.stats()['size'] < size:
+            await asyncio.sleep(0.01)
+
+    async def test_acquire(self):
+        """Test that the ready thread is taken without waiting and the pool is refilled."""
+        latency = 0.05
+        threads = FakeThreads(latency=latency)
+        pool = WarmThreadPool(SimpleNamespace(threads=threads), size=2)
+        pool.start()
+        await asyncio.wait_for(self._wait_for_size(pool, 2), timeout=5)
+        self.assertEqual(pool.stats()['size'], 2)
+
+        thread = await pool.acquire()
+        self.assertEqual(thread.id, "thread_1")
+        # The ready thread was taken, no thread was created for the request.
+        self.assertEqual((pool.stats()['hits'], pool.stats()['misses']), (1, 0))
+        self.assertEqual(threads.created, 2)
+
+        await pool.acquire()
+        await pool.acquire()
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3)
+        self.assertGreaterEqual(stats['refill_latency_ms'], latency * 1000)
+
+        await asyncio.wait_for(self._wait_for_size(pool, 2), timeout=5)
+        self.assertEqual(pool.stats()['size'], 2)
+        await pool.close()
+        self.assertEqual(len(threads.deleted), 2)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    @patch.object(WarmThreadPool, 'REFILL_RETRY_DELAY', 0)
+    async def test_refill_retries_failures(self):
+        """Test that the refill continues after the failed creation."""
+        threads = FakeThreads(latency=0, failures=1)
+        pool = WarmThreadPool(SimpleNamespace(threads=threads), size=1)
+        pool.start()
+        await asyncio.sleep(0.01)
+        self.assertEqual(pool.stats()['refill_failures'], 1)
+        self.assertEqual(pool.stats()['size'], 1)
+        await pool.close()
+
+    async def test_disabled_pool(self):
+        """Test that the disabled pool creates the threads inline."""
+        threads = FakeThreads(latency=0)
+        pool = WarmThreadPool(SimpleNamespace(threads=threads), size=0)
+        pool.start()
+        self.assertEqual((await pool.acquire()).id, "thread_1")
+        self.assertEqual(threads.created, 1)
+        await pool.close()
+        self.assertEqual(threads.deleted, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from api.vector_store_builder import get_or_create_vector_store, read_manifest
+
+
+class FakeAgentsClient:
+    """The agents client, which keeps the uploaded files and vector stores in memory."""
+
+    def __init__(self, latency=0.01, failing_files=(), failed_in_batch=0):
+        self._latency = latency
+        self._failing_files = set(failing_files)
+        self._failed_in_batch = failed_in_batch
+        self.uploads = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.batches = []
+        self.stores = {}
+        self.file_ids = set()
+        self.files = SimpleNamespace(upload_and_poll=self._upload, list=self._list_files)
+        self.vector_stores = SimpleNamespace(
+            list=self._list_stores, create_and_poll=self._create_store, modify=self._modify_store,
+            delete=self._delete_store)
+        self.vector_store_file_batches = SimpleNamespace(create_and_poll=self._create_batch)
+
+    async def _upload(self, file_path, purpose):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self._latency)
+        self.in_flight -= 1
+        if os.path.basename(file_path) in self._failing_files:
+            raise RuntimeError("Upload failed")
+        self.uploads.append(os.path.basename(file_path))
+        file_id = f'file_{len(self.uploads)}'
+        self.file_ids.add(file_id)
+        return SimpleNamespace(id=file_id)
+
+    async def _list_files(self, purpose):
+        return SimpleNamespace(data=[SimpleNamespace(id=file_id) for file_id in self.file_ids])
+
+    async def _list_stores(self):
+        for store in list(self.stores.values()):
+            yield store
+
+    async def _create_store(self, name):
+        store = SimpleNamespace(
+            id=f'vs_{len(self.stores) + 1}', name=name, metadata={}, status='completed',
+            file_counts=SimpleNamespace(completed=0))
+        self.stores[store.id] = store
+        return store
+
+    async def _modify_store(self, vector_store_id, metadata):
+        self.stores[vector_store_id].metadata = metadata
+
+    async def _delete_store(self, vector_store_id):
+        del self.stores[vector_store_id]
+
+    async def _create_batch(self, vector_store_id, file_ids):
+        self.batches.append(file_ids)
+        self.stores[vector_store_id].file_counts.completed += len(file_ids) - self._failed_in_batch
+        return SimpleNamespace(file_counts=SimpleNamespace(failed=self._failed_in_batch))
+
+
+class TestVectorStoreBuilder(unittest.IsolatedAsyncioTestCase):
+    """Tests for the vector store builder."""
+
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self.directory = self._directory.name
+        self.manifest_path = os.path.join(self.directory, 'manifest', 'uploaded_files.json')
+        self.paths = []
+        for i in range(20):
+            self.paths.append(os.path.join(self.directory, f'file_{i}.md'))
+            with open(self.paths[-1], 'w') as fp:
+                fp.write(f'content {i}')
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self) -> None:
+        self._directory.cleanup()
+        unittest.TestCase.tearDown(self)
+
+    async def _build(self, client):
+        return await get_or_create_vector_store(
+            client, self.paths, 'store', concurrency=4, manifest_path=self.manifest_path)
+
+    async def test_upload_is_concurrent(self):
+        """Test that the files are uploaded with the limited concurrency and added in one batch."""
+        client = FakeAgentsClient()
+        vector_store_id = await self._build(client)
+        self.assertEqual(sorted(client.uploads), sorted(os.path.basename(path) for path in self.paths))
+        self.assertEqual(client.max_in_flight, 4)
+        self.assertEqual(len(client.batches), 1)
+        self.assertEqual(len(client.batches[0]), 20)
+        self.assertIn('content_hash', client.stores[vector_store_id].metadata)
+        self.assertEqual(len(read_manifest(self.manifest_path)), 20)
+
+    async def test_unchanged_files_are_not_uploaded(self):
+        """Test that the store with the same files is reused without any upload."""
+        client = FakeAgentsClient()
+        vector_store_id = await self._build(client)
+        client.uploads.clear()
+        self.assertEqual(await self._build(client), vector_store_id)
+        self.assertEqual(client.uploads, [])
+        self.assertEqual(len(client.stores), 1)
+
+    async def test_changed_file_is_uploaded(self):
+        """Test that only the changed file is uploaded and the new store is built."""
+        client = FakeAgentsClient()
+        vector_store_id = await self._build(client)
+        with open(self.paths[3], 'w') as fp:
+            fp.write('new content')
+        client.uploads.clear()
+        new_vector_store_id = await self._build(client)
+        self.assertNotEqual(new_vector_store_id, vector_store_id)
+        self.assertEqual(client.uploads, ['file_3.md'])
+        self.assertEqual(client.stores[new_vector_store_id].file_counts.completed, 20)
+
+    async def test_deleted_file_is_uploaded_again(self):
+        """Test that the file, which is in the manifest but not in the service, is uploaded again."""
+        client = FakeAgentsClient()
+        await self._build(client)
+        client.stores.clear()
+        client.file_ids.discard(read_manifest(self.manifest_path)['file_0.md']['id'])
+        client.uploads.clear()
+        await self._build(client)
+        self.assertEqual(client.uploads, ['file_0.md'])
+
+    async def test_failed_upload_keeps_uploaded_files(self):
+        """Test that the files uploaded before the failure are recorded and not uploaded again."""
+        client = FakeAgentsClient(failing_files=['file_3.md'])
+        with self.assertRaises(RuntimeError):
+            await self._build(client)
+        manifest = read_manifest(self.manifest_path)
+        self.assertEqual(len(manifest), 19)
+        self.assertNotIn('file_3.md', manifest)
+        self.assertEqual(client.stores, {})
+
+        client._failing_files.clear()
+        client.uploads.clear()
+        await self._build(client)
+        self.assertEqual(client.uploads, ['file_3.md'])
+        self.assertEqual(len(read_manifest(self.manifest_path)), 20)
+
+    async def test_partial_store_is_deleted(self):
+        """Test that the store, to which some files were not added, is deleted and not marked as reusable."""
+        client = FakeAgentsClient(failed_in_batch=1)
+        with self.assertRaises(RuntimeError):
+            await self._build(client)
+        self.assertEqual(client.stores, {})
+        self.assertEqual(len(read_manifest(self.manifest_path)), 20)
+
+        client._failed_in_batch = 0
+        client.uploads.clear()
+        vector_store_id = await self._build(client)
+        self.assertEqual(client.uploads, [])
+        self.assertEqual(list(client.stores), [vector_store_id])
+        self.assertIn('content_hash', client.stores[vector_store_id].metadata)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import unittest
+
+from api.worker_profile import (
+    PROFILES,
+    get_available_cpus,
+    get_cgroup_cpu_quota,
+    get_profile,
+    get_worker_count,
+)
+
+
+class TestWorkerProfile(unittest.TestCase):
+    """Tests for the execution profiles of the server."""
+
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self.root = self._directory.name
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self) -> None:
+        self._directory.cleanup()
+        unittest.TestCase.tearDown(self)
+
+    def _write(self, name, content):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(content)
+
+    def test_cgroup_v2_quota(self):
+        """Test that the quota is read from the cgroup v2 file."""
+        self._write('cpu.max', '150000 100000\n')
+        self.assertEqual(get_cgroup_cpu_quota(self.root), 1.5)
+        self._write('cpu.max', 'max 100000\n')
+        self.assertIsNone(get_cgroup_cpu_quota(self.root))
+
+    def test_cgroup_v1_quota(self):
+        """Test that the quota is read from the cgroup v1 files."""
+        self._write('cpu/cpu.cfs_period_us', '100000\n')
+        self._write('cpu/cpu.cfs_quota_us', '-1\n')
+        self.assertIsNone(get_cgroup_cpu_quota(self.root))
+        self._write('cpu/cpu.cfs_quota_us', '200000\n')
+        self.assertEqual(get_cgroup_cpu_quota(self.root), 2.0)
+
+    def test_available_cpus(self):
+        """Test that the quota limits the CPUs of the host."""
+        self.assertEqual(get_available_cpus(self.root), len(os.sched_getaffinity(0)))
+        self._write('cpu.max', '50000 100000\n')
+        self.assertEqual(get_available_cpus(self.root), 0.5)
+
+    def test_worker_count(self):
+        """Test the number of workers of the profiles and the overrides."""
+        self.assertEqual(get_worker_count(get_profile(None), 16), 16)
+        self.assertEqual(get_worker_count(get_profile('legacy'), 16), 33)
+        self.assertEqual(get_worker_count(get_profile('async'), 1.5), 2)
+        self.assertEqual(get_worker_count(get_profile('async'), 0.5), 1)
+        self.assertEqual(get_worker_count(get_profile('async'), 16, workers=3), 3)
+        self.assertEqual(get_worker_count(get_profile('legacy'), 16, max_workers=4), 4)
+        self.assertGreater(PROFILES['async'].max_active, PROFILES['legacy'].max_active)
+        with self.assertRaises(ValueError):
+            get_profile('threads')
+
+
+if __name__ == "__main__":
+    unittest.main()